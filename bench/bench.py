@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+logq benchmarks: per-stage timings and end-to-end CLI scenarios on a generated log.
+
+    python bench/bench.py                          # 200k lines, print table
+    python bench/bench.py -n 1000000 --json new.json
+    python bench/bench.py --json new.json --compare old.json
+
+Results are best of --repeat runs, in seconds. JSON results of two versions can be compared with --compare.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from genlog import generate                                     # noqa: E402
+from logq import __version__                                    # noqa: E402
+from logq.expressions import ExpressionCollection               # noqa: E402
+from logq.logfile import LogFile                                 # noqa: E402
+from logq.output import get_writer                               # noqa: E402
+from logq.parser import COMBINED_REGEX, get_parser               # noqa: E402
+from logq.ratecount import RateCount                             # noqa: E402
+
+# queries of logq.toml
+LOGINTAG = "uri=='/client/dashboard' and method=='GET' and status==200"
+LOGIN = "uri=='/login' and method=='POST'"
+POST = "method=='POST'"
+REALUSER = "'LOGIN' in tags"
+
+# end-to-end scenarios: name -> cli arguments
+SCENARIOS = {
+    'cli_sum_top_postrate': ['-q', 'post', 'logintag', '--sum', '-s', 'rates_postrate-', '-n', '50'],
+    'cli_login_json': ['-q', 'login', '-o', 'json'],
+    'cli_realuser_ip': ['-q', 'logintag', 'realuser', '-o', 'ip'],
+    'cli_post_rate': ['-q', 'post', '-o', 'rate'],
+    'cli_onload_post_sum': ['--onload', POST, '-q', 'post', '--sum'],
+}
+
+
+def best_of(repeat: int, func: Callable[[], None]) -> float:
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def make_ec() -> ExpressionCollection:
+    ec = ExpressionCollection()
+    ec.add(LOGINTAG, "tagging", "LOGIN")
+    ec.add(POST, "rate", "postrate")
+    ec.add(LOGIN, "out", None)
+    return ec
+
+
+def stage_benchmarks(path: str, repeat: int) -> Dict[str, float]:
+    regex = re.compile(COMBINED_REGEX)
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    results = dict()
+
+    parser = get_parser(regex, ['method', 'uri'])
+    results['parse'] = best_of(repeat, lambda: [parser.parse(line) for line in lines])
+
+    records = [parser.parse(line)[1] for line in lines]
+    timestamps = [parser.parse(line)[0] for line in lines]
+
+    ec = ExpressionCollection()
+    ec.add(POST, "onload", None)
+    results['onload'] = best_of(repeat, lambda: [ec.apply_all("onload", r) for r in records])
+
+    ec = ExpressionCollection()
+    ec.add(LOGINTAG, "tagging", "LOGIN")
+    results['tagging'] = best_of(repeat, lambda: [ec.matches("tagging", r) for r in records])
+
+    def rate():
+        counters = dict()
+        for n, (ts, r) in enumerate(zip(timestamps, records)):
+            if r['method'] == 'POST':
+                rc = counters.get(r['ip'])
+                if rc is None:
+                    rc = counters[r['ip']] = RateCount(60)
+                rc.add(ts, n)
+    results['rate'] = best_of(repeat, rate)
+
+    def read(**kwargs):
+        logfile = LogFile(path, regex, ec=make_ec(), fields=['method', 'uri'], **kwargs)
+        logfile.read_all()
+        return logfile
+    results['read_all'] = best_of(repeat, lambda: read())
+    results['read_all_mmap'] = best_of(repeat, lambda: read(use_mmap=True))
+
+    logfile = read(use_mmap=True)
+
+    def summaries():
+        logfile._summaries.clear()
+        logfile.summaries()
+    results['summary'] = best_of(repeat, summaries)
+
+    rows = range(len(logfile.store))
+    for output in ('log', 'json'):
+        results[f'output_{output}'] = best_of(repeat, lambda: get_writer(output, io.BytesIO(), logfile.store).write_rows(rows))
+    return results
+
+
+def cli_benchmarks(path: str, repeat: int) -> Dict[str, float]:
+    config = os.path.join(os.path.dirname(HERE), 'logq.toml')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(HERE))
+    results = dict()
+    for name, args in SCENARIOS.items():
+        cmd = [sys.executable, '-c', 'from logq.cli import main; main()', '-c', config, '-l', path] + args
+        results[name] = best_of(repeat, lambda: subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL))
+    return results
+
+
+def compare(results: Dict[str, float], old: Dict[str, float]):
+    print(f"{'benchmark':<24} {'old':>9} {'new':>9} {'ratio':>7}")
+    for name, new in results.items():
+        if name in old:
+            print(f"{name:<24} {old[name]:>9.3f} {new:>9.3f} {new / old[name]:>7.2f}")
+        else:
+            print(f"{name:<24} {'-':>9} {new:>9.3f}")
+
+
+def get_args(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description='logq benchmarks')
+    parser.add_argument('-n', '--lines', type=int, default=200000, help='Lines of generated log (default: %(default)s)')
+    parser.add_argument('--ips', type=int, default=2000)
+    parser.add_argument('--bursts', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log', default=None, help='Use this log instead of generated one')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark, best is reported')
+    parser.add_argument('--only', choices=['stages', 'cli'], default=None)
+    parser.add_argument('--json', metavar='PATH', default=None, help='Write results as json')
+    parser.add_argument('--compare', metavar='PATH', default=None, help='Compare with results saved with --json')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = get_args()
+    with tempfile.TemporaryDirectory(prefix='logq-bench-') as tmp:
+        path = args.log
+        if path is None:
+            path = os.path.join(tmp, 'access.log')
+            generate(path, args.lines, ips=args.ips, bursts=args.bursts, seed=args.seed)
+
+        results = dict()
+        if args.only in (None, 'stages'):
+            results.update(stage_benchmarks(path, args.repeat))
+        if args.only in (None, 'cli'):
+            results.update(cli_benchmarks(path, args.repeat))
+
+        with open(path, 'rb') as f:
+            nlines = sum(1 for _ in f)
+        size = os.path.getsize(path)
+
+    report = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'log': {'lines': nlines, 'bytes': size, 'seed': args.seed, 'generated': args.log is None},
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+    else:
+        for name, elapsed in results.items():
+            print(f"{name:<24} {elapsed:>9.3f}s")
+
+
+if __name__ == '__main__':
+    main()
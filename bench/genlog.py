@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Seeded generator of realistic combined-format access logs for benchmarks.
+
+Same arguments (and seed) always give the same log:
+
+    python bench/genlog.py -n 1000000 --ips 5000 --bursts 20 -o /tmp/access.log
+"""
+import argparse
+import random
+import sys
+from datetime import datetime, timedelta
+from typing import Dict, List, TextIO
+
+START = datetime(2025, 9, 1, 0, 0, 0)
+
+PAGES = ['/', '/about', '/pricing', '/blog/', '/blog/post-{}', '/docs/{}', '/api/items?id={}', '/search?q={}']
+STATIC = ['/static/app.js', '/static/style.css', '/static/logo.png', '/favicon.ico', '/static/img/{}.jpg']
+SCAN = ['/wp-login.php', '/xmlrpc.php', '/wp-admin/', '/.env', '/phpmyadmin/', '/admin.php', '/.git/config']
+
+BROWSERS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Version/17.0 Mobile Safari/604.1',
+]
+BOTS = ['Googlebot/2.1 (+http://www.google.com/bot.html)', 'bingbot/2.0', 'curl/8.0', 'python-requests/2.31']
+REFERRERS = ['-', 'https://www.google.com/', 'https://example.com/', 'https://example.com/blog/']
+
+DEFAULT_STATUS = '200:80,304:6,302:5,404:7,500:2'
+
+
+def parse_mix(s: str) -> Dict[int, int]:
+    """ "200:80,404:7" -> {200: 80, 404: 7} """
+    mix = dict()
+    for part in s.split(','):
+        code, weight = part.split(':')
+        mix[int(code)] = int(weight)
+    return mix
+
+
+def random_ip(rnd: random.Random) -> str:
+    return f"{rnd.randint(1, 223)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+
+
+class Generator:
+    """ mix of human sessions (with logins), crawlers, scanners and bursts of login/xmlrpc POSTs """
+    def __init__(self, lines: int, ips: int, bursts: int, status: Dict[int, int], seed: int):
+        self.rnd = random.Random(seed)
+        self.lines = lines
+        self.ips = [random_ip(self.rnd) for _ in range(ips)]
+        self.agents = {ip: self.rnd.choice(BROWSERS + BOTS[:1] if i % 10 else BOTS) for i, ip in enumerate(self.ips)}
+        self.codes = list(status)
+        self.weights = list(status.values())
+        # line numbers where attack bursts start
+        self.bursts = sorted(self.rnd.randrange(lines) for _ in range(bursts))
+
+    def fill(self, template: str) -> str:
+        return template.format(self.rnd.randint(1, 500)) if '{}' in template else template
+
+    def request(self, ip: str) -> tuple:
+        """ (method, uri, status) of one ordinary request """
+        rnd = self.rnd
+        agent = self.agents[ip]
+        r = rnd.random()
+        if agent in BOTS and r < 0.3:
+            return 'GET', self.fill(rnd.choice(SCAN)), 404
+        if r < 0.45:
+            return 'GET', self.fill(rnd.choice(STATIC)), rnd.choice((200, 200, 200, 304))
+        if r < 0.50:
+            return 'POST', '/login', rnd.choice((302, 302, 200))
+        if r < 0.53:
+            return 'GET', '/client/dashboard', 200
+        return 'GET', self.fill(rnd.choice(PAGES)), rnd.choices(self.codes, self.weights)[0]
+
+    def write(self, f: TextIO):
+        rnd = self.rnd
+        t = START
+        bursts = list(self.bursts)
+        n = 0
+        while n < self.lines:
+            t += timedelta(seconds=rnd.choice((0, 0, 0, 1, 1, 2)))
+            if bursts and n >= bursts[0]:
+                bursts.pop(0)
+                # one ip hammers login or xmlrpc, several requests per second
+                ip = random_ip(rnd)
+                uri = rnd.choice(('/login', '/xmlrpc.php'))
+                agent = rnd.choice(BOTS)
+                for _ in range(min(rnd.randint(200, 2000), self.lines - n)):
+                    t += timedelta(seconds=rnd.choice((0, 0, 0, 1)))
+                    self.line(f, ip, t, 'POST', uri, rnd.choice((200, 401, 403)), agent)
+                    n += 1
+                continue
+
+            ip = rnd.choice(self.ips)
+            method, uri, status = self.request(ip)
+            self.line(f, ip, t, method, uri, status, self.agents[ip])
+            n += 1
+
+    def line(self, f: TextIO, ip: str, t: datetime, method: str, uri: str, status: int, agent: str):
+        size = 0 if status in (302, 304) else self.rnd.randint(200, 60000)
+        f.write(f'{ip} - - [{t.strftime("%d/%b/%Y:%H:%M:%S")} +0000] "{method} {uri} HTTP/1.1" {status} {size} '
+                f'"{self.rnd.choice(REFERRERS)}" "{agent}"\n')
+
+
+def get_args(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description='Generate synthetic combined-format access log')
+    parser.add_argument('-n', '--lines', type=int, default=100000, help='Number of lines (default: %(default)s)')
+    parser.add_argument('--ips', type=int, default=2000, help='Number of regular client ips (default: %(default)s)')
+    parser.add_argument('--bursts', type=int, default=10, help='Number of attack bursts (default: %(default)s)')
+    parser.add_argument('--status', default=DEFAULT_STATUS, help='Status mix of pages, code:weight,... (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', default=None, help='Output file (default: stdout)')
+    return parser.parse_args(argv)
+
+
+def generate(path: str, lines: int, ips: int = 2000, bursts: int = 10, status: str = DEFAULT_STATUS, seed: int = 1):
+    gen = Generator(lines, ips, bursts, parse_mix(status), seed)
+    with open(path, 'w') as f:
+        gen.write(f)
+
+
+def main():
+    args = get_args()
+    gen = Generator(args.lines, args.ips, args.bursts, parse_mix(args.status), args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            gen.write(f)
+    else:
+        gen.write(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Send log lines as syslog datagrams to logq --follow listening on udp:// or unix:// socket.
+
+    logq -c logq.toml -f -l udp://127.0.0.1:5514 -q post -o ip &
+    python bench/sendlog.py /tmp/access.log udp://127.0.0.1:5514 --rate 20000
+
+Lines are sent with RFC 3164 header like nginx (access_log syslog:server=...) does, use --raw to send lines as is.
+"""
+import argparse
+import errno
+import os
+import socket
+import sys
+import time
+from typing import List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from logq.ingest import NETWORK_REGEX, UDP_ADDRESS_REGEX      # noqa: E402
+
+# rate is checked after each BATCH lines
+BATCH = 100
+
+
+def connect(spec: str) -> socket.socket:
+    m = NETWORK_REGEX.match(spec)
+    if not m:
+        raise ValueError(f"Invalid target {spec!r}, use udp://HOST:PORT or unix:///PATH")
+    if m.group('scheme') == 'unix':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.connect(m.group('address'))
+        return sock
+    a = UDP_ADDRESS_REGEX.match(m.group('address'))
+    host = a.group('host') or '127.0.0.1'
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect((host, int(a.group('port'))))
+    return sock
+
+
+def send(sock: socket.socket, lines: List[str], rate: int | None, raw: bool) -> float:
+    """ send lines, not faster than rate lines/sec. Returns elapsed seconds """
+    header = '' if raw else time.strftime('<190>%b %e %H:%M:%S localhost nginx: ')
+    start = time.perf_counter()
+    for n, line in enumerate(lines, 1):
+        data = (header + line).encode('utf-8')
+        while True:
+            try:
+                sock.send(data)
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # send queue is full
+                time.sleep(0.001)
+        if rate and n % BATCH == 0:
+            ahead = n / rate - (time.perf_counter() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    return time.perf_counter() - start
+
+
+def get_args(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description='Send log lines as syslog datagrams')
+    parser.add_argument('log', help='Log file')
+    parser.add_argument('target', help='udp://HOST:PORT or unix:///PATH')
+    parser.add_argument('--rate', type=int, default=None, help='Lines per second (default: as fast as possible)')
+    parser.add_argument('-n', '--lines', type=int, default=None, help='Send only first N lines')
+    parser.add_argument('--raw', action='store_true', default=False, help='Send lines without syslog header')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = get_args()
+    with open(args.log) as f:
+        lines = [line.rstrip('\n') for line in f]
+    if args.lines is not None:
+        lines = lines[:args.lines]
+    sock = connect(args.target)
+    elapsed = send(sock, lines, args.rate, args.raw)
+    print(f"sent {len(lines)} lines in {elapsed:.2f}s ({len(lines) / elapsed:.0f} lines/sec)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
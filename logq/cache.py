@@ -0,0 +1,248 @@
+from array import array
+from types import CodeType
+from typing import Dict, Any, Tuple, List
+import json
+import marshal
+import mmap
+import os
+import re
+import sys
+import zlib
+
+from .__version__ import __version__
+from .recordstore import RecordStore, Column
+
+MAGIC = b'LOGQCACHE\n'
+# bump when parser or file layout changes, old caches are ignored then
+CACHE_VERSION = 2
+ALIGN = 8
+# bump when QueryCache layout changes
+QUERY_CACHE_VERSION = 1
+# ad-hoc expressions of command line are cached too, only last ones are kept
+MAX_EXPRESSIONS = 1000
+TAIL_CHECK = 4096
+
+
+def cache_dir() -> str:
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'logq')
+
+
+def tail_crc(path: str, offset: int) -> int:
+    """ checksum of bytes before offset, to detect log replaced by other file of same inode and bigger size """
+    with open(path, 'rb') as f:
+        start = max(0, offset - TAIL_CHECK)
+        f.seek(start)
+        return zlib.crc32(f.read(offset - start))
+
+
+class Sections:
+    """ reader of sections written by write_sections() """
+    def __init__(self, mm: mmap.mmap, header: Dict[str, Any], data_start: int):
+        self.mm = mm
+        self.header = header
+        self.data_start = data_start
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.header['sections']
+
+    def numbers(self, name: str) -> array:
+        typecode, start, length = self.header['sections'][name]
+        start += self.data_start
+        a = array(typecode)
+        a.frombytes(self.mm[start:start + length])
+        return a
+
+    def strings(self, name: str) -> List[str]:
+        _, start, length = self.header['sections'][name]
+        start += self.data_start
+        if not self.header['counts'][name]:
+            return list()
+        return str(self.mm[start:start + length], 'utf-8').split('\n')
+
+
+def read_sections(mm: mmap.mmap, magic: bytes) -> Sections | None:
+    """ sections of file written by write_sections(), None if file has other magic """
+    if mm[:len(magic)] != magic:
+        return None
+    pos = len(magic)
+    hlen = int.from_bytes(mm[pos:pos + 8], 'little')
+    header = json.loads(mm[pos + 8:pos + 8 + hlen])
+    return Sections(mm, header, pos + 8 + hlen)
+
+
+def write_sections(path: str, magic: bytes, header: Dict[str, Any], sections: List[Tuple[str, str, Any]]):
+    """ write (name, typecode, data) sections: arrays as raw bytes, typecode 'S' for list of strings.
+        Offsets and counts of sections are added to header. File is replaced atomically.
+    """
+    blobs = list()
+    header = dict(header, sections=dict(), counts=dict())
+    pos = 0
+    for name, typecode, data in sections:
+        blob = '\n'.join(data).encode('utf-8') if typecode == 'S' else data.tobytes()
+        header['sections'][name] = (typecode, pos, len(blob))
+        header['counts'][name] = len(data)
+        blobs.append(blob)
+        pad = -len(blob) % ALIGN
+        if pad:
+            blobs.append(b'\0' * pad)
+        pos += len(blob) + pad
+
+    header_bytes = json.dumps(header).encode()
+    # sections start at first aligned position after header, offsets in header are relative to it
+    header_bytes += b' ' * (-(len(magic) + 8 + len(header_bytes)) % ALIGN)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(magic)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp, path)
+
+
+def store_sections(store: RecordStore, prefix: str = '') -> List[Tuple[str, str, Any]] | None:
+    """ sections of RecordStore, None if some fields were not extracted """
+    sections = list()
+    for name in RecordStore.encoded:
+        column: Column = getattr(store, name)
+        if None in column.index:
+            return None
+        sections.append((f'{prefix}{name}.values', 'S', column.values))
+        sections.append((f'{prefix}{name}.codes', column.codes.typecode, column.codes))
+    sections.append((f'{prefix}ts', store.ts.typecode, store.ts))
+    sections.append((f'{prefix}status', store.status.typecode, store.status))
+    sections.append((f'{prefix}size', store.size.typecode, store.size))
+    sections.append((f'{prefix}raw', 'S', store.raw))
+
+    ip_rows = array('I')
+    ip_counts = array('I')
+    for ip in store.ip.values:
+        rows = store.ip_rows[ip]
+        ip_rows.extend(rows)
+        ip_counts.append(len(rows))
+    sections.append((f'{prefix}ip_rows', ip_rows.typecode, ip_rows))
+    sections.append((f'{prefix}ip_counts', ip_counts.typecode, ip_counts))
+    return sections
+
+
+def read_store(sections: Sections, prefix: str = '') -> RecordStore:
+    store = RecordStore()
+    for name in RecordStore.encoded:
+        column: Column = getattr(store, name)
+        column.values = sections.strings(f'{prefix}{name}.values')
+        column.index = {v: code for code, v in enumerate(column.values)}
+        column.codes = sections.numbers(f'{prefix}{name}.codes')
+    store.ts = sections.numbers(f'{prefix}ts')
+    store.status = sections.numbers(f'{prefix}status')
+    store.size = sections.numbers(f'{prefix}size')
+    store.raw = sections.strings(f'{prefix}raw')
+
+    ip_rows = sections.numbers(f'{prefix}ip_rows')
+    ip_counts = sections.numbers(f'{prefix}ip_counts')
+    pos = 0
+    for ip, count in zip(store.ip.values, ip_counts):
+        store.ip_rows[ip] = ip_rows[pos:pos + count]
+        pos += count
+    return store
+
+
+class ParseCache:
+    """ on-disk columnar copy of parsed RecordStore (all fields, before onload)
+
+        File: MAGIC, 8-byte header length, JSON header, then 8-aligned sections:
+        numeric columns as raw array bytes, string lists as one utf-8 blob of values joined
+        by newline (parsed fields and lines never contain newline).
+        Cache is valid for same path, inode and regex if log did not shrink and bytes before
+        cached offset did not change; only bytes after offset need parsing.
+    """
+    def __init__(self, path: str, log_regex: re.Pattern, directory: str | None = None):
+        self.path = os.path.abspath(path)
+        # not imported at start: loading OpenSSL is noticeable in short runs
+        import hashlib
+        self.regex_hash = hashlib.sha1(f"{CACHE_VERSION}:{log_regex.pattern}".encode()).hexdigest()
+        name = hashlib.sha1(self.path.encode()).hexdigest()
+        self.cache_path = os.path.join(directory or cache_dir(), f"{name}.cache")
+
+    def load(self) -> Tuple[RecordStore, int, int] | None:
+        """ returns (store, offset, inode) or None if no valid cache """
+        try:
+            st = os.stat(self.path)
+            with open(self.cache_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sections = read_sections(mm, MAGIC)
+                if sections is None:
+                    return None
+                header = sections.header
+                if header['path'] != self.path or header['inode'] != st.st_ino \
+                        or header['regex'] != self.regex_hash or header['offset'] > st.st_size \
+                        or header['tail_crc'] != tail_crc(self.path, header['offset']):
+                    return None
+                return read_store(sections), header['offset'], header['inode']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, store: RecordStore, offset: int, inode: int):
+        sections = store_sections(store)
+        if sections is None:
+            # some fields were not extracted, can not cache
+            return
+        header = dict(path=self.path, inode=inode, offset=offset, regex=self.regex_hash,
+                      tail_crc=tail_crc(self.path, offset))
+        write_sections(self.cache_path, MAGIC, header, sections)
+
+
+class QueryCache:
+    """ parsed config file and validated expressions (code objects), kept with marshal in cache directory.
+
+        Runs with same config skip parsing toml and validating expressions (and importing toml and
+        evalidate). One file per config path and Python version, used only if config content and
+        logq version are same as when it was saved.
+    """
+    def __init__(self, config_path: str, directory: str | None = None):
+        self.config_path = os.path.abspath(config_path)
+        with open(config_path, 'rb') as f:
+            self.data = f.read()
+        name = f"{zlib.crc32(self.config_path.encode()):08x}.{sys.implementation.cache_tag}"
+        self.cache_path = os.path.join(directory or cache_dir(), f"{name}.qcache")
+        # parsed config (toml), None until loaded or set by caller
+        self.config: Dict[str, Any] | None = None
+        self.code: Dict[str, CodeType] = dict()
+        self.loaded = False
+
+    def load(self) -> bool:
+        try:
+            with open(self.cache_path, 'rb') as f:
+                entry = marshal.load(f)
+            if entry['version'] != [QUERY_CACHE_VERSION, __version__] or entry['data'] != self.data:
+                return False
+            self.config, self.code = entry['config'], entry['code']
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            return False
+        self.loaded = True
+        return True
+
+    def save(self, code: Dict[str, CodeType]):
+        """ save config and code, if something is new. Errors (e.g. read-only cache directory) are ignored """
+        if self.loaded and all(expr in self.code for expr in code):
+            return
+        code = dict(list(code.items())[-MAX_EXPRESSIONS:])
+        entry = dict(version=[QUERY_CACHE_VERSION, __version__], data=self.data, config=self.config, code=code)
+        try:
+            blob = marshal.dumps(entry)
+        except ValueError:
+            # config has values marshal can not store (toml dates)
+            return
+        tmp = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp, self.cache_path)
+        except OSError:
+            return
+        self.code = code
+        self.loaded = True
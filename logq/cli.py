@@ -1,36 +1,69 @@
 import re
-from collections import defaultdict
-from datetime import datetime
-import os
 import sys
 import argparse
 import json
-import toml
-from evalidate import Expr, EvalException, base_eval_model
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Iterable
+import heapq
+from functools import partial
 
 from .stats import stats
 from .logfile import LogFile
-from .config import settings, load_config
-from .expressions import ExpressionCollection
+from .follow import Follower
+from .files import expand_paths, is_compressed, split_sources
+from .config import settings, load_config, save_query_cache
+from .expressions import ExpressionCollection, SESSION_SOURCES
+from .output import open_output, get_writer, selected_rows
+from .timerange import parse_time
+from .netset import IpGrouper, load_networks
+
+def numpy_available() -> bool:
+    try:
+        import numpy     # noqa: F401
+        return True
+    except ImportError:
+        return False
 
 def get_args():
 
     def_period = 60
 
     parser = argparse.ArgumentParser(description=f'Process nginx log file. Python: {sys.version_info.major}.{sys.version_info.minor}')
-    parser.add_argument('-l', '--log', metavar='PATH', type=str, nargs='?', help='Path to log file')
+    parser.add_argument('-l', '--log', metavar='PATH', type=str, nargs='+', help='Path(s) or glob(s) of log files, rotated and compressed (gz, bz2, xz, zst) files are merged by time. With --follow also syslog sockets udp://HOST:PORT and unix:///PATH')
     parser.add_argument("-c", "--config", help="Path to logq.toml")
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Parse log in N processes')
+    parser.add_argument('--cache', action='store_true', default=False, help='Keep parsed log in ~/.cache/logq, next runs parse only appended lines (compressed logs are always parsed)')
+    parser.add_argument('--since', metavar='TIME', default=None, help='Only records since TIME: "01/Sep/2025:16:00:00", "2025-09-01 16:00" or time ago ("90m", "2h", "1d")')
+    parser.add_argument('--until', metavar='TIME', default=None, help='Only records before TIME (same formats as --since)')
+    parser.add_argument('--time-index', action='store_true', default=False, help='With --since/--until: keep sparse offset index of log in ~/.cache/logq for faster seeking')
+    parser.add_argument('--partition', metavar='K/N', default=None, help='Only ips of K-th (0..N-1) of N hash partitions, e.g. to --export shards in parallel')
+    parser.add_argument('--group-net', metavar='BITS', type=int, nargs='+', default=None, help='Sessions per network instead of per ip: IPv4 [IPv6] prefix length, e.g. "24" (IPv6 /64) or "24 48". ip field is network, e.g. 192.0.2.0/24')
 
 
     g = parser.add_argument_group('Output')
     g.add_argument('--verbose', '-v', action='store_true', default=False)
-    g.add_argument('--output', '-o', choices=["json", "log", "ip", "rate"], default="log")    
-    g.add_argument('--sort', '-s', default=None, help='Sort output by given field (e.g. "hits" or "hits-" for descending order)')
-    g.add_argument('--num', '-n', default=None, type=int, help='Num results to show (for [sorted] sessions)')
-    g.add_argument('--period', '-p', default=def_period, type=int, help='period for counters')
+    g.add_argument('--profile', nargs='?', const='table', choices=['table', 'json'], default=None,
+                   help='Print time per stage and per query to stderr, as table (default) or json')
+    g.add_argument('--output', '-o', choices=["json", "log", "ip", "rate", "csv"], default="log", help='json: one object per line (NDJSON)')
+    g.add_argument('--output-file', metavar='PATH', default=None, help='Write output to file instead of stdout')
+    g.add_argument('--export', metavar='PATH', default=None, help='Write per-ip state (and records which passed out stage, unless --sum) to PATH for "logq merge"')
+    g.add_argument('--sort', '-s', default=None, help='Sort output by given field (e.g. "hits" or "hits-" for descending order), several fields are comma separated: "status404-,hits-"')
+    g.add_argument('--num', '-n', default=None, type=int, help='Num results to show (for [sorted] sessions), only top NUM are kept while sorting')
+    g.add_argument('--period', '-p', default=[def_period], type=int, nargs='+', help='period(s) for counters in seconds, e.g. "-p 60 10 600". Extra periods add rates_<counter>_<N>s to summary')
     g.add_argument('--sum', '--summary', action='store_true', default=False, help='print only session summary')
 
+    g = parser.add_argument_group('Follow (live detector)')
+    g.add_argument('-f', '--follow', action='store_true', default=False, help='Tail log and print session when it starts matching session filter (or gets tag/rate match)')
+    g.add_argument('--from-start', action='store_true', default=False, help='With --follow: process existing content of log first')
+    g.add_argument('--idle', default=3600, type=int, metavar='SECONDS', help='With --follow: forget sessions idle for SECONDS (default: %(default)s)')
+    g.add_argument('--interval', default=1.0, type=float, metavar='SECONDS', help='With --follow: poll interval')
+
+    g = parser.add_argument_group('Approximate mode (fixed memory for huge number of ips)')
+    g.add_argument('--approx', action='store_true', default=False, help='Count hits of all ips in sketches, keep sessions (tags, rates, records) only for top ips by hits')
+    g.add_argument('--approx-top', default=10000, type=int, metavar='N', help='Number of tracked top ips (default: %(default)s)')
+    g.add_argument('--approx-width', default=1 << 18, type=int, metavar='W', help='Count-Min sketch width, hits are overestimated by at most e/W of all hits (default: %(default)s)')
+    g.add_argument('--approx-depth', default=4, type=int, metavar='D', help='Count-Min sketch depth, error bound holds with probability 1-exp(-D) (default: %(default)s)')
+    g.add_argument('--approx-records', default=10, type=int, metavar='N', help='Records kept per tracked ip for output (default: %(default)s)')
+
 
     g = parser.add_argument_group('Filters (Session > Record). Stages: onload, tagging, rate, session, out')
     g.add_argument('-q', dest='query', default=None, metavar='NAME', nargs='*', type=str, help='Run named queries NAME from config')
@@ -42,6 +75,9 @@ def get_args():
     g.add_argument('--session', nargs='+', type=str, help='Add session query expression filter(s)')
     g.add_argument('--out', nargs='+', type=str, help='Add out query expression filter(s)')
 
+    g.add_argument('--reorder', action='store_true', default=False, help='Reorder filter expressions by observed selectivity (expressions must be independent)')
+    g.add_argument('--columnar', action='store_true', default=False, help='Evaluate onload, tagging, rate and out expressions over whole columns (needs numpy)')
+
     g = parser.add_argument_group('Variables')
     g.add_argument('--set', nargs='+', dest='setvars', type=str, help='SET context variable(s), e.g. --set var=value var2=value2')
 
@@ -52,37 +88,17 @@ def get_args():
 def session_filter(logfile: LogFile, ec: ExpressionCollection) -> List[Dict[str, Any]]:
     iplist = list()
 
-    # onload already applied in read_all
-
-    # tagging pass
-    for ip in logfile.ips():
-        for r in logfile.ip_records[ip]:
-            rec_data = r.as_dict()
-            for e in ec.iter("tagging"):
-                try:
-                    if eval(e.code, None, rec_data):
-                        logfile.add_tag(ip, e.param)
-                except NameError as ex:
-                    print(f"Name error in expression {e.expr}: {ex}", file=sys.stderr)
-                    sys.exit(1)
-
-    # rating pass
-    for ip in logfile.ips():
-        for r in logfile.ip_records[ip]:
-            rec_data = r.as_dict()
-            for e in ec.iter("rate"):
-                rec_match = eval(e.code, None, rec_data)
-                if rec_match:
-                    logfile.ratecount(ip, e.param, r.datetime, data=r)
-                    pass
+    # onload, tagging, rate (and out) already applied in read_all, one pass per record
 
+    with stats.timer("summary", len(logfile.ip_records)):
+        summaries = logfile.summaries()
 
-    # session and out pass
-    for ip in logfile.ips():
-        summary = logfile.summary(ip)
+    # session pass
+    for ip, summary in summaries.items():
         if ec.apply_all("session", summary) or not ec.session:
             # session summary match
             iplist.append(ip)
+    stats.sum_matches = len(iplist)
         #if all(eval(e.code, None, summary) for e in ec.iter("session")) or not ec.session:
         #    # session summary match
         #    iplist.append(ip)
@@ -91,24 +107,52 @@ def session_filter(logfile: LogFile, ec: ExpressionCollection) -> List[Dict[str,
 
 
 
-def sort_sessions(data: List[Dict[str, Any]], sort_order: str, output: str) -> List[Dict[str, Any]]:
-    """  Sort data by given field """
+class Descending:
+    """ reverses order of non-numeric sort key """
+    __slots__ = ('value',)
 
-    if sort_order is not None:
-        sort_field = sort_order.rstrip('-')
-    else:
-        sort_field = 'hits'
+    def __init__(self, value):
+        self.value = value
 
-    sort_reverse = sort_order.endswith('-') if sort_order else False
+    def __eq__(self, other):
+        return self.value == other.value
 
-    data_sorted = sorted(data, key=lambda x: x.get(sort_field, 0), reverse=sort_reverse)
-    return data_sorted
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def sort_key(sort_order: str | None) -> Callable[[Dict[str, Any]], tuple]:
+    """ key for session summaries from "field", "field-" (descending) or several comma separated: "status404-,hits" """
+    order = list()
+    for field in (sort_order or 'hits').split(','):
+        field = field.strip()
+        order.append((field.rstrip('-'), field.endswith('-')))
+
+    def key(summary: Dict[str, Any]) -> tuple:
+        values = list()
+        for field, descending in order:
+            value = summary.get(field, 0)
+            if descending:
+                value = -value if isinstance(value, (int, float)) else Descending(value)
+            values.append(value)
+        return tuple(values)
+    return key
+
+
+def sort_sessions(data: Iterable[Dict[str, Any]], sort_order: str, output: str, num: int | None = None) -> List[Dict[str, Any]]:
+    """ Sort data by given field(s). With num only top num sessions are kept (heap of num items).
+        Equal sessions keep order of data (ips are sorted)
+    """
+    key = sort_key(sort_order)
+    if num is not None:
+        return heapq.nsmallest(num, data, key=key)
+    return sorted(data, key=key)
 
 
 
 def get_queries(args: argparse.Namespace) -> ExpressionCollection:
     """ Get queries from config and make ec """
-    ec = ExpressionCollection()
+    ec = ExpressionCollection(reorder=args.reorder)
 
     queries = args.query if args.query else list()
 
@@ -159,7 +203,7 @@ def get_queries(args: argparse.Namespace) -> ExpressionCollection:
                         if stage == 'rate':
                             param = qconf['counter']
 
-                        ec.add(query, stage, param)
+                        ec.add(query, stage, param, name=q)
 
                     except KeyError as e:
                         print(f"Invalid query config for {q!r}, missing key {e}")
@@ -180,6 +224,16 @@ def get_queries(args: argparse.Namespace) -> ExpressionCollection:
         if args.out:
             for q in args.out:
                 ec.add(q, "out", None)
+
+        try:
+            load_networks(ec, settings.networks)
+        except (OSError, ValueError) as e:
+            print(f"Can not load network set: {e}", file=sys.stderr)
+            sys.exit(1)
+
+        # validate names and compile stages once, before reading log
+        ec.compile()
+        save_query_cache()
     
     except ValueError as e:
         print(f"Error in expression: {e}")
@@ -187,72 +241,214 @@ def get_queries(args: argparse.Namespace) -> ExpressionCollection:
 
     return ec
 
-def main():
+def needed_fields(args: argparse.Namespace, ec: ExpressionCollection) -> set | None:
+    """ record fields which must be extracted from log lines, None for all """
+    if args.output in ("json", "csv") and not args.sum:
+        return None
+    fields = ec.names(["onload", "tagging", "rate", "out"])
+    fields.update(SESSION_SOURCES[name] for name in ec.names(["session"]) if name in SESSION_SOURCES)
+    if args.sum or args.sort or ec.sort_field:
+        # bytes and uris in printed (or sorted) summary
+        fields.update(SESSION_SOURCES.values())
+    if args.output in ("log", "rate") and not args.sum:
+        fields.add("raw")
+    return fields
+
+def follow_sources(follower: Follower, sources: List[str], fields: List[str], args: argparse.Namespace):
+    """ --follow with several files and/or syslog sockets, each parsed with regex of its log config """
+    from .ingest import Ingest
+    ingest = Ingest(follower, fields=fields, interval=args.interval)
+    try:
+        for spec in sources:
+            ingest.add_source(spec, re.compile(settings.getlogconf(spec)['regex']), from_start=args.from_start)
+    except (OSError, ValueError) as e:
+        ingest.close()
+        print(f"Can not open source: {e}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        ingest.follow()
+    finally:
+        if args.verbose:
+            for spec, lines in ingest.counts().items():
+                print(f"# {spec}: {lines} lines", file=sys.stderr)
 
+def main():
+    if sys.argv[1:2] == ['serve']:
+        from .server import main as serve
+        serve(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['merge']:
+        from .shard import main as merge
+        merge(sys.argv[2:])
+        return
 
     args = get_args()
+    stats.profile = args.profile is not None
     
     load_config(args.config)
 
-    log_path = args.log
-    if not log_path:
+    if not args.log:
         print("No log file specified")
         sys.exit(1)
 
+    file_specs, network = split_sources(args.log)
+    if network and not args.follow:
+        print("udp:// and unix:// sources need --follow", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        log_paths = expand_paths(file_specs)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    # newest file
+    log_path = log_paths[-1] if log_paths else network[0]
+    single = len(log_paths) == 1 and not network and not is_compressed(log_path)
+
     logconf = settings.getlogconf(log_path)
 
     ec = get_queries(args)
 
+    try:
+        since = parse_time(args.since) if args.since else None
+        until = parse_time(args.until) if args.until else None
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
     log_pattern = re.compile(logconf['regex'])
-    logfile = LogFile(log_path, log_pattern, ec=ec, period=args.period)
-    logfile.read_all()
 
-    if args.verbose:
-        print(f"# Loaded {logfile.nrecords} records from {args.path}")
+    group = None
+    if args.group_net:
+        try:
+            if len(args.group_net) > 2:
+                raise ValueError("--group-net takes IPv4 and optional IPv6 prefix length")
+            group = IpGrouper(*args.group_net) if len(args.group_net) == 2 else IpGrouper(args.group_net[0], 64)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
 
+    if args.follow:
+        if any(is_compressed(path) for path in log_paths):
+            print("--follow needs plain log files", file=sys.stderr)
+            sys.exit(1)
+        if args.output == "ip":
+            alert = lambda summary: print(summary['ip'], flush=True)
+        else:
+            alert = None
+        fields = ec.names(["onload", "tagging", "rate"])
+        # size and uri of session fields bytes and uris
+        fields.update(SESSION_SOURCES[name] for name in ec.names(["session"]) if name in SESSION_SOURCES)
+        follower = Follower(log_path, log_pattern, ec=ec, period=args.period, idle=args.idle,
+                            fields=fields, alert=alert, group=group)
+        try:
+            if single:
+                follower.follow(interval=args.interval, from_start=args.from_start)
+            else:
+                follow_sources(follower, log_paths + network, fields, args)
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.columnar and not numpy_available():
+        print("--columnar needs numpy (pip install logq[fast]), evaluating record by record", file=sys.stderr)
+    partition = None
+    if args.partition:
+        try:
+            k, n = (int(x) for x in args.partition.split('/'))
+            if not 0 <= k < n:
+                raise ValueError
+        except ValueError:
+            print(f"Invalid partition {args.partition!r}, use K/N with 0 <= K < N", file=sys.stderr)
+            sys.exit(1)
+        partition = (k, n)
+
+    if args.approx:
+        if args.export or args.output == "rate":
+            print("--approx can not be used with --export and -o rate", file=sys.stderr)
+            sys.exit(1)
+        if args.jobs > 1 or args.cache or args.columnar:
+            print("--approx reads log in one pass, -j, --cache and --columnar are ignored", file=sys.stderr)
+
+    fields = needed_fields(args, ec)
+    logfile_class = LogFile
+    if args.approx:
+        from .sketch import ApproxLogFile
+        logfile_class = partial(ApproxLogFile, top=args.approx_top, width=args.approx_width, depth=args.approx_depth,
+                                records=0 if args.sum else args.approx_records)
+    if args.export:
+        from .shard import ShardLogFile
+        logfile_class = ShardLogFile
+        # records for merge are exported with all fields, summary needs bytes and uris
+        fields = None if not args.sum else fields | set(SESSION_SOURCES.values())
+    logfile = logfile_class(log_path, log_pattern, ec=ec, period=args.period, fields=fields, cache=args.cache,
+                            use_mmap=True, columnar=args.columnar, since=since, until=until, time_index=args.time_index,
+                            partition=partition, group=group)
+    with stats.timer("read"):
+        if single:
+            logfile.read_all(jobs=args.jobs)
+        else:
+            try:
+                logfile.read_files(log_paths, jobs=args.jobs)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+    stats.stage("read").records = logfile.nrecords if stats.profile else 0
+
+    if args.verbose:
+        print(f"# Loaded {logfile.nrecords} records from {' '.join(log_paths)}")
+        if args.approx:
+            print(f"# Sketches: {logfile.nbytes()} bytes, ~{logfile.distinct_ips.count()} distinct ips, "
+                  f"hits overestimated by at most {logfile.hits.error():.0f}, "
+                  f"{len(logfile.sessions)} tracked ips ({logfile.sessions.evicted} evicted)")
+        elif logfile.nrecords:
+            print(f"# Record store: {logfile.store.nbytes()} bytes, {logfile.store.nbytes() // logfile.nrecords} bytes/record")
+
+
+    if args.export:
+        from .shard import export_shard
+        export_shard(logfile, args.export, records=not args.sum, meta=dict(partition=args.partition, group_net=args.group_net))
+        if args.verbose:
+            print(f"# Exported {len(logfile.ip_records)} sessions to {args.export}")
+        return
 
     iplist = session_filter(logfile, ec=ec)
 
     summarize = ec.summarize or args.sum
 
-    if args.sum:
-        # Output
-        data = list()
-
-        for ip in iplist:
-            summary = logfile.summary(ip)
-            data.append(summary)
-        sort_order = ec.sort_field or args.sort
-        data = sort_sessions(data, sort_order=sort_order, output=args.output)
-        print(json.dumps(data, indent=4))
-    else:
-        if args.output == "rate":
-            for ip in iplist:
-                for cnt in logfile.ratecounters(ip):
-                    for r in logfile.rate_records(ip, cnt):
-                        print(r.raw)
-                
+    out = open_output(args.output_file)
+    with stats.timer("output"):
+        if args.sum:
+            # Output
+            sessions = (logfile.summary(ip) for ip in iplist)
+            sort_order = ec.sort_field or args.sort
+            data = sort_sessions(sessions, sort_order=sort_order, output=args.output, num=args.num)
+            out.write(json.dumps(data, indent=4).encode('utf-8') + b'\n')
         else:
-            printed_ips = set()
-            for r in logfile.all_records:
-                if r.ip not in iplist:
-                    continue
-                rec_data = r.as_dict()
-                if ec.apply_all("out", rec_data):
-                    if args.output == "json":
-                        print(json.dumps(rec_data, ensure_ascii=False))
-                    elif args.output == "ip":
-                        if r.ip not in printed_ips:
-                            print(f"# {r.ip}")
-                            printed_ips.add(r.ip)
-                    else:   # log
-                        print(r.raw)
+            store = logfile.kept_records(iplist) if args.approx else logfile.store
+            writer = get_writer(args.output, out, store)
+            if args.approx:
+                writer.write_rows(range(len(store)))
+            elif args.output == "rate":
+                for ip in iplist:
+                    for cnt in logfile.ratecounters(ip):
+                        writer.write_rows(logfile.ratecounts[ip][cnt].top_dataq)
+            else:
+                writer.write_rows(selected_rows(logfile.store, logfile.out_match, iplist))
+            writer.flush()
+            stats.rec_matches = writer.nrows
+            stats.stage("output").records = writer.nrows if stats.profile else 0
 
+    if args.output_file:
+        out.close()
 
     if args.verbose:
-        print("# Sum IP matches:", stats.sum_matches)
-        print("# Sum Name errors:", stats.sum_name_errors)
-        print("# Sum Runtime errors:", stats.sum_runtime_errors)
-        print("# Records matches:", stats.rec_matches)
-        print("# Records Runtime errors:", stats.rec_runtime_errors)
-        
\ No newline at end of file
+        print(f"# Parse errors: {stats.parse_errors}, skipped by onload: {logfile.skipped_onload}")
+        print("# Sessions matched:", stats.sum_matches)
+        print("# Session name/runtime errors:", stats.sum_name_errors, stats.sum_runtime_errors)
+        print("# Records printed:", stats.rec_matches)
+        print("# Record name/runtime errors:", stats.rec_name_errors, stats.rec_runtime_errors)
+
+    if args.profile == "json":
+        print(json.dumps(stats.report(), indent=4), file=sys.stderr)
+    elif args.profile:
+        print(stats.table(), file=sys.stderr)
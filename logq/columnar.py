@@ -0,0 +1,220 @@
+from array import array
+from typing import Any, Dict, List, Iterable, Tuple
+import ast
+import operator
+
+try:
+    import numpy as np
+except ImportError:     # optional, pip install logq[fast]
+    np = None
+
+from .expressions import BindVariables, CompiledStage, Expression
+from .recordstore import RecordStore, MappedLines
+from .utils import format_epoch
+
+# comparisons of numeric column with numeric constant, done directly by numpy
+COMPARE_OPS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne,
+    ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+NUMERIC_FIELDS = ('status', 'size')
+# statuses below this are encoded by lookup table, others (broken lines) by np.unique
+STATUS_RANGE = 65536
+
+
+class Untranslatable(Exception):
+    pass
+
+
+class ColumnView:
+    """ record fields of RecordStore as numpy arrays.
+
+        Every field is seen as (distinct values, per-row codes), so predicate on one field can be
+        evaluated once per distinct value and spread to rows with a lookup table.
+        Columns are built on first use.
+    """
+    def __init__(self, store: RecordStore):
+        self.store = store
+        self.nrows = len(store)
+        self._columns: Dict[str, Tuple[List[Any], Any]] = dict()
+        self._numeric: Dict[str, Any] = dict()
+
+    def numeric(self, field: str):
+        try:
+            return self._numeric[field]
+        except KeyError:
+            pass
+        column = getattr(self.store, field)
+        arr = self._numeric[field] = np.frombuffer(column, dtype=column.typecode) if len(column) else np.zeros(0, dtype=np.int64)
+        return arr
+
+    def encoded(self, field: str) -> Tuple[List[Any], Any]:
+        try:
+            return self._columns[field]
+        except KeyError:
+            pass
+
+        store = self.store
+        if field in RecordStore.encoded:
+            column = getattr(store, field)
+            codes = np.frombuffer(column.codes, dtype=column.codes.typecode) if len(column) else np.zeros(0, dtype=np.uint32)
+            result = (column.values, codes)
+        elif field == 'status':
+            status = self.numeric('status')
+            if len(status) and status.max() >= STATUS_RANGE:
+                distinct, codes = np.unique(status, return_inverse=True)
+                result = (distinct.tolist(), codes)
+            else:
+                # small range, distinct values without sorting
+                distinct = np.flatnonzero(np.bincount(status, minlength=1))
+                codes = np.zeros(STATUS_RANGE, dtype=np.intp)
+                codes[distinct] = np.arange(len(distinct))
+                result = (distinct.tolist(), codes[status])
+        elif field == 'size':
+            distinct, codes = np.unique(self.numeric('size'), return_inverse=True)
+            result = (distinct.tolist(), codes)
+        elif field == 'datetime':
+            distinct, codes = np.unique(self.numeric('ts'), return_inverse=True)
+            result = ([format_epoch(ts) for ts in distinct.tolist()], codes)
+        else:
+            # raw: every row is distinct, nothing to gain
+            raise Untranslatable(field)
+
+        self._columns[field] = result
+        return result
+
+
+class ColumnarExpression:
+    """ one record-level expression evaluated over all rows of store at once.
+
+        Supported subtrees (comparisons, and/or/not, in, startswith/endswith...) which use a single
+        field are evaluated once per distinct value of that field, numeric comparisons with constants
+        directly with numpy. Anything else is evaluated per record, only on rows where translated
+        conjuncts of top-level "and" are true.
+    """
+    def __init__(self, expression: Expression, variables: Dict[str, Any], networks: Dict[str, Any] | None = None,
+                 where: str = "out"):
+        self.expression = expression
+        self.namespace = {'__builtins__': {}}
+        binder = BindVariables(variables, self.namespace, networks)
+        self.node = binder.visit(ast.parse(expression.expr, '<usercode>', 'eval')).body
+        # per-record evaluation of whole expression
+        self.stage = CompiledStage(where, [expression], variables, networks=networks)
+
+    def mask(self, view: ColumnView, fields: Iterable[str]):
+        try:
+            return self.translate(self.node, view)
+        except Untranslatable:
+            pass
+
+        candidates = np.ones(view.nrows, dtype=bool)
+        if isinstance(self.node, ast.BoolOp) and isinstance(self.node.op, ast.And):
+            for child in self.node.values:
+                try:
+                    candidates &= self.translate(child, view)
+                except Untranslatable:
+                    pass
+
+        mask = np.zeros(view.nrows, dtype=bool)
+        store = view.store
+        check = self.stage.check
+        for n in np.flatnonzero(candidates).tolist():
+            mask[n] = check(store.row(n, fields))[0]
+        return mask
+
+    def translate(self, node: ast.AST, view: ColumnView):
+        """ boolean mask of rows where node is true, raises Untranslatable """
+        if isinstance(node, ast.BoolOp):
+            masks = [self.translate(child, view) for child in node.values]
+            reduce = np.logical_and.reduce if isinstance(node.op, ast.And) else np.logical_or.reduce
+            return reduce(masks)
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ~self.translate(node.operand, view)
+
+        if isinstance(node, ast.Constant):
+            return np.full(view.nrows, bool(node.value))
+
+        names = {n.id for n in ast.walk(node) if isinstance(n, ast.Name) and n.id not in self.namespace}
+        if len(names) != 1:
+            raise Untranslatable(ast.dump(node))
+        field = names.pop()
+
+        if field in NUMERIC_FIELDS and isinstance(node, ast.Compare) and len(node.ops) == 1 \
+                and type(node.ops[0]) in COMPARE_OPS:
+            left, right = node.left, node.comparators[0]
+            op = COMPARE_OPS[type(node.ops[0])]
+            if isinstance(left, ast.Name) and self.is_number(right):
+                return op(view.numeric(field), right.value)
+            if isinstance(right, ast.Name) and self.is_number(left):
+                return op(left.value, view.numeric(field))
+
+        return self.lookup(node, field, view)
+
+    @staticmethod
+    def is_number(node: ast.AST) -> bool:
+        return isinstance(node, ast.Constant) and type(node.value) in (int, float)
+
+    def lookup(self, node: ast.AST, field: str, view: ColumnView):
+        """ evaluate node once per distinct value of field """
+        values, codes = view.encoded(field)
+        code = compile(ast.fix_missing_locations(ast.Expression(node)), '<columnar>', 'eval')
+        table = np.zeros(len(values), dtype=bool)
+        try:
+            for i, value in enumerate(values):
+                table[i] = bool(eval(code, self.namespace, {field: value}))
+        except Exception as e:
+            # e.g. None of not extracted field, let per-record evaluation deal with it
+            raise Untranslatable(str(e)) from e
+        return table[codes]
+
+
+def stage_masks(expressions: List[Expression], variables: Dict[str, Any], view: ColumnView,
+                fields: Iterable[str], networks: Dict[str, Any] | None = None, where: str = "out") -> List[Any]:
+    """ boolean mask over rows for each expression of stage where """
+    return [ColumnarExpression(e, variables, networks, where).mask(view, fields) for e in expressions]
+
+
+def take(store: RecordStore, rows) -> RecordStore:
+    """ new store with given rows (sorted numpy array of row numbers) """
+    result = RecordStore()
+    for name in RecordStore.encoded:
+        column = getattr(store, name)
+        target = getattr(result, name)
+        # values (and their codes) are kept as is, some may become unused
+        target.values = column.values
+        target.index = column.index
+        target.codes = _take_array(column.codes, rows)
+    result.ts = _take_array(store.ts, rows)
+    result.status = _take_array(store.status, rows)
+    result.size = _take_array(store.size, rows)
+    if isinstance(store.raw, MappedLines):
+        result.raw = MappedLines(store.raw.buf)
+        result.raw.offsets = _take_array(store.raw.offsets, rows)
+        result.raw.lengths = _take_array(store.raw.lengths, rows)
+        result.raw.extra = store.raw.extra
+    else:
+        raw = store.raw
+        result.raw = [raw[n] for n in rows.tolist()]
+    result.datetimes = dict(store.datetimes)
+
+    # ip -> rows, ips in order of first appearance
+    ipc = np.frombuffer(result.ip.codes, dtype=result.ip.codes.typecode)
+    order = np.argsort(ipc, kind='stable')
+    counts = np.bincount(ipc, minlength=len(result.ip.values))
+    ends = np.cumsum(counts)
+    present = np.flatnonzero(counts)
+    firsts = order[ends[present] - counts[present]]
+    values = result.ip.values
+    for code in present[np.argsort(firsts)].tolist():
+        end = ends[code]
+        result.ip_rows[values[code]] = array('I', order[end - counts[code]:end].astype(np.uint32).tobytes())
+    return result
+
+
+def _take_array(a: array, rows) -> array:
+    result = array(a.typecode)
+    if len(a):
+        result.frombytes(np.frombuffer(a, dtype=a.typecode)[rows].tobytes())
+    return result
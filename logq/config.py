@@ -1,7 +1,11 @@
-import toml
 import os
+from fnmatch import fnmatch
 from typing import List, Dict, Any
 
+from .cache import QueryCache
+from .expressions import validated
+from .files import rotated_base
+
 DEFAULT_PATHS = [
     "/etc/logq.toml",
     "/usr/local/etc/logq.toml",
@@ -16,18 +20,23 @@ class Settings:
     query: dict
     scripts: dict
     context: dict
+    networks: dict
 
     def __repr__(self):
         return f"Settings(def_regex={self.def_regex})"
 
     def getlogconf(self, path) -> Dict[str, Any]:
+        """ config for log path, rotated files (access.log.1, access.log.2.gz) use config of access.log """
+        base = rotated_base(path)
         for v in self.logs.values():
-            if v['path'] == path:
+            if v['path'] in (path, base) or fnmatch(path, v['path']):
                 return v
         # not found
         return dict(regex = self.def_regex)
 
 settings = Settings()
+# QueryCache of each loaded config file
+query_caches: List[QueryCache] = list()
 
 def load_config(path=None):
     paths = [path] if path else DEFAULT_PATHS
@@ -35,7 +44,14 @@ def load_config(path=None):
         if os.path.exists(p):
             # print(f"Loading config from {p}")
 
-            tomlconf =  toml.load(p)
+            qcache = QueryCache(p)
+            if qcache.load():
+                tomlconf = qcache.config
+                validated.update(qcache.code)
+            else:
+                import toml
+                tomlconf = qcache.config = toml.loads(qcache.data.decode('utf-8'))
+            query_caches.append(qcache)
 
             # init settings
             settings.def_regex = tomlconf.get("def_regex", None)
@@ -43,5 +59,12 @@ def load_config(path=None):
             settings.query = tomlconf.get("query", {})
             settings.scripts = tomlconf.get("scripts", {})
             settings.context = tomlconf.get("context", {})
+            settings.networks = tomlconf.get("networks", {})
 
     return {}  
+
+
+def save_query_cache():
+    """ save parsed config and expressions validated in this run for next runs """
+    for qcache in query_caches:
+        qcache.save(validated)
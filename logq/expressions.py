@@ -1,26 +1,460 @@
-from typing import Any, Literal, List, Dict
+from typing import Any, Literal, List, Dict, Tuple, Iterable
 from types import CodeType
-from evalidate import Expr, EvalException, base_eval_model
 from collections.abc import Iterator
+from itertools import compress
+import ast
+import re
 import sys
+import time
+
+from .cache import MAX_EXPRESSIONS
+from .parser import FIELDS
+from .stats import stats
+
+# names available to session stage expressions (see LogFile.summary)
+SESSION_FIELDS = ('ip', 'hits', 'first', 'last', 'duration', 'duration_sec', 'tags',
+                  'bytes', 'uris', 'interval_min', 'interval_avg')
+# record fields needed to compute session fields
+SESSION_SOURCES = {'bytes': 'size', 'uris': 'uri'}
+SESSION_FIELD_REGEX = re.compile(r'(status\d+|rates_\w+)$')
+
+# functions allowed in expressions: net('NAME') is NetSet of [networks.NAME] config, used as "ip in net('NAME')"
+FUNCTIONS = ['net']
+
+# python types which can be embedded into code object as constants
+CONSTANT_TYPES = (int, float, complex, str, bytes, bool, type(None))
+
+# calls before conjuncts of filter stage are reordered by selectivity
+REORDER_SAMPLE = 1000
+
+# tagging/rate stages with fewer indexable rules are evaluated as one tuple
+INDEX_MIN_RULES = 8
+
+# fields whose value is always a substring of raw log line (status/size are converted to int, datetime reformatted)
+LINE_FIELDS = ('ip', 'method', 'uri', 'protocol', 'referrer', 'user_agent', 'raw')
+
+
+# expression -> code validated by evalidate. Filled from QueryCache by load_config(), so expressions
+# validated by previous runs with same config are not validated (and evalidate is not imported) again.
+# Least recently used first, only MAX_EXPRESSIONS are kept (logq serve gets new ad-hoc expressions forever)
+validated: Dict[str, CodeType] = dict()
+_model = None
+
+
+def eval_model():
+    """ evalidate model of expressions, built once """
+    global _model
+    if _model is None:
+        from evalidate import base_eval_model
+        _model = base_eval_model.clone()
+        _model.nodes.extend(['Call', 'Attribute'])
+        _model.attributes.extend(['startswith', 'endswith'])
+        _model.allowed_functions.extend(FUNCTIONS)
+    return _model
 
 
 class Expression:
     expr: str
     code: CodeType
+    node: ast.Expression
     param: Any
-    def __init__(self, expr: str, param: Any = None):
+    def __init__(self, expr: str, param: Any = None, name: str | None = None):
         self.expr = expr
         self.param = param
+        # query name from config (for profiling)
+        self.name = name or expr
+
+        code = validated.pop(expr, None)
+        if code is None:
+            from evalidate import Expr, EvalException
+            try:
+                code = Expr(expr, model=eval_model()).code
+            except EvalException as e:
+                raise ValueError(f"Invalid expression({e}): {expr}") from e
+            if len(validated) >= MAX_EXPRESSIONS:
+                del validated[next(iter(validated))]
+        # (re)inserted as most recently used
+        validated[expr] = code
+        self.code = code
+        self.node = ast.parse(expr, '<usercode>', 'eval')
+
+    def __getstate__(self):
+        # code objects can not be pickled, expression is validated again on unpickling
+        return (self.expr, self.param, self.name)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def names(self) -> set:
+        """ record (or session) fields and variables used by expression, not function names """
+        functions = {n.func.id for n in ast.walk(self.node) if isinstance(n, ast.Call) and isinstance(n.func, ast.Name)}
+        return {n.id for n in ast.walk(self.node) if isinstance(n, ast.Name)} - functions
+
+
+class BindVariables(ast.NodeTransformer):
+    """ replace context variables with constants (or globals of compiled code), and net('NAME') with NetSet """
+    def __init__(self, variables: Dict[str, Any], namespace: Dict[str, Any], networks: Dict[str, Any] | None = None):
+        self.variables = variables
+        self.namespace = namespace
+        self.networks = networks
+
+    def visit_Call(self, node: ast.Call):
+        if not (isinstance(node.func, ast.Name) and node.func.id == 'net') or self.networks is None:
+            return self.generic_visit(node)
+        if len(node.args) != 1 or node.keywords or not isinstance(node.args[0], ast.Constant) \
+                or not isinstance(node.args[0].value, str):
+            raise ValueError("net() takes one network set name: net('NAME')")
+        name = node.args[0].value
+        if name not in self.networks:
+            raise ValueError(f"Unknown network set {name!r}, add [networks.{name}] to config")
+        # lookup is NetSet.__contains__, no call per record
+        glob = f"_net_{list(self.networks).index(name)}"
+        self.namespace[glob] = self.networks[name]
+        return ast.copy_location(ast.Name(glob, ast.Load()), node)
+
+    def visit_Name(self, node: ast.Name):
+        if node.id not in self.variables:
+            return node
+        value = self.variables[node.id]
+        if isinstance(value, CONSTANT_TYPES):
+            return ast.copy_location(ast.Constant(value), node)
+        # not a constant (e.g. list), pass as global which can not be shadowed by record field
+        name = f"_var_{node.id}"
+        self.namespace[name] = value
+        return ast.copy_location(ast.Name(name, ast.Load()), node)
+
+
+def eval_error(where: str, ex: Exception, record: dict):
+    """ count and report error of expression, record (or session) does not match """
+    if isinstance(ex, NameError):
+        stats.error(where, name_error=True)
+        print(f"Name error in {where} expression: {ex}. Fields: {' '.join(record.keys())}", file=sys.stderr)
+    else:
+        # e.g. TypeError on unexpected value
+        stats.error(where, name_error=False)
+        print(f"Error in {where} expression: {ex!r}", file=sys.stderr)
+
+
+class LinePrefilter:
+    """ cheap necessary condition of onload stage, tested on raw line before parsing.
+
+        clauses: every clause must have at least one of its literals in line. Lines which fail
+        can not pass onload, so they are not parsed at all.
+    """
+    def __init__(self, clauses: List[List[str]]):
+        self.clauses = clauses
+        self.byte_clauses = [[lit.encode('utf-8') for lit in clause] for clause in clauses]
+
+    def match(self, line: str) -> bool:
+        for clause in self.clauses:
+            for lit in clause:
+                if lit in line:
+                    break
+            else:
+                return False
+        return True
+
+    def match_bytes(self, line: bytes) -> bool:
+        for clause in self.byte_clauses:
+            for lit in clause:
+                if lit in line:
+                    break
+            else:
+                return False
+        return True
+
+    @staticmethod
+    def clauses_of(node: ast.AST, fields: Iterable[str] = LINE_FIELDS) -> List[List[str]]:
+        """ literals which must be in line if node is true (empty list: no condition).
+            fields: fields whose value is substring of raw line
+        """
+        if isinstance(node, ast.BoolOp):
+            children = [LinePrefilter.clauses_of(child, fields) for child in node.values]
+            if isinstance(node.op, ast.And):
+                return [clause for child in children for clause in child]
+            # or: one of alternatives, each weakened to its first clause
+            if all(children):
+                return [[lit for child in children for lit in child[0]]]
+            return []
+
+        if isinstance(node, ast.Compare) and len(node.ops) == 1:
+            left, op, right = node.left, node.ops[0], node.comparators[0]
+            if isinstance(op, ast.Eq):
+                if LinePrefilter.is_literal(right) and LinePrefilter.is_field(left, fields):
+                    return [[right.value]]
+                if LinePrefilter.is_literal(left) and LinePrefilter.is_field(right, fields):
+                    return [[left.value]]
+            elif isinstance(op, ast.In) and LinePrefilter.is_literal(left) and LinePrefilter.is_field(right, fields):
+                return [[left.value]]
+
+        # uri.startswith('/wp-')
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) \
+                and node.func.attr in ('startswith', 'endswith') and LinePrefilter.is_field(node.func.value, fields) \
+                and len(node.args) == 1 and not node.keywords and LinePrefilter.is_literal(node.args[0]):
+            return [[node.args[0].value]]
+        return []
+
+    @staticmethod
+    def is_field(node: ast.AST, fields: Iterable[str] = LINE_FIELDS) -> bool:
+        return isinstance(node, ast.Name) and node.id in fields
+
+    @staticmethod
+    def is_literal(node: ast.AST) -> bool:
+        return isinstance(node, ast.Constant) and isinstance(node.value, str) and node.value != ''
+
+
+class RuleIndex:
+    """ tagging/rate rules of shape field == literal or field.startswith('literal'), possibly and-ed
+        with other conditions, kept in hash maps. Record needs one lookup per field (and prefix length)
+        instead of eval of every rule; other conditions are evaluated only for rules found by lookup.
+    """
+    def __init__(self):
+        # field -> value -> rules
+        self.equals: Dict[str, Dict[Any, List[int]]] = dict()
+        # field -> prefix length -> prefix -> rules
+        self.prefixes: Dict[str, Dict[int, Dict[str, List[int]]]] = dict()
+        self.size = 0
+
+    def add(self, rule: int, node: ast.AST) -> bool:
+        """ index rule by node (or first indexable conjunct of it), False if it can not be indexed """
+        for conjunct in self.conjuncts(node):
+            key = self.key(conjunct)
+            if key is None:
+                continue
+            kind, field, value = key
+            if kind == 'eq':
+                self.equals.setdefault(field, dict()).setdefault(value, list()).append(rule)
+            else:
+                by_length = self.prefixes.setdefault(field, dict())
+                by_length.setdefault(len(value), dict()).setdefault(value, list()).append(rule)
+                # shortest prefixes first, lookup stops at length of value
+                self.prefixes[field] = dict(sorted(by_length.items()))
+            self.size += 1
+            return True
+        return False
 
-        my_model = base_eval_model.clone()
-        my_model.nodes.extend(['Call', 'Attribute'])
-        my_model.attributes.extend(['startswith', 'endswith'])
+    @staticmethod
+    def conjuncts(node: ast.AST) -> List[ast.AST]:
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            return node.values
+        return [node]
 
+    @staticmethod
+    def key(node: ast.AST) -> Tuple[str, str, Any] | None:
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], ast.Eq):
+            left, right = node.left, node.comparators[0]
+            if isinstance(left, ast.Name) and left.id in FIELDS and isinstance(right, ast.Constant):
+                return ('eq', left.id, right.value)
+            if isinstance(right, ast.Name) and right.id in FIELDS and isinstance(left, ast.Constant):
+                return ('eq', right.id, left.value)
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'startswith' \
+                and isinstance(node.func.value, ast.Name) and node.func.value.id in FIELDS \
+                and len(node.args) == 1 and not node.keywords \
+                and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+            return ('prefix', node.func.value.id, node.args[0].value)
+        return None
+
+    def candidates(self, ctx: dict) -> List[int]:
+        """ rules whose indexed condition is true for record """
+        found = list()
+        for field, values in self.equals.items():
+            rules = values.get(ctx.get(field))
+            if rules:
+                found.extend(rules)
+        for field, by_length in self.prefixes.items():
+            value = ctx.get(field)
+            if not isinstance(value, str):
+                continue
+            for length, prefixes in by_length.items():
+                if length > len(value):
+                    break
+                rules = prefixes.get(value[:length])
+                if rules:
+                    found.extend(rules)
+        return found
+
+
+class CompiledStage:
+    """ all expressions of one stage compiled into a single code object
+
+        Expressions are already validated by evalidate, we only join their ASTs (with BoolOp or Tuple)
+        and bind context variables, so safety model is same. Code is evaluated with record (or session
+        summary) as locals and without builtins.
+    """
+    def __init__(self, where: str, expressions: List[Expression], variables: Dict[str, Any],
+                 reorder: bool = False, networks: Dict[str, Any] | None = None):
+        self.where = where
+        self.expressions = list(expressions)
+        self.variables = variables
+        self.networks = networks
+        self.params = [e.param for e in self.expressions]
+        # filter stages pass if all expressions are true, tagging/rate return matched params
+        self.is_filter = where not in ("tagging", "rate")
+        self.validate()
+
+        self.reorder = reorder and self.is_filter and len(self.expressions) > 1
+        self.calls = 0
+        self.hits = [0] * len(self.expressions)
+        self.compile()
+
+    def validate(self):
+        """ check all names once, before any record is evaluated """
+        for e in self.expressions:
+            for name in e.names():
+                if name in self.variables:
+                    continue
+                if self.where == "session":
+                    if name in SESSION_FIELDS or SESSION_FIELD_REGEX.match(name):
+                        continue
+                elif name in FIELDS:
+                    continue
+                raise ValueError(f"Unknown name {name!r} in {self.where} expression: {e.expr}")
+
+    def compile(self):
+        self.namespace = {'__builtins__': {}}
+        # one stage per expression, built when needed by evaluate_each()
+        self.singles: List[CompiledStage] | None = None
+        if self.where == "session":
+            # status404, rates_x: summary has them only if ip had such hits, default to 0
+            for e in self.expressions:
+                for name in e.names():
+                    if SESSION_FIELD_REGEX.match(name):
+                        self.namespace[name] = 0
+        binder = BindVariables(self.variables, self.namespace, self.networks)
+        nodes = [binder.visit(ast.parse(e.expr, '<usercode>', 'eval')).body for e in self.expressions]
+
+        if not nodes:
+            body = ast.Constant(True) if self.is_filter else ast.Tuple([], ast.Load())
+        elif self.is_filter:
+            body = nodes[0] if len(nodes) == 1 else ast.BoolOp(ast.And(), nodes)
+        else:
+            body = ast.Tuple(nodes, ast.Load())
+
+        tree = ast.fix_missing_locations(ast.Expression(body))
+        self.code = compile(tree, f'<{self.where}>', 'eval')
+
+        # tagging/rate: index equality/prefix rules, only the rest is evaluated as one tuple
+        self.index = None
+        if not self.is_filter:
+            index = RuleIndex()
+            # rule -> code of whole rule, None if indexed condition is the whole rule
+            self.checks: List[CodeType | None] = [None] * len(nodes)
+            self.generic = list()
+            for i, node in enumerate(nodes):
+                if index.add(i, node):
+                    if len(index.conjuncts(node)) > 1:
+                        self.checks[i] = compile(ast.fix_missing_locations(ast.Expression(node)), f'<{self.where}>', 'eval')
+                else:
+                    self.generic.append(i)
+            if index.size >= INDEX_MIN_RULES:
+                self.index = index
+                self.code = compile(ast.fix_missing_locations(ast.Expression(
+                    ast.Tuple([nodes[i] for i in self.generic], ast.Load()))), f'<{self.where}>', 'eval')
+
+    def sample(self, ctx: dict) -> bool:
+        """ count hits of each conjunct, after REORDER_SAMPLE calls put most selective first.
+            Conjuncts must not depend on each other (e.g. guard like "x is not None and x > 1")
+        """
+        result = bool(eval(self.code, self.namespace, ctx))
+        sample_ctx = {**ctx, **self.variables}
+        for i, e in enumerate(self.expressions):
+            try:
+                if eval(e.code, self.namespace, sample_ctx):
+                    self.hits[i] += 1
+            except Exception:
+                pass
+        self.calls += 1
+        if self.calls >= REORDER_SAMPLE:
+            order = sorted(range(len(self.expressions)), key=lambda i: self.hits[i])
+            self.expressions = [self.expressions[i] for i in order]
+            self.hits = [self.hits[i] for i in order]
+            self.reorder = False
+            self.compile()
+        return result
+
+    def evaluate(self, ctx: dict) -> Tuple[bool, List[Any]]:
+        """ returns (passed, matched params) """
+        if self.is_filter:
+            if self.reorder:
+                return self.sample(ctx), []
+            return bool(eval(self.code, self.namespace, ctx)), []
+
+        if self.index is None:
+            matched = list(compress(self.params, eval(self.code, self.namespace, ctx)))
+            return len(matched) == len(self.params), matched
+
+        # cost depends on number of generic and found rules, not on size of index
+        rules = list()
+        if self.generic:
+            rules = list(compress(self.generic, eval(self.code, self.namespace, ctx)))
+        checks = self.checks
+        for i in self.index.candidates(ctx):
+            if checks[i] is None or eval(checks[i], self.namespace, ctx):
+                rules.append(i)
+        params = self.params
+        matched = [params[i] for i in sorted(rules)]
+        return len(matched) == len(params), matched
+
+    def check(self, ctx: dict) -> Tuple[bool, List[Any]]:
+        """ evaluate() which does not raise: expression which raises is counted by eval_error and does not match """
         try:
-            self.code = Expr(expr, model=my_model).code
-        except EvalException as e:
-            raise ValueError(f"Invalid expression({e}): {expr}") from e
+            return self.evaluate(ctx)
+        except Exception:
+            # all expressions of stage are one tuple: find the failing one
+            return False, self.evaluate_each(ctx)
+
+    def evaluate_each(self, ctx: dict) -> List[Any]:
+        """ matched params, expressions evaluated one by one """
+        if self.singles is None:
+            self.singles = [CompiledStage(self.where, [e], self.variables, networks=self.networks)
+                            for e in self.expressions]
+        matched = list()
+        for single, param in zip(self.singles, self.params):
+            try:
+                if single.evaluate(ctx)[0]:
+                    matched.append(param)
+            except Exception as ex:
+                eval_error(self.where, ex, ctx)
+        return matched
+
+
+class ProfiledStage(CompiledStage):
+    """ stage for --profile: expressions are evaluated one by one, to count calls, hits and time of each.
+        Slower than CompiledStage, but time is attributed to queries.
+    """
+    def __init__(self, where: str, expressions: List[Expression], variables: Dict[str, Any],
+                 networks: Dict[str, Any] | None = None):
+        super().__init__(where, expressions, variables, networks=networks)
+        self.singles = [CompiledStage(where, [e], variables, networks=networks) for e in self.expressions]
+        self.queries = [stats.query(e.name, where, e.expr) for e in self.expressions]
+        self.stats = stats.stage(where)
+
+    def evaluate(self, ctx: dict) -> Tuple[bool, List[Any]]:
+        start = time.perf_counter()
+        matched = list()
+        passed = True
+        try:
+            for single, query, param in zip(self.singles, self.queries, self.params):
+                t = time.perf_counter()
+                try:
+                    hit = single.evaluate(ctx)[0]
+                except Exception as ex:
+                    eval_error(self.where, ex, ctx)
+                    hit = False
+                query.time += time.perf_counter() - t
+                query.calls += 1
+                if hit:
+                    query.hits += 1
+                    matched.append(param)
+                else:
+                    passed = False
+                    if self.is_filter:
+                        break
+        finally:
+            self.stats.records += 1
+            self.stats.time += time.perf_counter() - start
+        return passed, matched
 
 
 class ExpressionCollection:
@@ -37,27 +471,35 @@ class ExpressionCollection:
     sort_field: str | None = None
     sort_reverse: bool = False
 
-    def __init__(self):
+    def __init__(self, reorder: bool = False):
         self.onload = list()
         self.tag = list()
         self.rate = list()
         self.session = list()
         self.out = list()
         self.variables = dict()
+        # name -> NetSet, for net('NAME') in expressions
+        self.networks = dict()
+        # reorder conjuncts of filter stages by observed selectivity
+        self.reorder = reorder
+        self.compiled: Dict[str, CompiledStage] = dict()
 
-    def add(self, expr: str, where: Literal["onload", "tagging", "rate", "session", "out"], param: str | None):
+    def add(self, expr: str, where: Literal["onload", "tagging", "rate", "session", "out"], param: str | None,
+            name: str | None = None):
+
+        self.compiled.clear()
 
         # add expression to appropriate place
         if where == "onload":
-            self.onload.append(Expression(expr, param))
+            self.onload.append(Expression(expr, param, name))
         elif where == "tagging":
-            self.tag.append(Expression(expr, param))
+            self.tag.append(Expression(expr, param, name))
         elif where == "rate":
-            self.rate.append(Expression(expr, param))
+            self.rate.append(Expression(expr, param, name))
         elif where == "session":
-            self.session.append(Expression(expr, param))
+            self.session.append(Expression(expr, param, name))
         elif where == "out":
-            self.out.append(Expression(expr, param))
+            self.out.append(Expression(expr, param, name))
         else:
             raise ValueError(f"Invalid expression location: {where}")
 
@@ -81,21 +523,81 @@ class ExpressionCollection:
         else:
             raise ValueError(f"Invalid expression location: {where}")
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['compiled'] = dict()
+        return state
+
+    def compile(self):
+        """ compile all stages, raises ValueError if expression uses unknown name """
+        for where in ("onload", "tagging", "rate", "session", "out"):
+            self.stage(where)
+
+    def stage(self, where: Literal["onload", "tagging", "rate", "session", "out"]) -> CompiledStage:
+        try:
+            return self.compiled[where]
+        except KeyError:
+            pass
+        expressions = list(self.iter(where))
+        if stats.profile and expressions:
+            stage = self.compiled[where] = ProfiledStage(where, expressions, self.variables, networks=self.networks)
+        else:
+            stage = self.compiled[where] = CompiledStage(where, expressions, self.variables, reorder=self.reorder,
+                                                         networks=self.networks)
+        return stage
+
     def apply_all(self, where: Literal["onload", "tagging", "rate", "session", "out"], record: dict) -> bool:
+        return self.stage(where).check(record)[0]
 
-        ctx = {**record, **self.variables}                
+    def matches(self, where: Literal["tagging", "rate"], record: dict) -> List[Any]:
+        """ params (tags, counters) of stage expressions which are true for record """
+        return self.stage(where).check(record)[1]
+
+    def prefilter(self, exclude: Iterable[str] = ()) -> LinePrefilter | None:
+        """ raw line check derived from onload expressions, None if nothing can be derived.
+            Only onload: lines failing tagging/rate/out are still records of their sessions.
+            exclude: fields which are changed after parsing (ip grouped by --group-net), not in line as is
+        """
+        binder = BindVariables(self.variables, dict())
+        fields = [f for f in LINE_FIELDS if f not in exclude]
+        clauses = list()
+        for e in self.onload:
+            clauses.extend(LinePrefilter.clauses_of(binder.visit(ast.parse(e.expr, '<usercode>', 'eval')).body, fields))
+        return LinePrefilter(clauses) if clauses else None
+
+    def masks(self, where: Literal["onload", "tagging", "rate", "out"], view, fields: Iterable[str]) -> List[Any]:
+        """ columnar evaluation: boolean mask over rows of ColumnView for each expression of stage """
+        from .columnar import stage_masks
+        return stage_masks(list(self.iter(where)), self.variables, view, fields, networks=self.networks, where=where)
+
+    def names(self, where: List[str]) -> set:
+        """ names used by expressions in given stages """
+        names = set()
+        for w in where:
+            for e in self.iter(w):
+                names.update(e.names())
+        return names
+
+    def add_networks(self, name: str, netset):
+        """ NetSet available as net('NAME') """
+        self.compiled.clear()
+        self.networks[name] = netset
+
+    def network_names(self) -> set:
+        """ names of network sets used as net('NAME') in any stage """
+        names = set()
+        for where in ("onload", "tagging", "rate", "session", "out"):
+            for e in self.iter(where):
+                for n in ast.walk(e.node):
+                    if isinstance(n, ast.Call) and isinstance(n.func, ast.Name) and n.func.id == 'net' \
+                            and n.args and isinstance(n.args[0], ast.Constant):
+                        names.add(n.args[0].value)
+        return names
 
-        for e in self.iter(where):
-            try:
-                if not eval(e.code, None, ctx):
-                    return False
-            except NameError as ex:
-                print(f"Name error in expression {e.expr!r}: {ex}. Fields: {' '.join(ctx.keys())}", file=sys.stderr)
-                return False
-        return True
-    
     def set_var(self, name, value):
+        self.compiled.clear()
         self.variables[name] = value
 
     def set_vars(self, vars: Dict[str, Any]):
+        self.compiled.clear()
         self.variables.update(vars)
\ No newline at end of file
@@ -0,0 +1,96 @@
+import glob
+import importlib
+import os
+import re
+import stat
+from typing import List, IO, Tuple
+
+# extension -> module with open(), imported only when such file is read
+COMPRESSED = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'lzma',
+    '.lzma': 'lzma',
+}
+
+GLOB_REGEX = re.compile(r'[*?[]')
+
+# syslog sources of --follow (see ingest)
+NETWORK_REGEX = re.compile(r'^(?P<scheme>udp|unix)://(?P<address>.+)$')
+
+# access.log.1, access.log.2.gz
+ROTATED_REGEX = re.compile(r'^(?P<base>.*?)(?:\.(?P<n>\d+))?(?P<ext>\.(?:gz|bz2|xz|lzma|zst))?$')
+
+
+def is_compressed(path: str) -> bool:
+    return os.path.splitext(path)[1] in COMPRESSED or path.endswith('.zst')
+
+
+def open_log(path: str) -> IO[str]:
+    """ open (maybe compressed) log file for reading in text mode """
+    ext = os.path.splitext(path)[1]
+    if ext in COMPRESSED:
+        return importlib.import_module(COMPRESSED[ext]).open(path, 'rt', encoding='utf-8')
+    if ext == '.zst':
+        return open_zstd(path)
+    return open(path, 'r', encoding='utf-8')
+
+
+def open_zstd(path: str) -> IO[str]:
+    try:
+        from compression import zstd
+        return zstd.open(path, 'rt', encoding='utf-8')
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError(f"Can not read {path}: zstd support requires 'zstandard' package (pip install zstandard)")
+    return zstandard.open(path, 'rt', encoding='utf-8')
+
+
+def rotated_base(path: str) -> str:
+    """ /var/log/access.log.2.gz -> /var/log/access.log """
+    return ROTATED_REGEX.match(path).group('base')
+
+
+def rotation_number(path: str) -> int:
+    n = ROTATED_REGEX.match(path).group('n')
+    return int(n) if n else 0
+
+
+def expand_paths(patterns: List[str]) -> List[str]:
+    """ expand globs, order rotated files oldest first (access.log.2.gz, access.log.1, access.log) """
+    paths = list()
+    for pattern in patterns:
+        if GLOB_REGEX.search(pattern):
+            matched = glob.glob(pattern)
+            if not matched:
+                raise ValueError(f"No files match {pattern!r}")
+            paths.extend(sorted(matched))
+        else:
+            paths.append(pattern)
+
+    # stable sort: files of same rotation set oldest first, other files keep order
+    return sorted(dict.fromkeys(paths), key=lambda p: -rotation_number(p))
+
+
+def is_network(spec: str) -> bool:
+    """ udp://HOST:PORT or unix:///path/to/socket """
+    return NETWORK_REGEX.match(spec) is not None
+
+
+def remove_socket(path: str):
+    """ remove unix socket left by previous run before bind. Raises FileExistsError if path is not a socket """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    os.unlink(path)
+
+
+def split_sources(specs: List[str]) -> Tuple[List[str], List[str]]:
+    """ (file patterns, network sources) """
+    return [s for s in specs if not is_network(s)], [s for s in specs if is_network(s)]
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, Callable, List
+import json
+import os
+import time
+
+from .expressions import ExpressionCollection
+from .logfile import LogFile, make_summary
+from .ratecount import RateCount
+from .summary import interval_avg
+
+
+class Session:
+    """ incrementally updated state of one ip.
+
+        bytes and uris are counted only if record has size and uri (fields extracted by parser),
+        interval_min is over consecutive lines (not sorted by time as in LogFile summary)
+    """
+    __slots__ = ('ip', 'hits', 'first', 'last', 'status', 'tags', 'ratecounts', 'alerted',
+                 'bytes', 'uris', 'prev', 'interval_min')
+
+    def __init__(self, ip: str, ts: int):
+        self.ip = ip
+        self.hits = 0
+        self.first = ts
+        self.last = ts
+        self.status: Dict[int, int] = dict()
+        self.tags = set()
+        self.ratecounts: Dict[str, RateCount] = dict()
+        self.alerted = False
+        self.bytes = 0
+        self.uris = set()
+        self.prev = None
+        self.interval_min = None
+
+    def add(self, ts: int, status: int):
+        self.hits += 1
+        if ts < self.first:
+            self.first = ts
+        if ts > self.last:
+            self.last = ts
+        self.status[status] = self.status.get(status, 0) + 1
+
+    def add_record(self, ts: int, record: Dict[str, Any]):
+        """ add() and bytes, uris, intervals """
+        self.add(ts, record['status'])
+        self.bytes += record.get('size', 0)
+        uri = record.get('uri')
+        if uri is not None:
+            self.uris.add(uri)
+        if self.prev is not None:
+            gap = abs(ts - self.prev)
+            if self.interval_min is None or gap < self.interval_min:
+                self.interval_min = gap
+        self.prev = ts
+
+    def extra(self, fields: Iterable[str]) -> Dict[str, Any]:
+        """ bytes (if size is in fields), uris (if uri is), interval_min, interval_avg """
+        extra = dict()
+        if 'size' in fields:
+            extra['bytes'] = self.bytes
+        if 'uri' in fields:
+            extra['uris'] = len(self.uris)
+        extra['interval_min'] = self.interval_min or 0
+        extra['interval_avg'] = interval_avg(self.hits, self.first, self.last)
+        return extra
+
+    def summary(self, fields: Iterable[str] = ()) -> dict:
+        return make_summary(self.ip, self.hits, self.first, self.last, self.status, self.tags, self.ratecounts,
+                            self.extra(fields))
+
+
+class Follower(LogFile):
+    """ tail log and keep per-ip sessions up to date, records are not stored.
+
+        Work per line does not depend on history: session is updated in place, only its own
+        session stage is evaluated, and sessions idle for more than idle seconds (log time) are evicted.
+    """
+    def __init__(self, path, log_pattern, ec: ExpressionCollection, period: int | List[int] = 60, idle: int = 3600,
+                 fields: Iterable[str] | None = None, alert: Callable[[dict], None] | None = None,
+                 group: Callable[[str], str] | None = None):
+        super().__init__(path, log_pattern, ec=ec, period=period, fields=fields, group=group)
+        self.idle = idle
+        self.alert = alert or print_alert
+        # least recently active first
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+        self.evicted = 0
+
+    def add_record(self, ts: int, record: Dict[str, Any]) -> None:
+        if self.group is not None:
+            record['ip'] = self.group(record['ip'])
+        ec = self.ec
+        if not ec.apply_all("onload", record):
+            self.skipped_onload += 1
+            return None
+        self.nrecords += 1
+
+        ip = record['ip']
+        session = self.sessions.get(ip)
+        if session is None:
+            session = self.sessions[ip] = Session(ip, ts)
+        else:
+            self.sessions.move_to_end(ip)
+        session.add_record(ts, record)
+
+        for tag in ec.matches("tagging", record):
+            session.tags.add(tag)
+
+        for counter in ec.matches("rate", record):
+            rc = session.ratecounts.get(counter)
+            if rc is None:
+                rc = session.ratecounts[counter] = RateCount(self.period, keep_data=False)
+            rc.add(ts)
+
+        self.check(session)
+        self.evict(ts)
+        return None
+
+    def check(self, session: Session):
+        """ alert when session starts matching """
+        if self.ec.session:
+            match = self.ec.apply_all("session", session.summary(self.parser.fields))
+        else:
+            # no session filter: any tagging or rate match is interesting
+            match = bool(session.tags or session.ratecounts)
+
+        if match and not session.alerted:
+            self.alert(session.summary(self.parser.fields))
+        session.alerted = match
+
+    def evict(self, now: int):
+        cutoff = now - self.idle
+        while self.sessions:
+            ip, session = next(iter(self.sessions.items()))
+            if session.last >= cutoff:
+                break
+            del self.sessions[ip]
+            self.evicted += 1
+
+    def summary(self, ip: str) -> dict:
+        return self.sessions[ip].summary(self.parser.fields)
+
+    def ips(self):
+        return sorted(self.sessions.keys())
+
+    def follow(self, interval: float = 1.0, from_start: bool = False):
+        """ process new lines forever """
+        if not from_start:
+            with open(self.path, 'rb') as f:
+                self._inode = self._get_inode(f)
+                self._offset = os.fstat(f.fileno()).st_size
+        while True:
+            try:
+                n = self.read_new()
+            except FileNotFoundError:
+                # rotated, new file not created yet
+                n = 0
+            if not n:
+                time.sleep(interval)
+
+
+def print_alert(summary: dict):
+    print(json.dumps(summary, ensure_ascii=False), flush=True)
@@ -0,0 +1,229 @@
+from abc import ABC, abstractmethod
+import asyncio
+import os
+import re
+import socket
+from typing import Dict, List
+
+from .files import NETWORK_REGEX, is_network, remove_socket
+from .follow import Follower
+from .parser import get_parser
+from .stats import stats
+
+# file sources: max bytes read from one file before other sources get their turn
+READ_CHUNK = 256 * 1024
+# syslog sources: max datagrams received at once before other sources get their turn
+RECV_BATCH = 1000
+# receive buffer of syslog sockets, bursts are queued in kernel while lines are processed
+# (limited by net.core.rmem_max)
+RCVBUF = 8 * 1024 * 1024
+MAX_DATAGRAM = 65535
+
+UDP_ADDRESS_REGEX = re.compile(r'^\[?(?P<host>[^\]]*?)\]?:(?P<port>\d+)$')
+
+# syslog header before message: RFC 5424 (<PRI>1 TIMESTAMP HOST APP PROCID MSGID SD) or
+# RFC 3164 (<PRI>Mmm dd hh:mm:ss HOST TAG[PID]:), as sent by nginx (access_log syslog:server=...)
+SYSLOG_REGEX = re.compile(
+    r'^<\d{1,3}>(?:'
+    r'1 \S+ \S+ \S+ \S+ \S+ (?:-|(?:\[(?:[^\]\\]|\\.)*\])+) ?'
+    r'|(?:[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d )?(?:\S+ )?[^\s:\[]+(?:\[\d+\])?: ?'
+    r')')
+
+
+def strip_syslog(message: str) -> str:
+    """ log line from syslog message (messages without syslog header are returned as is) """
+    if message.startswith('<'):
+        m = SYSLOG_REGEX.match(message)
+        if m:
+            return message[m.end():]
+    return message
+
+
+class Source(ABC):
+    """ one input of Ingest: lines are parsed with own regex and fed to shared Follower """
+    def __init__(self, spec: str, log_regex: re.Pattern, ingest: 'Ingest'):
+        self.spec = spec
+        self.parser = get_parser(log_regex, ingest.fields)
+        self.ingest = ingest
+        self.lines = 0
+
+    def add_line(self, line: str):
+        self.lines += 1
+        self.ingest.add_line(self.parser, line)
+
+    @abstractmethod
+    async def run(self):
+        """ feed lines of source to ingest until cancelled """
+
+    def close(self):
+        pass
+
+
+class FileSource(Source):
+    """ tail of plain log file, follows rotation and truncation like LogFile.read_new() """
+    def __init__(self, spec: str, log_regex: re.Pattern, ingest: 'Ingest', from_start: bool = False):
+        super().__init__(spec, log_regex, ingest)
+        self.offset = 0
+        self.inode = None
+        if not from_start:
+            st = os.stat(spec)
+            self.offset, self.inode = st.st_size, st.st_ino
+
+    def read(self) -> int:
+        """ process up to READ_CHUNK bytes of complete new lines, returns bytes processed """
+        with open(self.spec, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if (self.inode is not None and st.st_ino != self.inode) or st.st_size < self.offset:
+                self.offset = 0
+            self.inode = st.st_ino
+            f.seek(self.offset)
+            data = f.read(READ_CHUNK)
+        end = data.rfind(b'\n') + 1
+        if not end:
+            # incomplete line is left for next read (unless it alone fills chunk)
+            if len(data) < READ_CHUNK:
+                return 0
+            end = len(data)
+        # str.splitlines() would also split at \x1c, \x85, \u2028... which may be in user agent
+        for line in data[:end].decode('utf-8', errors='replace').split('\n'):
+            line = line.strip()
+            if line:
+                self.add_line(line)
+        self.offset += end
+        return end
+
+    async def run(self):
+        interval = self.ingest.interval
+        while True:
+            try:
+                n = self.read()
+            except FileNotFoundError:
+                # rotated, new file not created yet
+                n = 0
+            # full chunk: more data is waiting, but let other sources run first
+            await asyncio.sleep(0 if n >= READ_CHUNK else interval)
+
+
+class SyslogSource(Source):
+    """ syslog messages (one or more lines per datagram) on udp://HOST:PORT or unix:///path socket """
+    def __init__(self, spec: str, log_regex: re.Pattern, ingest: 'Ingest'):
+        super().__init__(spec, log_regex, ingest)
+        m = NETWORK_REGEX.match(spec)
+        self.scheme = m.group('scheme')
+        self.address = m.group('address')
+        self.sock = self.bind()
+
+    def bind(self) -> socket.socket:
+        if self.scheme == 'unix':
+            remove_socket(self.address)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            address = self.address
+        else:
+            m = UDP_ADDRESS_REGEX.match(self.address)
+            if not m:
+                raise ValueError(f"Invalid address {self.spec!r}, use udp://HOST:PORT")
+            host, port = m.group('host') or '0.0.0.0', int(m.group('port'))
+            sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+            address = (host, port)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+        except OSError:
+            pass
+        sock.bind(address)
+        return sock
+
+    @property
+    def local_address(self):
+        return self.sock.getsockname()
+
+    def receive(self):
+        """ drain socket (up to RECV_BATCH datagrams), datagram transport of asyncio reads only one per loop iteration """
+        recv = self.sock.recv
+        add_line = self.add_line
+        for _ in range(RECV_BATCH):
+            try:
+                data = recv(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            for message in data.decode('utf-8', errors='replace').split('\n'):
+                if message:
+                    add_line(strip_syslog(message).strip())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.sock.setblocking(False)
+        loop.add_reader(self.sock.fileno(), self.receive)
+        try:
+            await loop.create_future()
+        finally:
+            loop.remove_reader(self.sock.fileno())
+
+    def close(self):
+        self.sock.close()
+        if self.scheme == 'unix':
+            try:
+                remove_socket(self.address)
+            except OSError:
+                pass
+
+
+class Ingest:
+    """ tail several log files and listen on syslog sockets concurrently in one event loop.
+
+        Each source is parsed with regex of its own [log.*] config, records of all sources
+        update sessions of one Follower (tags, rate counters, session alerts).
+    """
+    def __init__(self, follower: Follower, fields: List[str] | None = None, interval: float = 1.0):
+        self.follower = follower
+        self.fields = fields
+        self.interval = interval
+        self.prefilter = follower.prefilter
+        self.sources: List[Source] = list()
+
+    def add_source(self, spec: str, log_regex: re.Pattern, from_start: bool = False) -> Source:
+        if is_network(spec):
+            source = SyslogSource(spec, log_regex, self)
+        else:
+            source = FileSource(spec, log_regex, self, from_start=from_start)
+        self.sources.append(source)
+        return source
+
+    def add_line(self, parser, line: str):
+        follower = self.follower
+        if self.prefilter is not None and not self.prefilter.match(line):
+            follower.skipped_onload += 1
+            return
+        try:
+            ts, record = parser.parse(line)
+        except Exception:
+            stats.parse_errors += 1
+            return
+        follower.add_record(ts, record)
+
+    async def run(self):
+        tasks = [asyncio.create_task(source.run()) for source in self.sources]
+        try:
+            # first failed source stops all
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.close()
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+    def counts(self) -> Dict[str, int]:
+        """ lines received per source """
+        return {source.spec: source.lines for source in self.sources}
+
+    def follow(self):
+        """ process all sources forever """
+        try:
+            asyncio.run(self.run())
+        finally:
+            self.close()
@@ -1,22 +1,90 @@
 from collections import defaultdict
+import mmap
 import os
-from evalidate import base_eval_model, Expr, EvalException
-import sys
-import json
-from datetime import datetime
-from typing import Literal, List, Dict, Any
+import zlib
+from typing import List, Dict, Any, Iterator, Iterable, Tuple, Callable
 
 from .logrecord import LogRecord
-from .utils import dhms
+from .parser import get_parser
+from .recordstore import RecordStore, MappedLines
+from .utils import dhms, from_epoch
 from .ratecount import RateCount
+from .stats import stats
 from .expressions import ExpressionCollection
+from .summary import batch_aggregates, extra_aggregates
+from .timerange import TimeSeeker
+
+# open ends of --since/--until range
+MIN_TS = -(1 << 62)
+MAX_TS = 1 << 62
+
+def complete_end(path: str) -> int:
+    """ offset after last newline of file: end of complete lines, line being written is left out """
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(end - 65536, 0)
+            f.seek(start)
+            pos = f.read(end - start).rfind(b'\n')
+            if pos >= 0:
+                return start + pos + 1
+            end = start
+    return 0
+
+
+def ip_partition(ip: str, n: int) -> int:
+    """ hash partition of ip, same in every process and host """
+    return zlib.crc32(ip.encode()) % n
+
+
+def make_summary(ip: str, hits: int, first: int, last: int, status: Dict[int, int], tags: Iterable[str],
+                 ratecounts: Dict[str, RateCount] | None, extra: Dict[str, Any] | None = None) -> dict:
+    """ session summary from per-ip aggregates (first/last are epoch, status is code -> hits) """
+    sum = dict()
+    sum['ip'] = ip
+    sum['hits'] = hits
+
+    duration = last - first
+    sum['first'] = from_epoch(first).strftime("%d/%b/%Y %H:%M:%S")
+    sum['last'] = from_epoch(last).strftime("%d/%b/%Y %H:%M:%S")
+    sum['duration'] = dhms(duration)
+    sum['duration_sec'] = duration
+
+    for code, n in status.items():
+        sum[f'status{code}'] = n
+
+    if extra:
+        sum.update(extra)
+
+    sum['tags'] = list(tags)
+
+    if ratecounts:
+        for counter, rc in ratecounts.items():
+            sum[f'rates_{counter}'] = rc.get_max()
+            sum[f'rates_{counter}_time'] = rc.get_max_time().strftime("%d/%b/%Y %H:%M:%S")
+            # extra windows (--period 60 10 600)
+            for i, window in enumerate(rc.windows[1:], 1):
+                sum[f'rates_{counter}_{window}s'] = rc.get_max(i)
+                sum[f'rates_{counter}_{window}s_time'] = rc.get_max_time(i).strftime("%d/%b/%Y %H:%M:%S")
+
+    return sum
+
 
 class LogFile:
-    def __init__(self, path, log_pattern, ec: ExpressionCollection | None = None, period: int = 60):
+    def __init__(self, path, log_pattern, ec: ExpressionCollection | None = None, period: int | List[int] = 60, fields: Iterable[str] | None = None,
+                 cache: bool = False, use_mmap: bool = False, columnar: bool = False,
+                 since: int | None = None, until: int | None = None, time_index: bool = False,
+                 partition: Tuple[int, int] | None = None, group: Callable[[str], str] | None = None,
+                 complete_lines: bool = False):
         self.path = path
         self.log_regex = log_pattern
-        self.ip_records = defaultdict(list)
-        self.all_records = list()
+        # fields: extract only these fields from log lines (None: all)
+        self.parser = get_parser(log_pattern, fields)
+        self.store = RecordStore()
+        # ip -> array of row numbers in store
+        self.ip_records = self.store.ip_rows
+        # row n passed out stage
+        self.out_match = bytearray()
         self.tags = defaultdict(set)
         self.ratecounts: Dict[str, Dict[str, RateCount]] = dict()
         self._offset = 0
@@ -25,67 +93,373 @@ class LogFile:
         self.skipped_onload = 0
         self.period = period
         self.ec = ec
-
+        # keep parsed log in ParseCache
+        self.cache = cache
+        # read_all() scans mmap-ed file, raw lines are kept as references into it.
+        # Not for long-running processes: truncating mapped log makes access to old lines fail
+        self.use_mmap = use_mmap
+        # read records first, then evaluate record stages over whole columns (needs numpy)
+        self.columnar = columnar
+        # ip -> cached summary, dropped when ip gets new records
+        self._summaries: Dict[str, dict] = dict()
+        # lines which can not pass onload are not parsed (counted in skipped_onload)
+        self.prefilter = None
+        if ec is not None:
+            self.prefilter = ec.prefilter(exclude=('ip',) if group is not None else ())
+        # only records with since <= timestamp < until (epoch), read_all() seeks to this part of log
+        self.since = since
+        self.until = until
+        self.time_range = None
+        if since is not None or until is not None:
+            self.time_range = (MIN_TS if since is None else since, MAX_TS if until is None else until)
+        # keep sparse offset index of log in cache directory for seeking
+        self.time_index = time_index
+        # (k, n): only ips of k-th of n hash partitions (see ip_partition)
+        self.partition = partition
+        # ip -> session key (e.g. IpGrouper: network of ip), applied before all stages
+        self.group = group
+        # read_all() stops after last newline, line being written is left for read_new() (ParseCache, logq serve)
+        self.complete_lines = complete_lines
 
     def add_tag(self, ip, tag):
         self.tags[ip].add(tag)
 
-    def ratecount(self, ip, tag: str, dt: datetime, data: Any = None):
+    def ratecount(self, ip, tag: str, ts: int, data: Any = None):
         if ip not in self.ratecounts:
             self.ratecounts[ip] = dict()
         if tag not in self.ratecounts[ip]:
             self.ratecounts[ip][tag] = RateCount(self.period)
         
-        self.ratecounts[ip][tag].add(dt, data=data)
+        self.ratecounts[ip][tag].add(ts, data=data)
 
     def parse_line(self, line):
+        if self.prefilter is not None and not self.prefilter.match(line):
+            self.skipped_onload += 1
+            return None
         try:
-            return LogRecord(line, self.log_regex)
+            return self.parser.parse(line)
         except Exception:
+            stats.parse_errors += 1
             return None
 
-    def read_all(self):
-        self.ip_records.clear()
+    def add_record(self, ts: int, record: Dict[str, Any], raw: Tuple[int, int] | None = None) -> int | None:
+        """ run record stages (onload, tagging, rate, out) in one pass and store record. Returns row or None if skipped """
+        if self.group is not None:
+            record['ip'] = self.group(record['ip'])
+        if (self.time_range is not None or self.partition is not None) and not self.selected(ts, record):
+            return None
+
+        ec = self.ec
+        if ec is None:
+            n = self.store.append(ts, record, raw)
+            self._summaries.pop(record['ip'], None)
+            self.out_match.append(1)
+            self.nrecords += 1
+            return n
+
+        if not ec.apply_all("onload", record):
+            self.skipped_onload += 1
+            return None
+
+        n = self.store.append(ts, record, raw)
+        self.nrecords += 1
+        self.apply_stages(n, ts, record)
+        return n
+
+    def selected(self, ts: int, record: Dict[str, Any]) -> bool:
+        """ record is in --since/--until range and in --partition """
+        if self.time_range is not None and not self.time_range[0] <= ts < self.time_range[1]:
+            return False
+        if self.partition is not None and ip_partition(record['ip'], self.partition[1]) != self.partition[0]:
+            return False
+        return True
+
+    def apply_stages(self, n: int, ts: int, record: Dict[str, Any]):
+        """ tagging, rate and out stages for stored row n """
+        ec = self.ec
+        ip = record['ip']
+        self._summaries.pop(ip, None)
+
+        for tag in ec.matches("tagging", record):
+            self.add_tag(ip, tag)
+
+        for counter in ec.matches("rate", record):
+            self.ratecount(ip, counter, ts, data=n)
+
+        self.out_match.append(1 if ec.apply_all("out", record) else 0)
+
+    def reset(self):
+        self.store = RecordStore()
+        self.ip_records = self.store.ip_rows
+        del self.out_match[:]
+        self.tags.clear()
+        self.ratecounts.clear()
+        self._summaries.clear()
+        self.nrecords = 0
+        self.skipped_onload = 0
+
+    def read_all(self, jobs: int = 1):
+        if self._deferred():
+            self._read_columnar(self.read_all, jobs)
+            return
+
+        if self.cache:
+            self._read_cached(jobs)
+            return
+
+        if jobs > 1:
+            from .parallel import read_parallel
+            read_parallel(self, jobs)
+            return
+
+        self.reset()
         self._offset = 0
+        if self.time_range is not None:
+            start, end = self.byte_range()
+            if self.use_mmap and end > start:
+                self._read_mmap(start, end)
+                return
+            from .parallel import range_lines
+            with open(self.path, 'rb') as f:
+                self._inode = self._get_inode(f)
+            for line in range_lines(self.path, start, end):
+                parsed = self.parse_line(line.strip())
+                if parsed:
+                    self.add_record(*parsed)
+            self._offset = end
+            return
+
+        if self.use_mmap and os.path.getsize(self.path):
+            self._read_mmap(*self.byte_range())
+            return
+
+        # bytes of incomplete last line, not read
+        fragment = 0
         with open(self.path, 'r', encoding='utf-8') as f:
             self._inode = self._get_inode(f)
             for line in f:
-                record = self.parse_line(line.strip())
-
-                if record:
-                    record_dict = record.as_dict()                    
-                    # maybe filter?
-                    if self.ec:
-                        if self.ec.apply_all(where="onload", record=record_dict):
-                            # print("PASS", record_dict, file=sys.stderr)                       
-                            self.ip_records[record.ip].append(record)
-                            self.all_records.append(record)
-                            self.nrecords += 1
-                        else:
-                            # print("SKIP", record_dict, file=sys.stderr)
-                            self.skipped_onload += 1
-                    else:
-                        # no filter, just add
-                        self.ip_records[record.ip].append(record)
-                        self.all_records.append(record)
-                        self.nrecords += 1
+                if self.complete_lines and not line.endswith('\n'):
+                    fragment = len(line.encode('utf-8'))
+                    continue
+                fragment = 0
+                parsed = self.parse_line(line.strip())
+                if parsed:
+                    self.add_record(*parsed)
             
-            self._offset = f.tell()
+            self._offset = f.tell() - fragment
 
-    def read_new(self):
-        with open(self.path, 'r', encoding='utf-8') as f:
-            inode = self._get_inode(f)
-            if self._inode is not None and inode != self._inode:
-                self.read_all()
+    def byte_range(self) -> Tuple[int, int]:
+        """ (start, end) offsets of part of log with records of since..until """
+        if self.time_range is None:
+            start, end = 0, os.path.getsize(self.path)
+        else:
+            seeker = TimeSeeker(self.path, self.log_regex, use_index=self.time_index)
+            start, end = seeker.byte_range(self.since, self.until)
+        if self.complete_lines:
+            end = max(start, min(end, complete_end(self.path)))
+        return start, end
+
+    def _read_mmap(self, start: int = 0, end: int | None = None):
+        """ read_all() over mmap-ed file: lines are parsed as bytes, only needed fields are decoded.
+            Only lines of byte range start..end (at line boundaries) are read.
+        """
+        fields = set(self.parser.fields)
+        fields.discard('raw')
+        if self.ec is not None and 'raw' in self.ec.names(["onload", "tagging", "rate", "out"]):
+            fields.add('raw')
+        parser = get_parser(self.log_regex, fields)
+
+        with open(self.path, 'rb') as f:
+            self._inode = self._get_inode(f)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.store.raw = MappedLines(mm)
+
+        end = len(mm) if end is None else end
+        pos = start
+        mm.seek(start)
+        readline = mm.readline
+        while pos < end:
+            line = readline()
+            if not line:
+                break
+            start = pos
+            pos += len(line)
+            if line.endswith(b'\n'):
+                line = line[:-1]
+            if b'\r' in line:
+                # text mode treats lone \r as line break too
+                for segment in (line[:-1] if line.endswith(b'\r') else line).split(b'\r'):
+                    self._add_bytes(parser, segment, start)
+                    start += len(segment) + 1
+            else:
+                self._add_bytes(parser, line, start)
+        self._offset = end
+
+    def _add_bytes(self, parser, line: bytes, offset: int):
+        if self.prefilter is not None and not self.prefilter.match_bytes(line):
+            self.skipped_onload += 1
+            return
+        stripped = line.strip()
+        try:
+            if stripped and (stripped[0] < 0x20 or stripped[-1] < 0x20 or stripped[-1] > 0x7f or stripped[0] > 0x7f):
+                # str.strip() strips more than bytes.strip() (e.g. \x1c, \xa0), use str path
+                ts, record = parser.parse(line.decode('utf-8').strip())
+            else:
+                ts, record = parser.parse_bytes(stripped)
+        except Exception:
+            stats.parse_errors += 1
+            return
+        self.add_record(ts, record, raw=(offset, len(line)))
+
+    def read_files(self, paths: List[str], jobs: int = 1):
+        """ read rotated/compressed set of logs as one stream ordered by time """
+        if self._deferred():
+            self._read_columnar(self.read_files, paths, jobs)
+            return
+        from .parallel import read_files
+        read_files(self, paths, jobs)
+
+    def _deferred(self) -> bool:
+        if not self.columnar or self.ec is None:
+            return False
+        # numpy is imported only when columnar mode is asked for
+        from . import columnar
+        return columnar.np is not None
+
+    def _read_columnar(self, read, *args):
+        """ read records without any stage, then apply stages with apply_columnar() """
+        ec, self.ec = self.ec, None
+        try:
+            read(*args)
+        finally:
+            self.ec = ec
+        self.apply_columnar()
+
+    def apply_columnar(self):
+        """ onload, tagging, rate and out stages over all records in store at once """
+        from . import columnar
+        np = columnar.np
+        ec = self.ec
+        fields = self.parser.fields
+        view = columnar.ColumnView(self.store)
+        self._summaries.clear()
+
+        if ec.onload:
+            with stats.timer("onload", view.nrows):
+                keep = np.logical_and.reduce(ec.masks("onload", view, fields))
+            if not keep.all():
+                self.skipped_onload += view.nrows - int(keep.sum())
+                self.store = columnar.take(self.store, np.flatnonzero(keep))
+                self.ip_records = self.store.ip_rows
+                self.nrecords = len(self.store)
+                view = columnar.ColumnView(self.store)
+
+        store = self.store
+        ip_codes = view.encoded('ip')[1]
+
+        # tags are added in same order as record by record
+        found = list()
+        with stats.timer("tagging", view.nrows):
+            masks = ec.masks("tagging", view, fields)
+        for k, (e, mask) in enumerate(zip(ec.iter("tagging"), masks)):
+            rows = np.flatnonzero(mask)
+            _, first = np.unique(ip_codes[rows], return_index=True)
+            found.extend((n, k, e.param) for n in rows[first].tolist())
+        for n, _, tag in sorted(found):
+            self.add_tag(store.ip[n], tag)
+
+        if ec.rate:
+            params = [e.param for e in ec.iter("rate")]
+            with stats.timer("rate", view.nrows):
+                matched = [np.flatnonzero(mask) for mask in ec.masks("rate", view, fields)]
+            rows = np.concatenate(matched)
+            counters = np.concatenate([np.full(len(m), k) for k, m in enumerate(matched)])
+            order = np.lexsort((counters, rows))
+            ts = store.ts
+            for n, k in zip(rows[order].tolist(), counters[order].tolist()):
+                self.ratecount(store.ip[n], params[k], ts[n], data=n)
+
+        if ec.out:
+            with stats.timer("out", view.nrows):
+                out = np.logical_and.reduce(ec.masks("out", view, fields))
+            self.out_match = bytearray(out.astype(np.uint8).tobytes())
+        else:
+            self.out_match = bytearray(b'\1' * len(store))
+
+    def _read_cached(self, jobs: int = 1):
+        """ load parsed records from ParseCache, parse only bytes appended after it was saved """
+        from .cache import ParseCache
+
+        cache = ParseCache(self.path, self.log_regex)
+        # whole log is cached, time range is applied to cached records
+        full = LogFile(self.path, self.log_regex, use_mmap=self.use_mmap, complete_lines=True)
+        loaded = cache.load()
+        if loaded:
+            full.store, full._offset, full._inode = loaded
+            full.nrecords = len(full.store)
+            nlines = full.read_new()
+        else:
+            full.read_all(jobs=jobs)
+            nlines = len(full.store)
+        if nlines:
+            cache.save(full.store, full._offset, full._inode)
+        if not self.complete_lines:
+            # line being written is read by this run, but is not in cache
+            full.read_tail()
+
+        self.reset()
+        self._offset = full._offset
+        self._inode = full._inode
+        store = full.store
+        fields = self.parser.fields
+
+        if (self.ec is None or not self.ec.onload) and self.time_range is None and self.partition is None \
+                and self.group is None:
+            # nothing to filter out, use cached store as is
+            self.store = store
+            self.ip_records = store.ip_rows
+            self.nrecords = len(store)
+            if self.ec is None:
+                self.out_match = bytearray(b'\1' * len(store))
                 return
+            for n in range(len(store)):
+                self.apply_stages(n, store.ts[n], store.row(n, fields))
+            return
+
+        for n in range(len(store)):
+            self.add_record(store.ts[n], store.row(n, fields))
+
+    def read_new(self) -> int:
+        """ process lines appended since last read, returns number of lines.
+            Keeps state on rotation/truncation (continues from start of new file),
+            incomplete last line is left for next call.
+        """
+        nlines = 0
+        with open(self.path, 'rb') as f:
+            inode = self._get_inode(f)
+            if (self._inode is not None and inode != self._inode) or os.fstat(f.fileno()).st_size < self._offset:
+                self._offset = 0
+            self._inode = inode
             f.seek(self._offset)
             for line in f:
-                record = self.parse_line(line.strip())
-                if record:
-                    self.ip_records[record.ip].append(record)
-                    self.nrecords += 1
-            self._offset = f.tell()
-            self._inode = inode
+                if not line.endswith(b'\n'):
+                    break
+                self._offset += len(line)
+                nlines += 1
+                parsed = self.parse_line(line.decode('utf-8', errors='replace').strip())
+                if parsed:
+                    self.add_record(*parsed)
+        return nlines
+
+    def read_tail(self):
+        """ parse bytes after _offset (incomplete last line), _offset is not moved """
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            tail = f.read()
+        for line in tail.decode('utf-8', errors='replace').split('\n'):
+            parsed = self.parse_line(line.strip()) if line.strip() else None
+            if parsed:
+                self.add_record(*parsed)
 
     def _get_inode(self, f):
         try:
@@ -96,35 +470,44 @@ class LogFile:
     def ips(self):
         return sorted(self.ip_records.keys())
 
-    def summary(self, ip: str) -> dict:
-        sum = dict()
-        status=defaultdict(int)
-        sum['ip'] = ip
-        sum['hits'] = 0
-        
-        times = sorted(r.datetime for r in self.ip_records[ip])
-        duration = int((times[-1] - times[0]).total_seconds())
-        sum['first'] = times[0].strftime("%d/%b/%Y %H:%M:%S")
-        sum['last'] = times[-1].strftime("%d/%b/%Y %H:%M:%S")
-        sum['duration'] = dhms(duration)
-        sum['duration_sec'] = duration
+    def records(self, ip: str | None = None) -> Iterator[LogRecord]:
+        """ all records in log order, or records of one ip """
+        if ip is None:
+            return self.store.records()
+        return self.store.records(self.ip_records[ip])
 
-        for r in self.ip_records[ip]:
-            status[f'status{r.status}'] += 1
-            sum['hits'] += 1
+    def summary(self, ip: str) -> dict:
+        """ session summary for ip, cached until ip gets new records """
+        try:
+            return self._summaries[ip]
+        except KeyError:
+            pass
+        sum = self._summaries[ip] = self._make_summary(ip)
+        return sum
 
-        # merge data from status to sum
-        sum.update(status)
+    def _make_summary(self, ip: str) -> dict:
+        status = defaultdict(int)
+        rows = self.ip_records[ip]
+        ts = self.store.ts
+        for n in rows:
+            status[self.store.status[n]] += 1
 
-        sum['tags'] = list(self.tags[ip])
+        return make_summary(ip, len(rows), min(ts[n] for n in rows), max(ts[n] for n in rows), status,
+                            self.tags[ip], self.ratecounts.get(ip), extra_aggregates(self.store, rows, self.parser.fields))
 
-        if ip in self.ratecounts:
-            for counter in self.ratecounts[ip]:            
-                sum[f'rates_{counter}'] = self.ratecounts[ip][counter].get_max()
-                sum[f'rates_{counter}_time'] = self.ratecounts[ip][counter].get_max_time().strftime("%d/%b/%Y %H:%M:%S")
-        
-            
-        return sum
+    def summaries(self) -> Dict[str, dict]:
+        """ summaries of all ips, computed in one batch with numpy if available.
+            Only ips without cached summary (new records since last call, e.g. in logq serve) are computed
+        """
+        if len(self._summaries) < len(self.ip_records):
+            stale = [ip for ip in self.ip_records if ip not in self._summaries]
+            aggregates = batch_aggregates(self.store, self.parser.fields,
+                                          None if len(stale) == len(self.ip_records) else stale)
+            if aggregates is not None:
+                for ip, (hits, first, last, status, extra) in aggregates.items():
+                    self._summaries[ip] = make_summary(ip, hits, first, last, status, self.tags[ip],
+                                                       self.ratecounts.get(ip), extra)
+        return {ip: self.summary(ip) for ip in self.ips()}
 
     def ratecounters(self, ip: str) -> List[str]:
         if ip in self.ratecounts:
@@ -133,5 +516,5 @@ class LogFile:
     
     def rate_records(self, ip: str, tag: str) -> List[Any]:
         if ip in self.ratecounts and tag in self.ratecounts[ip]:            
-            return list(self.ratecounts[ip][tag].top_dataq)
+            return [LogRecord(self.store, n) for n in self.ratecounts[ip][tag].top_dataq]
         return list()
\ No newline at end of file
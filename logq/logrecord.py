@@ -1,32 +1,74 @@
 from datetime import datetime
 
+from .utils import from_epoch
+
+DATETIME_FMT = "%d/%b/%Y %H:%M:%S"
+
+
 class LogRecord:
-    def __init__(self, line, log_regex):
-        m = log_regex.match(line)
-        if not m:
-            raise ValueError(f'Invalid log line: {line}')
-        self.ip = m.group('ip')
-        self.datetime_str = m.group('datetime')
-        self.datetime = datetime.strptime(self.datetime_str.split()[0], "%d/%b/%Y:%H:%M:%S")
-        self.method = m.group('method')
-        self.uri = m.group('uri')
-        self.protocol = m.group('protocol')
-        self.status = int(m.group('status'))
-        self.size = int(m.group('size'))
-        self.referrer = m.group('referrer')
-        self.user_agent = m.group('user_agent')
-        self.raw = line
+    """ lightweight view of one row in RecordStore """
+    __slots__ = ('store', 'n')
+
+    def __init__(self, store, n: int):
+        self.store = store
+        self.n = n
+
+    @property
+    def ip(self) -> str:
+        return self.store.ip[self.n]
+
+    @property
+    def ts(self) -> int:
+        return self.store.ts[self.n]
+
+    @property
+    def datetime(self) -> datetime:
+        return from_epoch(self.store.ts[self.n])
+
+    @property
+    def method(self) -> str:
+        return self.store.method[self.n]
+
+    @property
+    def uri(self) -> str:
+        return self.store.uri[self.n]
+
+    @property
+    def protocol(self) -> str:
+        return self.store.protocol[self.n]
+
+    @property
+    def status(self) -> int:
+        return self.store.status[self.n]
+
+    @property
+    def size(self) -> int:
+        return self.store.size[self.n]
+
+    @property
+    def referrer(self) -> str:
+        return self.store.referrer[self.n]
+
+    @property
+    def user_agent(self) -> str:
+        return self.store.user_agent[self.n]
+
+    @property
+    def raw(self) -> str:
+        return self.store.raw[self.n]
 
     def as_dict(self):
+        store = self.store
+        n = self.n
         return {
-            'ip': self.ip,
-            'datetime': self.datetime.strftime("%d/%b/%Y %H:%M:%S"),
-            'method': self.method,
-            'uri': self.uri,
-            'protocol': self.protocol,
-            'status': self.status,
-            'size': self.size,
-            'referrer': self.referrer,
-            'user_agent': self.user_agent,
-            'raw': self.raw
-        }
\ No newline at end of file
+            'ip': store.ip[n],
+            'datetime': store.datetime_str(n),
+            'method': store.method[n],
+            'uri': store.uri[n],
+            'protocol': store.protocol[n],
+            'status': store.status[n],
+            'size': store.size[n],
+            'referrer': store.referrer[n],
+            'user_agent': store.user_agent[n],
+            'raw': store.raw[n]
+        }
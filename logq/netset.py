@@ -0,0 +1,207 @@
+import ipaddress
+from typing import Dict, Any, Iterable, List, Tuple
+
+# ip -> result caches of NetSet and IpGrouper are cleared when they reach this size
+CACHE_SIZE = 65536
+
+IpNetwork = ipaddress.IPv4Network | ipaddress.IPv6Network
+
+
+def parse_networks(line: str) -> Tuple[List[IpNetwork], str | None]:
+    """ networks of one line of network list and its ASN (None if line has no ASN column).
+
+        Line is CIDR or ip ("10.0.0.0/8", "192.0.2.1"), range ("192.0.2.10-192.0.2.99",
+        "192.0.2.10 - 192.0.2.99"), or ip2asn row ("START END ASN ..."). Text after # is ignored.
+    """
+    words = line.split('#', 1)[0].split()
+    if not words:
+        return [], None
+    if '-' in words[0]:
+        start, _, end = words[0].partition('-')
+        rest = words[1:]
+    elif len(words) >= 3 and words[1] == '-':
+        start, end, rest = words[0], words[2], words[3:]
+    elif len(words) >= 2 and '/' not in words[0]:
+        start, end, rest = words[0], words[1], words[2:]
+    else:
+        return [ipaddress.ip_network(words[0], strict=False)], None
+
+    first, last = ipaddress.ip_address(start), ipaddress.ip_address(end)
+    if first > last:
+        raise ValueError(f"Invalid range {start}-{end}")
+    asn = rest[0].upper().removeprefix('AS') if rest else None
+    return list(ipaddress.summarize_address_range(first, last)), asn
+
+
+class NetSet:
+    """ set of IPv4/IPv6 networks, compiled into radix tries with 8-bit stride.
+
+        Trie node is dict: byte of address -> [covered, child node]. Network with prefix not on
+        byte boundary is expanded to all values of its last byte, so lookup of ip is at most
+        one dict lookup per byte of its prefix (4 for IPv4, 16 for IPv6), whatever the number
+        of networks. Results are cached per ip string.
+    """
+    def __init__(self, networks: Iterable[str | IpNetwork] = ()):
+        self.v4: Dict[int, list] = dict()
+        self.v6: Dict[int, list] = dict()
+        # 0.0.0.0/0, ::/0
+        self.all4 = False
+        self.all6 = False
+        self.size = 0
+        self._cache: Dict[str, bool] = dict()
+        for network in networks:
+            self.add(network)
+
+    def add(self, network: str | IpNetwork):
+        """ add CIDR network, ip or range "FIRST-LAST" """
+        if isinstance(network, str):
+            networks, _ = parse_networks(network)
+        else:
+            networks = [network]
+        for net in networks:
+            self.add_network(net)
+
+    def add_network(self, network: IpNetwork):
+        self._cache.clear()
+        self.size += 1
+        prefix = network.prefixlen
+        if not prefix:
+            if network.version == 4:
+                self.all4 = True
+            else:
+                self.all6 = True
+            return
+
+        address = network.network_address.packed
+        node = self.v4 if network.version == 4 else self.v6
+        depth = (prefix + 7) // 8
+        for byte in address[:depth - 1]:
+            entry = node.setdefault(byte, [False, None])
+            if entry[0]:
+                # already covered by shorter prefix
+                return
+            if entry[1] is None:
+                entry[1] = dict()
+            node = entry[1]
+
+        # last byte: all values which share its first (prefix - 8 * (depth - 1)) bits
+        free = 8 * depth - prefix
+        first = address[depth - 1] >> free << free
+        for byte in range(first, first + (1 << free)):
+            node[byte] = [True, None]
+
+    def __contains__(self, ip: Any) -> bool:
+        try:
+            return self._cache[ip]
+        except KeyError:
+            pass
+        if not isinstance(ip, str):
+            # None of not extracted field
+            return False
+        found = self.lookup(ip)
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[ip] = found
+        return found
+
+    def lookup(self, ip: str) -> bool:
+        """ ip (or network address of "ip/prefix", as grouped by IpGrouper) is in one of networks """
+        ip = ip.partition('/')[0]
+        try:
+            if ':' in ip:
+                address = ipaddress.IPv6Address(ip)
+                if address.ipv4_mapped is None:
+                    return self.all6 or self._walk(self.v6, address.packed)
+                address = address.ipv4_mapped.packed
+            else:
+                address = bytes(map(int, ip.split('.')))
+                if len(address) != 4:
+                    return False
+        except ValueError:
+            return False
+        return self.all4 or self._walk(self.v4, address)
+
+    @staticmethod
+    def _walk(node: Dict[int, list], address: bytes) -> bool:
+        for byte in address:
+            entry = node.get(byte)
+            if entry is None:
+                return False
+            if entry[0]:
+                return True
+            node = entry[1]
+        return False
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_config(cls, conf: Dict[str, Any]) -> 'NetSet':
+        """ [networks.NAME] config: networks = [...] list and/or file(s) with one network, range or
+            ip2asn row per line; asn = [...] keeps only rows of these ASNs
+        """
+        netset = cls(conf.get('networks', ()))
+        files = conf.get('file', [])
+        if isinstance(files, str):
+            files = [files]
+        asns = {str(asn).upper().removeprefix('AS') for asn in conf.get('asn', ())}
+        for path in files:
+            netset.load(path, asns)
+        return netset
+
+    def load(self, path: str, asns: Iterable[str] = ()):
+        """ add networks from file, only rows with ASN in asns if given """
+        asns = set(asns)
+        with open(path, 'r', encoding='utf-8') as f:
+            for n, line in enumerate(f, 1):
+                try:
+                    networks, asn = parse_networks(line)
+                except ValueError as e:
+                    raise ValueError(f"{path}:{n}: {e}") from e
+                if asns and asn not in asns:
+                    continue
+                for network in networks:
+                    self.add_network(network)
+
+
+# name -> NetSet loaded from config, shared by all ExpressionCollections of process
+_loaded: Dict[str, NetSet] = dict()
+
+
+def load_networks(ec, conf: Dict[str, Dict[str, Any]]):
+    """ add network sets used by expressions of ec ([networks.NAME] of config) to ec.
+        Raises OSError or ValueError if file can not be read, unknown names are left to ec.compile()
+    """
+    for name in ec.network_names():
+        if name in ec.networks or name not in conf:
+            continue
+        if name not in _loaded:
+            _loaded[name] = NetSet.from_config(conf[name])
+        ec.add_networks(name, _loaded[name])
+
+
+class IpGrouper:
+    """ ip -> its network ("192.0.2.0/24", "2001:db8::/64"), so sessions are per network instead of per ip """
+    def __init__(self, v4: int = 32, v6: int = 128):
+        if not 0 <= v4 <= 32 or not 0 <= v6 <= 128:
+            raise ValueError(f"Invalid prefix length /{v4} /{v6}")
+        self.v4 = v4
+        self.v6 = v6
+        self._cache: Dict[str, str] = dict()
+
+    def __call__(self, ip: str) -> str:
+        try:
+            return self._cache[ip]
+        except KeyError:
+            pass
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            # not an address, keep as is
+            return ip
+        prefix = self.v4 if address.version == 4 else self.v6
+        network = str(ipaddress.ip_network((address, prefix), strict=False))
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[ip] = network
+        return network
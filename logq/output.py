@@ -0,0 +1,201 @@
+from abc import ABC, abstractmethod
+from itertools import compress
+from typing import BinaryIO, Callable, Iterable, List
+import csv
+import io
+import json
+import operator
+import sys
+
+# optional, faster json. Imported by JsonWriter, import takes longer than short runs without -o json
+orjson = None
+
+from .recordstore import RecordStore, MappedLines
+
+# writes are batched to this size
+BATCH_SIZE = 256 * 1024
+
+# fields of -o json and -o csv, in order of LogRecord.as_dict()
+JSON_FIELDS = ('ip', 'datetime', 'method', 'uri', 'protocol', 'status', 'size', 'referrer', 'user_agent', 'raw')
+CSV_FIELDS = JSON_FIELDS[:-1]
+
+
+def import_orjson():
+    global orjson
+    if orjson is None:
+        try:
+            import orjson
+        except ImportError:
+            pass
+
+
+def dumps(value) -> bytes:
+    """ json of single value, same as json.dumps(value, ensure_ascii=False) """
+    if orjson is not None and isinstance(value, str):
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+def open_output(path: str | None) -> BinaryIO:
+    """ binary stream for output file, or stdout """
+    if path is None:
+        sys.stdout.flush()
+        if hasattr(sys.stdout, 'buffer'):
+            return sys.stdout.buffer
+        # stdout replaced with text stream (e.g. redirect_stdout)
+        return TextOutput(sys.stdout)
+    return open(path, 'wb')
+
+
+class TextOutput:
+    """ binary writes to text stream """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data: bytes):
+        self.stream.write(data.decode('utf-8'))
+
+    def flush(self):
+        self.stream.flush()
+
+
+def selected_rows(store: RecordStore, out_match: bytearray, ips: Iterable[str]) -> Iterable[int]:
+    """ rows which passed out stage and belong to one of sessions, in log order """
+    allowed = bytearray(len(store.ip.values))
+    for ip in ips:
+        allowed[store.ip.index[ip]] = 1
+    # membership by ip code, no string hashing per row
+    in_session = map(allowed.__getitem__, store.ip.codes)
+    return compress(range(len(store)), map(operator.and_, out_match, in_session))
+
+
+class RecordWriter(ABC):
+    """ writes records of store as lines, in batches """
+    def __init__(self, out: BinaryIO, store: RecordStore):
+        self.out = out
+        self.store = store
+        self.buf: List[bytes] = list()
+        self.size = 0
+        # rows written
+        self.nrows = 0
+
+    @abstractmethod
+    def format(self, n: int) -> bytes | None:
+        """ line of row n, None if row is not written """
+
+    def write(self, line: bytes):
+        self.buf.append(line)
+        self.size += len(line)
+        if self.size >= BATCH_SIZE:
+            self.flush()
+
+    def write_rows(self, rows: Iterable[int]):
+        fmt = self.format
+        write = self.write
+        for n in rows:
+            line = fmt(n)
+            if line is not None:
+                write(line)
+                self.nrows += 1
+
+    def flush(self):
+        if self.buf:
+            self.out.write(b''.join(self.buf))
+            self.buf.clear()
+            self.size = 0
+        self.out.flush()
+
+
+class LogWriter(RecordWriter):
+    """ -o log, -o rate: raw lines """
+    def __init__(self, out: BinaryIO, store: RecordStore):
+        super().__init__(out, store)
+        raw = store.raw
+        if isinstance(raw, MappedLines):
+            self.raw = raw.line_bytes
+        else:
+            self.raw = lambda n: raw[n].encode('utf-8')
+
+    def format(self, n: int) -> bytes:
+        return self.raw(n) + b'\n'
+
+
+class IpWriter(RecordWriter):
+    """ -o ip: each ip once """
+    def __init__(self, out: BinaryIO, store: RecordStore):
+        super().__init__(out, store)
+        self.printed = bytearray(len(store.ip.values))
+
+    def format(self, n: int) -> bytes | None:
+        code = self.store.ip.codes[n]
+        if self.printed[code]:
+            return None
+        self.printed[code] = 1
+        return b'# ' + self.store.ip.values[code].encode('utf-8') + b'\n'
+
+
+class JsonWriter(RecordWriter):
+    """ -o json: one json object per line (NDJSON), same as json.dumps(record.as_dict()).
+
+        Values of dictionary-encoded columns and timestamps are serialized once and reused.
+    """
+    def __init__(self, out: BinaryIO, store: RecordStore):
+        super().__init__(out, store)
+        import_orjson()
+        self.columns = [self.encoded_column(name) for name in RecordStore.encoded]
+        self.datetimes = dict()
+
+    def encoded_column(self, name: str) -> Callable[[int], bytes]:
+        column = getattr(self.store, name)
+        cache: List[bytes | None] = list()
+
+        def get(n: int) -> bytes:
+            code = column.codes[n]
+            if code >= len(cache):
+                cache.extend([None] * (len(column.values) - len(cache)))
+            value = cache[code]
+            if value is None:
+                value = cache[code] = dumps(column.values[code])
+            return value
+        return get
+
+    def format(self, n: int) -> bytes:
+        store = self.store
+        ip, method, uri, protocol, referrer, user_agent = (get(n) for get in self.columns)
+        ts = store.ts[n]
+        dt = self.datetimes.get(ts)
+        if dt is None:
+            dt = self.datetimes[ts] = dumps(store.datetime_str(n))
+        return b''.join((
+            b'{"ip": ', ip, b', "datetime": ', dt, b', "method": ', method, b', "uri": ', uri,
+            b', "protocol": ', protocol, b', "status": ', b'%d' % store.status[n], b', "size": ', b'%d' % store.size[n],
+            b', "referrer": ', referrer, b', "user_agent": ', user_agent, b', "raw": ', dumps(store.raw[n]), b'}\n'))
+
+
+class CsvWriter(RecordWriter):
+    """ -o csv: header and one row per record (without raw line) """
+    def __init__(self, out: BinaryIO, store: RecordStore):
+        super().__init__(out, store)
+        self.text = io.StringIO()
+        self.csv = csv.writer(self.text)
+        self.csv.writerow(CSV_FIELDS)
+        self.write(self.text.getvalue().encode('utf-8'))
+
+    def format(self, n: int) -> bytes:
+        self.text.seek(0)
+        self.text.truncate()
+        self.csv.writerow(self.store.row(n, CSV_FIELDS).values())
+        return self.text.getvalue().encode('utf-8')
+
+
+WRITERS = {
+    'log': LogWriter,
+    'rate': LogWriter,
+    'ip': IpWriter,
+    'json': JsonWriter,
+    'csv': CsvWriter,
+}
+
+
+def get_writer(output: str, out: BinaryIO, store: RecordStore) -> RecordWriter:
+    return WRITERS[output](out, store)
@@ -0,0 +1,192 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import count, repeat
+from typing import List, Tuple, Dict, Any, Iterator, Iterable, Callable
+import heapq
+import io
+import os
+import re
+
+from .expressions import ExpressionCollection
+from .files import is_compressed, open_log
+from .logfile import LogFile
+from .stats import stats
+
+# max size of byte range parsed by one task
+CHUNK_SIZE = 32 * 1024 * 1024
+# stats counters incremented while reading, worker returns them with its chunk
+ERROR_COUNTERS = ('parse_errors', 'rec_name_errors', 'rec_runtime_errors')
+
+
+def split_ranges(path: str, size: int, nchunks: int, start: int = 0) -> List[Tuple[int, int]]:
+    """ split bytes start..size of file into newline-aligned (start, end) byte ranges """
+    ranges = list()
+    step = max((size - start) // nchunks, 1)
+    with open(path, 'rb') as f:
+        while start < size:
+            end = start + step
+            if end >= size:
+                end = size
+            else:
+                f.seek(end)
+                f.readline()
+                end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def range_lines(path: str, start: int, end: int) -> Iterator[str]:
+    """ lines of byte range, decoded same way as text-mode open() in LogFile.read_all """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+
+
+class ChunkReader(LogFile):
+    """ parses one byte range in worker process.
+
+        onload, tagging and out are per-record and run here, rate counting needs records of all
+        ranges in log order, so matched counters are only remembered and replayed by parent.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rates: List[Tuple[int, str]] = list()
+        self.errors_start = {name: getattr(stats, name) for name in ERROR_COUNTERS}
+
+    def ratecount(self, ip, tag: str, ts: int, data: Any = None):
+        self.rates.append((data, tag))
+
+    def read_range(self, start: int, end: int):
+        self.read_lines(range_lines(self.path, start, end))
+
+    def read_file(self):
+        """ whole (maybe compressed) file, plain file from its ParseCache with --cache """
+        if self.cache and not is_compressed(self.path):
+            self._read_cached()
+            return
+        with open_log(self.path) as f:
+            self.read_lines(f)
+
+    def read_lines(self, lines: Iterable[str]):
+        for line in lines:
+            parsed = self.parse_line(line.strip())
+            if parsed:
+                self.add_record(*parsed)
+
+    def result(self) -> Dict[str, Any]:
+        # errors of this chunk are counted by parent (also when chunk is read in parent process)
+        errors = dict()
+        for name, start in self.errors_start.items():
+            errors[name] = getattr(stats, name) - start
+            setattr(stats, name, start)
+        return dict(store=self.store, out_match=self.out_match, tags=dict(self.tags), rates=self.rates,
+                    nrecords=self.nrecords, skipped_onload=self.skipped_onload, errors=errors)
+
+
+def read_chunk(path: str, log_regex: re.Pattern, fields: Iterable[str], ec: ExpressionCollection | None,
+               byte_range: Tuple[int, int], since: int | None = None, until: int | None = None,
+               partition: Tuple[int, int] | None = None, group: Callable[[str], str] | None = None) -> Dict[str, Any]:
+    reader = ChunkReader(path, log_regex, ec=ec, fields=fields, since=since, until=until, partition=partition,
+                         group=group)
+    reader.read_range(*byte_range)
+    return reader.result()
+
+
+def read_file(log_regex: re.Pattern, fields: Iterable[str], ec: ExpressionCollection | None, path: str,
+              since: int | None = None, until: int | None = None, partition: Tuple[int, int] | None = None,
+              group: Callable[[str], str] | None = None, cache: bool = False) -> Dict[str, Any]:
+    reader = ChunkReader(path, log_regex, ec=ec, fields=fields, since=since, until=until, partition=partition,
+                         group=group, cache=cache)
+    reader.read_file()
+    return reader.result()
+
+
+def read_parallel(logfile: LogFile, jobs: int):
+    """ LogFile.read_all() with log split into byte ranges parsed by pool of jobs processes """
+    logfile.reset()
+    with open(logfile.path, 'rb') as f:
+        logfile._inode = logfile._get_inode(f)
+    # whole log, or only part with --since/--until records
+    start, size = logfile.byte_range()
+
+    nchunks = max(jobs, -(-(size - start) // CHUNK_SIZE))
+    ranges = split_ranges(logfile.path, size, nchunks, start)
+    worker = partial(read_chunk, logfile.path, logfile.log_regex, logfile.parser.fields, logfile.ec,
+                     since=logfile.since, until=logfile.until, partition=logfile.partition, group=logfile.group)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # map() returns results in order of ranges, so merged records keep log order
+        for chunk in executor.map(worker, ranges):
+            merge_chunk(logfile, chunk)
+
+    logfile._offset = size
+
+
+def merge_chunk(logfile: LogFile, chunk: Dict[str, Any]):
+    store = logfile.store
+    base = len(store)
+    store.extend(chunk['store'])
+    logfile.out_match += chunk['out_match']
+    for ip, tags in chunk['tags'].items():
+        logfile.tags[ip].update(tags)
+    for row, counter in chunk['rates']:
+        n = base + row
+        logfile.ratecount(store.ip[n], counter, store.ts[n], data=n)
+    logfile.nrecords += chunk['nrecords']
+    logfile.skipped_onload += chunk['skipped_onload']
+    add_errors(chunk)
+
+
+def add_errors(chunk: Dict[str, Any]):
+    for name, n in chunk['errors'].items():
+        setattr(stats, name, getattr(stats, name) + n)
+
+
+def read_files(logfile: LogFile, paths: List[str], jobs: int = 1):
+    """ read several (maybe compressed) files, each in own process, and merge records by timestamp.
+        With logfile.cache plain files are read from their own ParseCache
+    """
+    logfile.reset()
+    # compressed files can not be seeked, records out of time range are only skipped
+    worker = partial(read_file, logfile.log_regex, logfile.parser.fields, logfile.ec,
+                     since=logfile.since, until=logfile.until, partition=logfile.partition, group=logfile.group,
+                     cache=logfile.cache)
+    if jobs <= 1:
+        jobs = min(len(paths), os.cpu_count() or 1)
+
+    if jobs > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunks = list(executor.map(worker, paths))
+    else:
+        chunks = [worker(path) for path in paths]
+
+    merge_sorted(logfile, chunks)
+
+
+def merge_sorted(logfile: LogFile, chunks: List[Dict[str, Any]]):
+    """ k-way merge of chunks by timestamp. Ties (and out-of-order lines inside chunk) keep chunk order """
+    store = logfile.store
+    remaps = [store.remap(chunk['store']) for chunk in chunks]
+    rates = list()
+    for chunk in chunks:
+        by_row = dict()
+        for row, counter in chunk['rates']:
+            by_row.setdefault(row, list()).append(counter)
+        rates.append(by_row)
+
+    streams = [zip(chunk['store'].ts, repeat(k), count()) for k, chunk in enumerate(chunks)]
+    for ts, k, row in heapq.merge(*streams):
+        chunk = chunks[k]
+        n = store.copy_row(chunk['store'], row, remaps[k])
+        logfile.out_match.append(chunk['out_match'][row])
+        for counter in rates[k].get(row, ()):
+            logfile.ratecount(store.ip[n], counter, ts, data=n)
+
+    for chunk in chunks:
+        for ip, tags in chunk['tags'].items():
+            logfile.tags[ip].update(tags)
+        logfile.nrecords += chunk['nrecords']
+        logfile.skipped_onload += chunk['skipped_onload']
+        add_errors(chunk)
@@ -0,0 +1,232 @@
+import re
+import time
+from datetime import datetime
+from typing import Dict, Any, Tuple, Iterable
+
+from .logrecord import DATETIME_FMT
+from .stats import stats
+from .utils import epoch
+
+# combined log format, same as def_regex in logq.toml
+COMBINED_REGEX = r'(?P<ip>\d+\.\d+\.\d+\.\d+) - - \[(?P<datetime>[^\]]+)\] "(?P<method>\w+) (?P<uri>[^ ]+) (?P<protocol>[^"]+)" (?P<status>\d+) (?P<size>\d+) "(?P<referrer>[^"]*)" "(?P<user_agent>[^"]*)"'
+
+FIELDS = ('ip', 'datetime', 'method', 'uri', 'protocol', 'status', 'size', 'referrer', 'user_agent', 'raw')
+
+MONTHS = {m: i for i, m in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+TIMESTAMP_REGEX = re.compile(r'(\d\d)/([A-Z][a-z][a-z])/(\d\d\d\d):(\d\d):(\d\d):(\d\d)(?:\s|$)')
+
+# always extracted: needed for sessions and summaries
+REQUIRED_FIELDS = {'ip', 'datetime', 'status'}
+
+# largest status and size which fit RecordStore columns, lines with bigger values are parse errors
+MAX_STATUS = 0xffffffff
+MAX_SIZE = 0x7fffffffffffffff
+
+
+class TimestampDecoder:
+    """ memoized log timestamp -> (epoch, formatted datetime) """
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.cache: Dict[str, Tuple[int, str]] = dict()
+
+    def decode(self, s: str) -> Tuple[int, str]:
+        try:
+            return self.cache[s]
+        except KeyError:
+            pass
+
+        if len(self.cache) >= self.maxsize:
+            self.cache.clear()
+        dt = self.strptime(s)
+        result = self.cache[s] = (epoch(dt), dt.strftime(DATETIME_FMT))
+        return result
+
+    def decode_bytes(self, b: bytes) -> Tuple[int, str]:
+        try:
+            return self.cache[b]
+        except KeyError:
+            pass
+        result = self.cache[b] = self.decode(b.decode('utf-8'))
+        return result
+
+
+    @staticmethod
+    def strptime(s: str) -> datetime:
+        m = TIMESTAMP_REGEX.match(s)
+        if m:
+            try:
+                day, month, year, hour, minute, second = m.groups()
+                return datetime(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second))
+            except (KeyError, ValueError):
+                pass
+        return datetime.strptime(s.split()[0], "%d/%b/%Y:%H:%M:%S")
+
+
+class RegexParser:
+    """ parse line with configurable regex, extract only needed fields """
+    def __init__(self, log_regex: re.Pattern, fields: Iterable[str] | None = None):
+        self.log_regex = log_regex
+        self.fields = set(FIELDS) if fields is None else set(fields) | REQUIRED_FIELDS
+        self.groups = [f for f in FIELDS if f in self.fields and f not in ('datetime', 'status', 'size', 'raw')]
+        self.timestamps = TimestampDecoder()
+
+    def parse(self, line: str) -> Tuple[int, Dict[str, Any]]:
+        """ return (epoch, fields), fields are same as LogRecord.as_dict() (only needed ones) """
+        m = self.log_regex.match(line)
+        if not m:
+            raise ValueError(f'Invalid log line: {line}')
+
+        ts, dtstr = self.timestamps.decode(m.group('datetime'))
+        record = {f: m.group(f) for f in self.groups}
+        record['datetime'] = dtstr
+        record['status'] = status = int(m.group('status'))
+        if status > MAX_STATUS:
+            raise ValueError(f'Invalid status: {status}')
+        if 'size' in self.fields:
+            record['size'] = size = int(m.group('size'))
+            if size > MAX_SIZE:
+                raise ValueError(f'Invalid size: {size}')
+        if 'raw' in self.fields:
+            record['raw'] = line
+        return ts, record
+
+    def parse_bytes(self, line: bytes) -> Tuple[int, Dict[str, Any]]:
+        """ parse line read from mmap (already stripped) """
+        return self.parse(line.decode('utf-8'))
+
+
+class CombinedParser(RegexParser):
+    """ split-based parser for combined log format, falls back to regex for unusual lines """
+
+    def parse(self, line: str) -> Tuple[int, Dict[str, Any]]:
+        # ip - - [datetime] "method uri protocol" status size "referrer" "user_agent"
+        parts = line.split('"', 6)
+        if len(parts) != 7 or parts[4] != ' ':
+            return super().parse(line)
+
+        head = parts[0]
+        p = head.find(' - - [')
+        ip = head[:p]
+        if p < 0 or not head.endswith('] ') or ip.count('.') != 3 or '..' in ip \
+                or not ip.replace('.', '').isdecimal() or ip[0] == '.' or ip[-1] == '.':
+            return super().parse(line)
+        dt = head[p + 6:-2]
+        if not dt or ']' in dt:
+            return super().parse(line)
+
+        request = parts[1].split(' ', 2)
+        if len(request) != 3 or not request[0].isalpha() or not request[1] or not request[2]:
+            return super().parse(line)
+
+        numbers = parts[2]
+        status_size = numbers[1:-1].split(' ')
+        if len(status_size) != 2 or numbers[0] != ' ' or numbers[-1] != ' ' \
+                or not status_size[0].isdecimal() or not status_size[1].isdecimal():
+            return super().parse(line)
+
+        if len(status_size[0]) > 9 or len(status_size[1]) > 18:
+            # maybe too big for RecordStore, regex path checks it
+            return super().parse(line)
+
+        fields = self.fields
+        ts, dtstr = self.timestamps.decode(dt)
+        record = {'ip': ip, 'datetime': dtstr, 'status': int(status_size[0])}
+        if 'method' in fields:
+            record['method'] = request[0]
+        if 'uri' in fields:
+            record['uri'] = request[1]
+        if 'protocol' in fields:
+            record['protocol'] = request[2]
+        if 'size' in fields:
+            record['size'] = int(status_size[1])
+        if 'referrer' in fields:
+            record['referrer'] = parts[3]
+        if 'user_agent' in fields:
+            record['user_agent'] = parts[5]
+        if 'raw' in fields:
+            record['raw'] = line
+        return ts, record
+
+
+    def parse_bytes(self, line: bytes) -> Tuple[int, Dict[str, Any]]:
+        """ same as parse() but on bytes, fields which are not needed are never decoded """
+        parts = line.split(b'"', 6)
+        if len(parts) != 7 or parts[4] != b' ':
+            return super().parse_bytes(line)
+
+        head = parts[0]
+        p = head.find(b' - - [')
+        ip = head[:p]
+        if p < 0 or not head.endswith(b'] ') or ip.count(b'.') != 3 or b'..' in ip \
+                or not ip.replace(b'.', b'').isdigit() or ip[:1] == b'.' or ip[-1:] == b'.':
+            return super().parse_bytes(line)
+        dt = head[p + 6:-2]
+        if not dt or b']' in dt:
+            return super().parse_bytes(line)
+
+        request = parts[1].split(b' ', 2)
+        if len(request) != 3 or not request[0].isalpha() or not request[1] or not request[2]:
+            return super().parse_bytes(line)
+
+        numbers = parts[2]
+        status_size = numbers[1:-1].split(b' ')
+        if len(status_size) != 2 or numbers[:1] != b' ' or numbers[-1:] != b' ' \
+                or not status_size[0].isdigit() or not status_size[1].isdigit():
+            return super().parse_bytes(line)
+
+        if len(status_size[0]) > 9 or len(status_size[1]) > 18:
+            return super().parse_bytes(line)
+
+        fields = self.fields
+        ts, dtstr = self.timestamps.decode_bytes(dt)
+        record = {'ip': ip.decode('ascii'), 'datetime': dtstr, 'status': int(status_size[0])}
+        if 'method' in fields:
+            record['method'] = request[0].decode('ascii')
+        if 'uri' in fields:
+            record['uri'] = request[1].decode('utf-8')
+        if 'protocol' in fields:
+            record['protocol'] = request[2].decode('utf-8')
+        if 'size' in fields:
+            record['size'] = int(status_size[1])
+        if 'referrer' in fields:
+            record['referrer'] = parts[3].decode('utf-8')
+        if 'user_agent' in fields:
+            record['user_agent'] = parts[5].decode('utf-8')
+        if 'raw' in fields:
+            record['raw'] = line.decode('utf-8')
+        return ts, record
+
+
+class ProfiledParser:
+    """ parser wrapper for --profile: time of parse() and parse_bytes() goes to 'parse' stage """
+    def __init__(self, parser: RegexParser):
+        self.parser = parser
+        self.fields = parser.fields
+        self.stats = stats.stage('parse')
+
+    def parse(self, line: str) -> Tuple[int, Dict[str, Any]]:
+        start = time.perf_counter()
+        try:
+            return self.parser.parse(line)
+        finally:
+            self.stats.time += time.perf_counter() - start
+            self.stats.records += 1
+
+    def parse_bytes(self, line: bytes) -> Tuple[int, Dict[str, Any]]:
+        start = time.perf_counter()
+        try:
+            return self.parser.parse_bytes(line)
+        finally:
+            self.stats.time += time.perf_counter() - start
+            self.stats.records += 1
+
+
+def get_parser(log_regex: re.Pattern, fields: Iterable[str] | None = None) -> RegexParser:
+    """ fast parser for combined log format, regex parser for anything else """
+    if log_regex.pattern == COMBINED_REGEX:
+        parser = CombinedParser(log_regex, fields)
+    else:
+        parser = RegexParser(log_regex, fields)
+    if stats.profile:
+        return ProfiledParser(parser)
+    return parser
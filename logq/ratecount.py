@@ -1,35 +1,90 @@
-from collections import deque
-from datetime import timedelta, datetime
-from typing import Any
-import copy
+from array import array
+from datetime import datetime
+from typing import Any, Iterable, List
+
+from .utils import from_epoch
 
 
 class RateCount:
-    def __init__(self, window_seconds: int):
-        self.window = timedelta(seconds=window_seconds)
-        self.events = deque()
-        self.dataq = deque()
-        self.top_dataq = None
-        self.max_count = 0
-        self.max_range = (None, None)  # (start, end)
-
-    def add(self, dt: datetime, data: Any = None):
-        self.events.append(dt)
-        self.dataq.append(data)
-
-        cutoff = dt - self.window
-        while self.events and self.events[0] <= cutoff:
-            self.events.popleft()
-            self.dataq.popleft()
-
-        if len(self.events) > self.max_count:
-            self.max_count = len(self.events)
-            self.max_range = (self.events[0], self.events[-1])
-            self.top_dataq = copy.copy(self.dataq)
-            # print("New max rate:", self.max_count , len(self.dataq), len(self.top_dataq), len(self.events), "from", self.max_range[0], "to", self.max_range[1])
-
-    def get_max(self) -> int:        
-        return self.max_count
-
-    def get_max_time(self) -> datetime:
-        return self.max_range[0]
+    """ max number of events within sliding window(s) of window_seconds.
+
+        Events are kept in one append-only sequence, each window only moves its left edge,
+        so add() is amortized O(1) per window. Peak is remembered as (start, end) positions,
+        data of main window peak is sliced out when top_dataq is requested or when events
+        before the window are dropped, so old peak does not keep the buffer growing.
+    """
+    def __init__(self, window_seconds: int | Iterable[int], keep_data: bool = True):
+        if isinstance(window_seconds, int):
+            window_seconds = [window_seconds]
+        # first window is the main one (rates_<counter> in summary, -o rate)
+        self.windows: List[int] = list(window_seconds)
+        self.keep_data = keep_data
+        self.times = array('q')
+        self.data = list()
+        # absolute position of times[0], events before it are dropped
+        self.base = 0
+        self.left = [0] * len(self.windows)
+        self.max_counts = [0] * len(self.windows)
+        # absolute (start, end) positions of peak window and its first/last timestamp
+        self.peaks = [(0, -1)] * len(self.windows)
+        self.max_ranges = [(None, None)] * len(self.windows)
+        # data of main window peak, copied when buffer is trimmed past its start (None: still in buffer)
+        self.peak_data: List[Any] | None = None
+
+    def add(self, ts: int, data: Any = None):
+        times = self.times
+        times.append(ts)
+        if self.keep_data:
+            self.data.append(data)
+        base = self.base
+        end = base + len(times) - 1
+
+        for i, window in enumerate(self.windows):
+            cutoff = ts - window
+            left = self.left[i]
+            while left <= end and times[left - base] <= cutoff:
+                left += 1
+            self.left[i] = left
+
+            count = end - left + 1
+            if count > self.max_counts[i]:
+                self.max_counts[i] = count
+                self.peaks[i] = (left, end)
+                self.max_ranges[i] = (times[left - base], ts)
+                if not i:
+                    self.peak_data = None
+
+        self._trim()
+
+    def _trim(self):
+        """ drop events no window needs, when they are half of the buffer """
+        keep = min(self.left)
+        dead = keep - self.base
+        if dead > 64 and dead * 2 > len(self.times):
+            if self.keep_data:
+                if self.peak_data is None and self.peaks[0][0] < keep:
+                    self.peak_data = self.top_dataq
+                del self.data[:dead]
+            del self.times[:dead]
+            self.base = keep
+
+    @property
+    def window(self) -> int:
+        return self.windows[0]
+
+    @property
+    def top_dataq(self) -> List[Any]:
+        """ data of events in peak of main window """
+        if not self.keep_data:
+            return list()
+        if self.peak_data is not None:
+            return self.peak_data
+        start, end = self.peaks[0]
+        return self.data[start - self.base:end - self.base + 1]
+
+    def get_max(self, n: int = 0) -> int:
+        return self.max_counts[n]
+
+    def get_max_time(self, n: int = 0) -> datetime | None:
+        start = self.max_ranges[n][0]
+        return None if start is None else from_epoch(start)
@@ -0,0 +1,224 @@
+from array import array
+from typing import Dict, Any, Iterator, Iterable, List, Tuple
+import sys
+
+from .logrecord import LogRecord
+from .utils import format_epoch
+
+
+class Column:
+    """ Dictionary-encoded column: each distinct value is stored once, rows keep integer codes """
+    def __init__(self):
+        self.values = list()
+        self.index = dict()
+        self.codes = array('I')
+
+    def encode(self, value) -> int:
+        code = self.index.get(value)
+        if code is None:
+            code = len(self.values)
+            self.index[value] = code
+            self.values.append(value)
+        return code
+
+    def append(self, value):
+        self.codes.append(self.encode(value))
+
+    def extend(self, other: "Column"):
+        """ append rows of other column, re-encoding its codes """
+        remap = [self.encode(v) for v in other.values]
+        self.codes.extend(remap[c] for c in other.codes)
+
+    def clear(self):
+        self.values.clear()
+        self.index.clear()
+        del self.codes[:]
+
+    def __getitem__(self, n: int):
+        return self.values[self.codes[n]]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.codes) + sys.getsizeof(self.values) + sys.getsizeof(self.index) \
+            + sum(sys.getsizeof(v) for v in self.values)
+
+
+class MappedLines:
+    """ raw lines as (offset, length) references into mmap-ed log, decoded only when accessed.
+        Lines added later (e.g. by read_new) are kept as str.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.offsets = array('q')
+        self.lengths = array('I')
+        self.extra = list()
+
+    def append(self, value: Tuple[int, int] | str):
+        if isinstance(value, tuple):
+            offset, length = value
+        else:
+            self.extra.append(value)
+            offset, length = -len(self.extra), 0
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def extend(self, values: Iterable[str]):
+        for v in values:
+            self.append(v)
+
+    def clear(self):
+        del self.offsets[:]
+        del self.lengths[:]
+        self.extra.clear()
+
+    def __getitem__(self, n: int) -> str:
+        offset = self.offsets[n]
+        if offset < 0:
+            return self.extra[-offset - 1]
+        return self.buf[offset:offset + self.lengths[n]].decode('utf-8', errors='replace').strip()
+
+    def line_bytes(self, n: int) -> bytes:
+        """ same as self[n].encode(), without decoding when possible """
+        offset = self.offsets[n]
+        if offset >= 0:
+            line = self.buf[offset:offset + self.lengths[n]].strip()
+            # bytes.strip() and str.strip() agree on ascii edges
+            if line and 0x20 <= line[0] < 0x80 and 0x20 <= line[-1] < 0x80:
+                return line
+        return self[n].encode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.offsets) + sys.getsizeof(self.lengths) + sys.getsizeof(self.extra) \
+            + sum(sys.getsizeof(r) for r in self.extra)
+
+
+class RecordStore:
+    """ Compact columnar storage for parsed log records """
+
+    encoded = ('ip', 'method', 'uri', 'protocol', 'referrer', 'user_agent')
+
+    def __init__(self):
+        self.ip = Column()
+        self.method = Column()
+        self.uri = Column()
+        self.protocol = Column()
+        self.referrer = Column()
+        self.user_agent = Column()
+        self.ts = array('q')
+        self.status = array('I')
+        self.size = array('q')
+        self.raw = list()
+        # epoch -> formatted datetime, shared by all rows with same timestamp
+        self.datetimes: Dict[int, str] = dict()
+        # ip -> row numbers
+        self.ip_rows: Dict[str, array] = dict()
+
+    def append(self, ts: int, fields: Dict[str, Any], raw: Tuple[int, int] | None = None) -> int:
+        """ raw: (offset, length) of line if raw column is MappedLines """
+        n = len(self.ts)
+        # fields which parser did not extract are stored as None (or 0 for size)
+        get = fields.get
+        self.ip.append(fields['ip'])
+        self.method.append(get('method'))
+        self.uri.append(get('uri'))
+        self.protocol.append(get('protocol'))
+        self.referrer.append(get('referrer'))
+        self.user_agent.append(get('user_agent'))
+        self.ts.append(ts)
+        self.status.append(fields['status'])
+        self.size.append(fields.get('size', 0))
+        self.raw.append(fields.get('raw') if raw is None else raw)
+
+        rows = self.ip_rows.get(fields['ip'])
+        if rows is None:
+            rows = self.ip_rows[fields['ip']] = array('I')
+        rows.append(n)
+        return n
+
+    def extend(self, other: "RecordStore"):
+        """ append all rows of other store """
+        base = len(self.ts)
+        for name in self.encoded:
+            getattr(self, name).extend(getattr(other, name))
+        self.ts.extend(other.ts)
+        self.status.extend(other.status)
+        self.size.extend(other.size)
+        self.raw.extend(other.raw)
+        self.datetimes.update(other.datetimes)
+        for ip, rows in other.ip_rows.items():
+            mine = self.ip_rows.get(ip)
+            if mine is None:
+                mine = self.ip_rows[ip] = array('I')
+            mine.extend(base + n for n in rows)
+
+    def remap(self, other: "RecordStore") -> Dict[str, List[int]]:
+        """ codes of other store's column values in this store, for copy_row() """
+        return {name: [getattr(self, name).encode(v) for v in getattr(other, name).values] for name in self.encoded}
+
+    def copy_row(self, other: "RecordStore", n: int, remap: Dict[str, List[int]]) -> int:
+        """ append row n of other store """
+        m = len(self.ts)
+        for name in self.encoded:
+            getattr(self, name).codes.append(remap[name][getattr(other, name).codes[n]])
+        self.ts.append(other.ts[n])
+        self.status.append(other.status[n])
+        self.size.append(other.size[n])
+        self.raw.append(other.raw[n])
+
+        ip = other.ip[n]
+        rows = self.ip_rows.get(ip)
+        if rows is None:
+            rows = self.ip_rows[ip] = array('I')
+        rows.append(m)
+        return m
+
+    def clear(self):
+        for name in self.encoded:
+            getattr(self, name).clear()
+        del self.ts[:]
+        del self.status[:]
+        del self.size[:]
+        self.raw.clear()
+        self.datetimes.clear()
+        self.ip_rows.clear()
+
+    def __len__(self):
+        return len(self.ts)
+
+    def datetime_str(self, n: int) -> str:
+        ts = self.ts[n]
+        try:
+            return self.datetimes[ts]
+        except KeyError:
+            s = self.datetimes[ts] = format_epoch(ts)
+            return s
+
+    def row(self, n: int, fields: Iterable[str]) -> Dict[str, Any]:
+        """ given fields of row n, same values as LogRecord.as_dict() """
+        return {f: self.datetime_str(n) if f == 'datetime' else getattr(self, f)[n] for f in fields}
+
+    def record(self, n: int):
+        return LogRecord(self, n)
+
+    def records(self, rows=None) -> Iterator[LogRecord]:
+        if rows is None:
+            rows = range(len(self.ts))
+        for n in rows:
+            yield LogRecord(self, n)
+
+    def nbytes(self) -> int:
+        """ approximate memory used by store """
+        size = sum(getattr(self, name).nbytes() for name in self.encoded)
+        size += sys.getsizeof(self.ts) + sys.getsizeof(self.status) + sys.getsizeof(self.size)
+        if isinstance(self.raw, MappedLines):
+            size += self.raw.nbytes()
+        else:
+            size += sys.getsizeof(self.raw) + sum(sys.getsizeof(r) for r in self.raw)
+        size += sys.getsizeof(self.datetimes) + sum(sys.getsizeof(d) for d in self.datetimes.values())
+        size += sys.getsizeof(self.ip_rows) + sum(sys.getsizeof(a) for a in self.ip_rows.values())
+        return size
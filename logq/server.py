@@ -0,0 +1,315 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import io
+import json
+import re
+import socketserver
+import sys
+import time
+
+from . import __version__
+from .cli import get_queries, sort_sessions
+from .config import settings, load_config
+from .expressions import ExpressionCollection
+from .files import is_compressed, remove_socket
+from .logfile import LogFile
+from .netset import load_networks
+from .output import get_writer, selected_rows
+from .stats import stats
+
+DEFAULT_LISTEN = "127.0.0.1:8765"
+# cached query results, cache is cleared when full or when log gets new records
+CACHE_SIZE = 256
+
+# query parameters: name -> True if it can be repeated
+PARAMS = {'q': True, 'session': True, 'out': True, 'sum': False, 'sort': False, 'num': False, 'output': False}
+OUTPUTS = ('json', 'log', 'ip', 'rate', 'csv')
+CONTENT_TYPES = {'json': 'application/x-ndjson', 'csv': 'text/csv', 'log': 'text/plain', 'ip': 'text/plain', 'rate': 'text/plain'}
+
+
+class QueryError(Exception):
+    """ invalid query, reported to client as 400 """
+
+
+class QueryService:
+    """ LogFile kept in memory and refreshed with read_new(), answers session/out queries over it.
+
+        Results are cached per query until log gets new records (generation changes).
+    """
+    def __init__(self, logfile: LogFile, ec: ExpressionCollection):
+        self.logfile = logfile
+        self.ec = ec
+        self.generation = 0
+        self.cache: Dict[tuple, Tuple[bytes, str]] = dict()
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = time.monotonic()
+
+    def refresh(self) -> int:
+        """ read lines appended to log, returns number of lines """
+        nlines = self.logfile.read_new()
+        self.refreshed = time.monotonic()
+        if nlines:
+            self.generation += 1
+            self.cache.clear()
+        return nlines
+
+    def query(self, params: Dict[str, List[str]]) -> Tuple[bytes, str, bool]:
+        """ (body, content type, cached) for query parameters """
+        for name, values in params.items():
+            if name not in PARAMS:
+                raise QueryError(f"Unknown parameter {name!r}, use: {', '.join(PARAMS)}")
+            if len(values) > 1 and not PARAMS[name]:
+                raise QueryError(f"Parameter {name!r} can be given only once")
+
+        self.refresh()
+        key = tuple(sorted((name, tuple(values)) for name, values in params.items()))
+        try:
+            result = self.cache[key]
+            self.hits += 1
+            return result + (True,)
+        except KeyError:
+            self.misses += 1
+
+        result = self.run(params)
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+        self.cache[key] = result
+        return result + (False,)
+
+    def query_ec(self, params: Dict[str, List[str]]) -> ExpressionCollection:
+        """ session and out expressions of query (named queries of config or ad-hoc) """
+        qec = ExpressionCollection()
+        qec.set_vars(self.ec.variables)
+        try:
+            for name in params.get('q', ()):
+                try:
+                    qconf = settings.query[name]
+                except KeyError:
+                    raise QueryError(f"Query {name!r} not found in config")
+                if qconf.get('stage') not in ('session', 'out'):
+                    raise QueryError(f"Query {name!r} is {qconf.get('stage')} query, only session and out queries "
+                                     "can be used per request (others are given when server starts)")
+                qec.add(qconf['query'], qconf['stage'], None, name=name)
+            for where in ('session', 'out'):
+                for expr in params.get(where, ()):
+                    qec.add(expr, where, None)
+            try:
+                load_networks(qec, settings.networks)
+            except (OSError, ValueError) as e:
+                raise QueryError(f"Can not load network set: {e}")
+            qec.compile()
+        except (ValueError, SyntaxError) as e:
+            raise QueryError(f"Error in expression: {e}")
+        return qec
+
+    def run(self, params: Dict[str, List[str]]) -> Tuple[bytes, str]:
+        qec = self.query_ec(params)
+        summary = params.get('sum', ['0'])[0].lower() not in ('0', 'false', 'no', '')
+        output = params.get('output', ['log'])[0]
+        if output not in OUTPUTS:
+            raise QueryError(f"Invalid output {output!r}, use: {', '.join(OUTPUTS)}")
+        num = None
+        if 'num' in params:
+            try:
+                num = int(params['num'][0])
+            except ValueError:
+                raise QueryError(f"Invalid num {params['num'][0]!r}")
+
+        logfile = self.logfile
+        ec = self.ec
+        iplist = list()
+        for ip, s in logfile.summaries().items():
+            if (not ec.session or ec.apply_all("session", s)) and (not qec.session or qec.apply_all("session", s)):
+                iplist.append(ip)
+
+        if summary:
+            sessions = (logfile.summary(ip) for ip in iplist)
+            sort_order = params.get('sort', [ec.sort_field])[0]
+            data = sort_sessions(sessions, sort_order=sort_order, output=output, num=num)
+            return json.dumps(data, indent=4).encode('utf-8') + b'\n', 'application/json'
+
+        out = io.BytesIO()
+        store = logfile.store
+        writer = get_writer(output, out, store)
+        if output == "rate":
+            for ip in iplist:
+                for cnt in logfile.ratecounters(ip):
+                    writer.write_rows(logfile.ratecounts[ip][cnt].top_dataq)
+        else:
+            rows = selected_rows(store, logfile.out_match, iplist)
+            if qec.out:
+                fields = logfile.parser.fields
+                rows = (n for n in rows if qec.apply_all("out", store.row(n, fields)))
+            writer.write_rows(rows)
+        writer.flush()
+        return out.getvalue(), CONTENT_TYPES[output]
+
+    def status(self) -> Dict[str, Any]:
+        logfile = self.logfile
+        return dict(version=__version__, log=logfile.path, records=logfile.nrecords, sessions=len(logfile.ip_records),
+                    offset=logfile._offset, generation=self.generation, cache_entries=len(self.cache),
+                    cache_hits=self.hits, cache_misses=self.misses)
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """ GET /query?q=NAME&session=EXPR&out=EXPR&sum=1&sort=FIELD&num=N&output=FORMAT,
+        POST /query with same parameters as json object, GET /status
+    """
+    server_version = f"logq/{__version__}"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/status':
+            self.reply(200, json.dumps(self.server.service.status(), indent=4).encode('utf-8') + b'\n', 'application/json')
+        elif url.path == '/query':
+            self.answer(parse_qs(url.query, keep_blank_values=True))
+        else:
+            self.error(404, f"Not found: {url.path}, use /query or /status")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/query':
+            self.error(404, f"Not found: {url.path}, use /query")
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError("body must be json object")
+        except ValueError as e:
+            self.error(400, f"Invalid request body: {e}")
+            return
+        params = {name: [str(v) for v in value] if isinstance(value, list) else [str(value)] for name, value in body.items()}
+        self.answer(params)
+
+    def answer(self, params: Dict[str, List[str]]):
+        start = time.perf_counter()
+        try:
+            body, content_type, cached = self.server.service.query(params)
+        except QueryError as e:
+            self.error(400, str(e))
+            return
+        self.reply(200, body, content_type, {
+            'X-Logq-Cache': 'hit' if cached else 'miss',
+            'X-Logq-Generation': str(self.server.service.generation),
+            'X-Logq-Time': f"{time.perf_counter() - start:.6f}",
+        })
+
+    def error(self, code: int, message: str):
+        self.reply(code, json.dumps({'error': message}).encode('utf-8') + b'\n', 'application/json')
+
+    def reply(self, code: int, body: bytes, content_type: str, headers: Dict[str, str] | None = None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format: str, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class TCPQueryServer(HTTPServer):
+    allow_reuse_address = True
+
+
+class UnixQueryServer(socketserver.UnixStreamServer):
+    def server_bind(self):
+        remove_socket(self.server_address)
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        try:
+            remove_socket(self.server_address)
+        except OSError:
+            pass
+
+
+def make_server(service: QueryService, listen: str | None = None, unix_socket: str | None = None,
+                verbose: bool = False) -> socketserver.BaseServer:
+    if unix_socket:
+        server = UnixQueryServer(unix_socket, QueryHandler)
+    else:
+        host, _, port = (listen or DEFAULT_LISTEN).rpartition(':')
+        server = TCPQueryServer((host or '127.0.0.1', int(port)), QueryHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def serve(server: socketserver.BaseServer, interval: float = 1.0):
+    """ answer requests one by one (no locking of LogFile needed), read new lines when idle for interval """
+    service = server.service
+    server.timeout = interval
+    while True:
+        server.handle_request()
+        if time.monotonic() - service.refreshed >= interval:
+            service.refresh()
+
+
+def get_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='logq serve', description='Keep log in memory and answer queries over HTTP '
+                                     '(localhost or unix socket)')
+    parser.add_argument('-l', '--log', metavar='PATH', required=True, help='Path of (plain) log file')
+    parser.add_argument("-c", "--config", help="Path to logq.toml")
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Parse log in N processes at start')
+    parser.add_argument('--cache', action='store_true', default=False, help='Load parsed log from ~/.cache/logq at start')
+    parser.add_argument('--listen', metavar='HOST:PORT', default=DEFAULT_LISTEN, help='HTTP address (default: %(default)s)')
+    parser.add_argument('--socket', metavar='PATH', default=None, help='Serve HTTP on unix socket PATH instead of --listen')
+    parser.add_argument('--interval', default=1.0, type=float, metavar='SECONDS', help='Read new lines when idle for SECONDS')
+    parser.add_argument('--period', '-p', default=[60], type=int, nargs='+', help='period(s) for counters in seconds')
+    parser.add_argument('--verbose', '-v', action='store_true', default=False)
+
+    g = parser.add_argument_group('Queries applied to all records (onload, tagging, rate) and default session/out filters')
+    g.add_argument('-q', dest='query', default=None, metavar='NAME', nargs='*', type=str, help='Named queries from config')
+    g.add_argument('-r', '--run', type=str, help='Run named script from config')
+    g.add_argument('--onload', nargs='+', type=str, help='Add onload query expression filter(s)')
+    g.add_argument('--session', nargs='+', type=str, help='Add session query expression filter(s)')
+    g.add_argument('--out', nargs='+', type=str, help='Add out query expression filter(s)')
+    g.add_argument('--reorder', action='store_true', default=False, help='Reorder filter expressions by observed selectivity')
+    g.add_argument('--set', nargs='+', dest='setvars', type=str, help='SET context variable(s), e.g. --set var=value')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]):
+    args = get_args(argv)
+    load_config(args.config)
+    if is_compressed(args.log):
+        print("logq serve needs plain log file", file=sys.stderr)
+        sys.exit(1)
+
+    ec = get_queries(args)
+    log_pattern = re.compile(settings.getlogconf(args.log)['regex'])
+    # all fields: any session or out expression can be asked. No mmap: log may be truncated while serving
+    logfile = LogFile(args.log, log_pattern, ec=ec, period=args.period, cache=args.cache,
+                      complete_lines=True)
+    start = time.perf_counter()
+    logfile.read_all(jobs=args.jobs)
+    service = QueryService(logfile, ec)
+
+    try:
+        server = make_server(service, listen=args.listen, unix_socket=args.socket, verbose=args.verbose)
+    except (OSError, ValueError) as e:
+        print(f"Can not listen on {args.socket or args.listen}: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.verbose:
+        print(f"# Loaded {logfile.nrecords} records from {args.log} in {time.perf_counter() - start:.2f}s, "
+              f"serving on {args.socket or args.listen}", file=sys.stderr)
+    try:
+        serve(server, interval=args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.verbose:
+            print(f"# Parse errors: {stats.parse_errors}", file=sys.stderr)
@@ -0,0 +1,282 @@
+from array import array
+from collections import defaultdict
+from itertools import accumulate, compress, count, repeat
+from typing import Any, Dict, List, Tuple
+import argparse
+import heapq
+import json
+import mmap
+import socket
+import sys
+import time
+
+from .cache import read_sections, write_sections, store_sections, read_store
+from .config import load_config
+from .logfile import LogFile, make_summary
+from .output import open_output, get_writer
+from .parser import FIELDS
+from .ratecount import RateCount
+from .recordstore import RecordStore
+from .summary import interval_avg
+
+MAGIC = b'LOGQSHARD\n'
+# bump when layout changes, shards of other version are refused
+SHARD_VERSION = 2
+
+
+class ShardLogFile(LogFile):
+    """ LogFile which also remembers every rate event (row, counter) for export_shard(),
+        RateCount keeps only events of its windows
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_events: List[Tuple[int, str]] = list()
+
+    def ratecount(self, ip, tag: str, ts: int, data: Any = None):
+        super().ratecount(ip, tag, ts, data=data)
+        self.rate_events.append((data, tag))
+
+    def reset(self):
+        super().reset()
+        self.rate_events.clear()
+
+
+def export_shard(logfile: ShardLogFile, path: str, records: bool = True, meta: Dict[str, Any] | None = None):
+    """ write per-ip partial state of logfile: timestamps of hits, status counters, bytes, uris, tags and
+        timestamps of rate events. With records, also records which passed out stage (all fields needed).
+
+        Each ip state keeps (timestamp, row) of first hit of each status and of rate events, so merge
+        can order them same as reading all logs together.
+    """
+    if not {'size', 'uri'} <= logfile.parser.fields:
+        raise ValueError("Export needs size and uri fields (bytes and uris of summary)")
+    store = logfile.store
+    ts = store.ts
+    ips = list(store.ip_rows)
+    ec = logfile.ec
+    counters = list(dict.fromkeys(e.param for e in ec.iter("rate"))) if ec is not None else list()
+    tag_values = sorted({tag for ip in ips for tag in logfile.tags.get(ip, ())})
+    tag_index = {tag: code for code, tag in enumerate(tag_values)}
+
+    events: Dict[str, Dict[str, array]] = defaultdict(lambda: defaultdict(lambda: array('I')))
+    for row, counter in logfile.rate_events:
+        events[store.ip[row]][counter].append(row)
+
+    hits, times, nbytes = array('I'), array('q'), array('q')
+    status_n, status_code, status_count, status_ts, status_row = array('I'), array('I'), array('I'), array('q'), array('I')
+    uri_n, uris = array('I'), array('I')
+    tag_n, tags = array('I'), array('I')
+    rate_n, rate_ts, rate_row = array('I'), array('q'), array('I')
+    uri_codes = store.uri.codes
+    for ip in ips:
+        rows = store.ip_rows[ip]
+        hits.append(len(rows))
+        times.extend(ts[n] for n in rows)
+        nbytes.append(sum(store.size[n] for n in rows))
+
+        status: Dict[int, List[int]] = dict()
+        for n in rows:
+            s = status.get(store.status[n])
+            if s is None:
+                status[store.status[n]] = [1, n]
+            else:
+                s[0] += 1
+        status_n.append(len(status))
+        for code, (cnt, first) in status.items():
+            status_code.append(code)
+            status_count.append(cnt)
+            status_ts.append(ts[first])
+            status_row.append(first)
+
+        distinct = set(uri_codes[n] for n in rows)
+        uri_n.append(len(distinct))
+        uris.extend(sorted(distinct))
+
+        ip_tags = logfile.tags.get(ip, ())
+        tag_n.append(len(ip_tags))
+        tags.extend(sorted(tag_index[tag] for tag in ip_tags))
+
+        ip_events = events.get(ip, {})
+        for counter in counters:
+            rows = ip_events.get(counter, ())
+            rate_n.append(len(rows))
+            rate_ts.extend(ts[n] for n in rows)
+            rate_row.extend(rows)
+
+    sections = [
+        ('ips', 'S', ips), ('hits', 'I', hits), ('times', 'q', times), ('bytes', 'q', nbytes),
+        ('status_n', 'I', status_n), ('status_code', 'I', status_code), ('status_count', 'I', status_count),
+        ('status_ts', 'q', status_ts), ('status_row', 'I', status_row),
+        ('uri_values', 'S', store.uri.values), ('uri_n', 'I', uri_n), ('uris', 'I', uris),
+        ('tag_values', 'S', tag_values), ('tag_n', 'I', tag_n), ('tags', 'I', tags),
+        ('rate_n', 'I', rate_n), ('rate_ts', 'q', rate_ts), ('rate_row', 'I', rate_row),
+    ]
+
+    if records:
+        out = RecordStore()
+        remap = out.remap(store)
+        for n in compress(range(len(store)), logfile.out_match):
+            out.copy_row(store, n, remap)
+        record_sections = store_sections(out, 'records.')
+        if record_sections is None:
+            raise ValueError("Records can be exported only with all fields extracted")
+        sections.extend(record_sections)
+
+    queries = {where: [e.expr for e in ec.iter(where)] for where in ("onload", "tagging", "rate", "out")} if ec else {}
+    header = dict(version=SHARD_VERSION, created=time.time(), host=socket.gethostname(), log=logfile.path,
+                  counters=counters, records=records, queries=queries, **(meta or {}))
+    write_sections(path, MAGIC, header, sections)
+
+
+class Shard:
+    """ per-ip partial state (and records) loaded from file written by export_shard() """
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            sections = read_sections(mm, MAGIC)
+            if sections is None:
+                raise ValueError(f"{path} is not logq shard (written by logq --export)")
+            self.header = sections.header
+            if self.header.get('version') != SHARD_VERSION:
+                raise ValueError(f"{path} was written by other version of logq")
+            for name in ('ips', 'uri_values', 'tag_values'):
+                setattr(self, name, sections.strings(name))
+            for name in ('hits', 'times', 'bytes', 'status_n', 'status_code', 'status_count', 'status_ts',
+                         'status_row', 'uri_n', 'uris', 'tag_n', 'tags', 'rate_n', 'rate_ts', 'rate_row'):
+                setattr(self, name, sections.numbers(name))
+            self.records = read_store(sections, 'records.') if self.header['records'] else None
+        self.counters: List[str] = self.header['counters']
+        # start of each ip (and ip/counter) in per-ip sections
+        self.times_start = list(accumulate(self.hits, initial=0))
+        self.status_start = list(accumulate(self.status_n, initial=0))
+        self.uri_start = list(accumulate(self.uri_n, initial=0))
+        self.tag_start = list(accumulate(self.tag_n, initial=0))
+        self.rate_start = list(accumulate(self.rate_n, initial=0))
+
+    def slice(self, name: str, i: int) -> range:
+        start = getattr(self, f'{name}_start')
+        return range(start[i], start[i + 1])
+
+
+def merge_summaries(shards: List[Shard], period: int | List[int] = 60) -> Dict[str, dict]:
+    """ session summaries of all ips from partial states, same as summaries of all logs read together """
+    where: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+    for k, shard in enumerate(shards):
+        for i, ip in enumerate(shard.ips):
+            where[ip].append((k, i))
+
+    summaries = dict()
+    for ip in sorted(where):
+        parts = [(k, shards[k], i) for k, i in where[ip]]
+        times = sorted(shard.times[j] for _, shard, i in parts for j in shard.slice('times', i))
+        hits = len(times)
+
+        # status counters in order of first hit with this status (timestamp, shard, row)
+        status_first: Dict[int, tuple] = dict()
+        status_count: Dict[int, int] = defaultdict(int)
+        for k, shard, i in parts:
+            for j in shard.slice('status', i):
+                code = shard.status_code[j]
+                status_count[code] += shard.status_count[j]
+                key = (shard.status_ts[j], k, shard.status_row[j])
+                if code not in status_first or key < status_first[code]:
+                    status_first[code] = key
+        status = {code: status_count[code] for code in sorted(status_first, key=status_first.get)}
+
+        uris = {shard.uri_values[shard.uris[j]] for _, shard, i in parts for j in shard.slice('uri', i)}
+        tags = {shard.tag_values[shard.tags[j]] for _, shard, i in parts for j in shard.slice('tag', i)}
+
+        # rate events replayed in order of all logs read together, counters in order of their first event
+        streams: Dict[str, list] = defaultdict(list)
+        for k, shard, i in parts:
+            for c, counter in enumerate(shard.counters):
+                rows = shard.slice('rate', i * len(shard.counters) + c)
+                if rows:
+                    streams[counter].append([(shard.rate_ts[j], k, shard.rate_row[j], c) for j in rows])
+        ratecounts = dict()
+        for counter, events in sorted(streams.items(), key=lambda item: min(min(e) for e in item[1])):
+            rc = ratecounts[counter] = RateCount(period, keep_data=False)
+            for event in heapq.merge(*events):
+                rc.add(event[0])
+
+        extra = dict(bytes=sum(shard.bytes[i] for _, shard, i in parts), uris=len(uris),
+                     interval_min=min((b - a for a, b in zip(times, times[1:])), default=0),
+                     interval_avg=interval_avg(hits, times[0], times[-1]))
+        summaries[ip] = make_summary(ip, hits, times[0], times[-1], status, tags, ratecounts, extra)
+    return summaries
+
+
+def merge_records(shards: List[Shard], ips: set) -> RecordStore:
+    """ exported records of given ips from all shards, merged by timestamp """
+    store = RecordStore()
+    stores = [shard.records for shard in shards]
+    remaps = [store.remap(s) for s in stores]
+    streams = [zip(s.ts, repeat(k), count()) for k, s in enumerate(stores)]
+    for _, k, row in heapq.merge(*streams):
+        if stores[k].ip[row] in ips:
+            store.copy_row(stores[k], row, remaps[k])
+    return store
+
+
+def get_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='logq merge', description='Merge per-ip state exported with logq --export '
+                                     '(from several hosts or partitions), run session and out stages on it')
+    parser.add_argument('shards', metavar='SHARD', nargs='+', help='Files written by logq --export')
+    parser.add_argument("-c", "--config", help="Path to logq.toml")
+    parser.add_argument('--verbose', '-v', action='store_true', default=False)
+    parser.add_argument('--output', '-o', choices=["json", "log", "ip", "csv"], default="log")
+    parser.add_argument('--output-file', metavar='PATH', default=None, help='Write output to file instead of stdout')
+    parser.add_argument('--sort', '-s', default=None, help='Sort sessions by field(s), e.g. "hits-"')
+    parser.add_argument('--num', '-n', default=None, type=int, help='Num results to show (for [sorted] sessions)')
+    parser.add_argument('--period', '-p', default=[60], type=int, nargs='+', help='period(s) for counters in seconds')
+    parser.add_argument('--sum', '--summary', action='store_true', default=False, help='print only session summary')
+    parser.add_argument('-q', dest='query', default=None, metavar='NAME', nargs='*', type=str, help='Named session and out queries from config')
+    parser.add_argument('--session', nargs='+', type=str, help='Add session query expression filter(s)')
+    parser.add_argument('--out', nargs='+', type=str, help='Add out query expression filter(s)')
+    parser.add_argument('--set', nargs='+', dest='setvars', type=str, help='SET context variable(s), e.g. --set var=value')
+    parser.set_defaults(onload=None, run=None, reorder=False)
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]):
+    from .cli import get_queries, sort_sessions
+
+    args = get_args(argv)
+    load_config(args.config)
+    ec = get_queries(args)
+    if ec.onload or ec.tag or ec.rate:
+        print("onload, tagging and rate queries are applied by logq --export, logq merge runs only session and out",
+              file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        shards = [Shard(path) for path in args.shards]
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if len({json.dumps(shard.header['queries'], sort_keys=True) for shard in shards}) > 1:
+        print("Warning: shards were exported with different queries", file=sys.stderr)
+    if not args.sum and any(shard.records is None for shard in shards):
+        print("Some shards have no records (exported with --sum), use --sum", file=sys.stderr)
+        sys.exit(1)
+
+    summaries = merge_summaries(shards, period=args.period)
+    iplist = [ip for ip, s in summaries.items() if not ec.session or ec.apply_all("session", s)]
+    if args.verbose:
+        print(f"# {len(shards)} shards, {len(summaries)} sessions, {len(iplist)} matched", file=sys.stderr)
+
+    out = open_output(args.output_file)
+    if args.sum:
+        data = sort_sessions((summaries[ip] for ip in iplist), sort_order=ec.sort_field or args.sort,
+                             output=args.output, num=args.num)
+        out.write(json.dumps(data, indent=4).encode('utf-8') + b'\n')
+    else:
+        store = merge_records(shards, set(iplist))
+        rows = range(len(store))
+        if ec.out:
+            rows = (n for n in rows if ec.apply_all("out", store.row(n, FIELDS)))
+        writer = get_writer(args.output, out, store)
+        writer.write_rows(rows)
+        writer.flush()
+    if args.output_file:
+        out.close()
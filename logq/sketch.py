@@ -0,0 +1,303 @@
+from array import array
+import heapq
+import math
+from typing import Dict, Any, Iterable, List, Hashable
+
+from .expressions import ExpressionCollection
+from .files import open_log
+from .follow import Session
+from .logfile import LogFile, make_summary
+from .ratecount import RateCount
+from .recordstore import RecordStore
+from .summary import interval_avg
+
+MASK32 = 0xffffffff
+MASK64 = 0xffffffffffffffff
+
+# defaults of --approx-* options
+TOP = 10000
+WIDTH = 1 << 18
+DEPTH = 4
+RECORDS = 10
+# HyperLogLog precision: distinct ips of log (16 KB, 0.8% error) and uris of one session (256 bytes, 6.5%)
+IPS_PRECISION = 14
+URIS_PRECISION = 8
+
+
+class CountMinSketch:
+    """ approximate counters of any number of keys in depth x width table of fixed size.
+
+        Estimate is never below true count and, with probability 1 - exp(-depth), above it
+        by at most e / width * total. Counters are updated conservatively (only those which are
+        at the minimum grow), which keeps error of small keys lower than the bound.
+        Keys are hashed with hash(), so sketch is valid only inside one process.
+    """
+    def __init__(self, width: int = WIDTH, depth: int = DEPTH):
+        self.width = width
+        self.depth = depth
+        self.steps = range(depth)
+        self.rows = [array('I', bytes(4 * width)) for _ in range(depth)]
+        self.total = 0
+
+    def _cells(self, key: Hashable) -> List[int]:
+        # double hashing: depth indexes from one 64-bit hash
+        h = hash(key)
+        h1, h2 = h & MASK32, (h >> 32 & MASK32) | 1
+        width = self.width
+        return [(h1 + i * h2) % width for i in self.steps]
+
+    def add(self, key: Hashable, n: int = 1) -> int:
+        """ count key n times, returns new estimate """
+        cells = self._cells(key)
+        rows = self.rows
+        counts = list(map(array.__getitem__, rows, cells))
+        estimate = min(counts) + n
+        for row, j, count in zip(rows, cells, counts):
+            if count < estimate:
+                row[j] = estimate
+        self.total += n
+        return estimate
+
+    def estimate(self, key: Hashable) -> int:
+        return min(map(array.__getitem__, self.rows, self._cells(key)))
+
+    def error(self) -> float:
+        """ max overestimate (with probability 1 - exp(-depth)) """
+        return math.e / self.width * self.total
+
+    def nbytes(self) -> int:
+        return sum(row.itemsize * len(row) for row in self.rows)
+
+
+class HyperLogLog:
+    """ approximate number of distinct values in 2**precision bytes, standard error 1.04 / sqrt(2**precision) """
+    def __init__(self, precision: int = IPS_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value: Hashable):
+        h = hash(value) & MASK64
+        p = self.precision
+        rest = h & (MASK64 >> p)
+        # position of first 1 bit in 64 - p bits after register index
+        rank = 64 - p - rest.bit_length() + 1
+        n = h >> (64 - p)
+        if rank > self.registers[n]:
+            self.registers[n] = rank
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # small cardinality: linear counting
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def error(self) -> float:
+        """ relative standard error """
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def nbytes(self) -> int:
+        return len(self.registers)
+
+
+class HeavyHitters:
+    """ up to capacity keys with highest counts, each with its value.
+
+        Counts are estimates given by caller (CountMinSketch.add()). New key gets in if table
+        is not full or its count is above the lowest one, which is then dropped. Heap has one
+        entry per key, entries of grown keys are stale (too low) and refreshed when they get to the top.
+    """
+    def __init__(self, capacity: int = TOP):
+        self.capacity = capacity
+        self.values: Dict[Hashable, Any] = dict()
+        self.counts: Dict[Hashable, int] = dict()
+        self.heap: List[list] = list()
+        self.evicted = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key: Hashable):
+        return self.values.get(key)
+
+    def update(self, key: Hashable, count: int):
+        """ new count of tracked key """
+        self.counts[key] = count
+
+    def min_count(self) -> int:
+        heap, counts = self.heap, self.counts
+        while True:
+            count, key = heap[0]
+            if counts[key] == count:
+                return count
+            heapq.heapreplace(heap, [counts[key], key])
+
+    def offer(self, key: Hashable, count: int, value: Any) -> bool:
+        """ track key with value if its count is high enough, returns True if tracked """
+        if len(self.values) >= self.capacity:
+            if not self.capacity or count <= self.min_count():
+                return False
+            _, lowest = heapq.heapreplace(self.heap, [count, key])
+            del self.values[lowest], self.counts[lowest]
+            self.evicted += 1
+        else:
+            heapq.heappush(self.heap, [count, key])
+        self.values[key] = value
+        self.counts[key] = count
+        return True
+
+    def clear(self):
+        self.values.clear()
+        self.counts.clear()
+        self.heap.clear()
+        self.evicted = 0
+
+
+class ApproxSession(Session):
+    """ exact state of tracked ip since it got into HeavyHitters, uris are counted in HyperLogLog """
+    __slots__ = ('records',)
+
+    def __init__(self, ip: str, ts: int):
+        super().__init__(ip, ts)
+        self.uris = HyperLogLog(URIS_PRECISION)
+        # (ts, record) which passed out stage, first RECORDS of them
+        self.records = list()
+
+
+class ApproxLogFile(LogFile):
+    """ LogFile in fixed memory for logs with huge number of ips (--approx).
+
+        Hits and per-status hits of every ip are counted in CountMinSketch, number of distinct
+        ips in HyperLogLog. Only top ips by hits (HeavyHitters) have session: tags, exact rate
+        counters, bytes, uris (HyperLogLog), and first records which passed out stage. Session of
+        ip starts when ip gets into top, so its first/last, tags, rates, bytes and records cover
+        only hits since then (for real heavy hitters it is almost all of them). Tagging, rate and
+        out expressions are evaluated only for tracked ips.
+    """
+    def __init__(self, path, log_pattern, ec: ExpressionCollection | None = None, period: int | List[int] = 60,
+                 fields: Iterable[str] | None = None, top: int = TOP, width: int = WIDTH, depth: int = DEPTH,
+                 records: int = RECORDS, **kwargs):
+        # text read: mmap-ed log would add whole file to resident memory
+        kwargs.update(cache=False, use_mmap=False, columnar=False)
+        super().__init__(path, log_pattern, ec=ec, period=period, fields=fields, **kwargs)
+        self.top = top
+        self.width = width
+        self.depth = depth
+        self.max_records = records
+        self.hits = CountMinSketch(width, depth)
+        self.status_hits = CountMinSketch(width, depth)
+        self.distinct_ips = HyperLogLog(IPS_PRECISION)
+        self.sessions = HeavyHitters(top)
+
+    def reset(self):
+        super().reset()
+        self.hits = CountMinSketch(self.width, self.depth)
+        self.status_hits = CountMinSketch(self.width, self.depth)
+        self.distinct_ips = HyperLogLog(IPS_PRECISION)
+        self.sessions.clear()
+
+    def add_record(self, ts: int, record: Dict[str, Any], raw=None) -> None:
+        if self.group is not None:
+            record['ip'] = self.group(record['ip'])
+        if (self.time_range is not None or self.partition is not None) and not self.selected(ts, record):
+            return None
+        ec = self.ec
+        if ec is not None and not ec.apply_all("onload", record):
+            self.skipped_onload += 1
+            return None
+        self.nrecords += 1
+
+        ip = record['ip']
+        status = record['status']
+        hits = self.hits.add(ip)
+        self.status_hits.add((ip, status))
+        self.distinct_ips.add(ip)
+
+        sessions = self.sessions
+        session = sessions.get(ip)
+        if session is None:
+            session = ApproxSession(ip, ts)
+            if not sessions.offer(ip, hits, session):
+                return None
+        else:
+            sessions.update(ip, hits)
+        session.add_record(ts, record)
+
+        if ec is None:
+            self.keep_record(session, ts, record)
+            return None
+
+        for tag in ec.matches("tagging", record):
+            session.tags.add(tag)
+
+        for counter in ec.matches("rate", record):
+            rc = session.ratecounts.get(counter)
+            if rc is None:
+                rc = session.ratecounts[counter] = RateCount(self.period, keep_data=False)
+            rc.add(ts)
+
+        if ec.apply_all("out", record):
+            self.keep_record(session, ts, record)
+        return None
+
+    def keep_record(self, session: ApproxSession, ts: int, record: Dict[str, Any]):
+        if len(session.records) < self.max_records:
+            session.records.append((ts, record))
+
+    def read_all(self, jobs: int = 1):
+        # worker processes would keep all records
+        super().read_all(jobs=1)
+
+    def read_files(self, paths: List[str], jobs: int = 1):
+        """ files one after another (given order), not merged by time """
+        self.reset()
+        for path in paths:
+            with open_log(path) as f:
+                for line in f:
+                    parsed = self.parse_line(line.strip())
+                    if parsed:
+                        self.add_record(*parsed)
+
+    def ips(self):
+        return sorted(self.sessions.values)
+
+    def summary(self, ip: str) -> dict:
+        """ summary of tracked ip: hits and status counts are sketch estimates, other fields cover tracked part """
+        session = self.sessions.get(ip)
+        hits = self.hits.estimate(ip)
+        status = {code: self.status_hits.estimate((ip, code)) for code in session.status}
+        extra = dict()
+        if 'size' in self.parser.fields:
+            extra['bytes'] = session.bytes
+        if 'uri' in self.parser.fields:
+            extra['uris'] = session.uris.count()
+        extra['interval_min'] = session.interval_min or 0
+        extra['interval_avg'] = interval_avg(session.hits, session.first, session.last)
+        return make_summary(ip, hits, session.first, session.last, status, session.tags, session.ratecounts, extra)
+
+    def summaries(self) -> Dict[str, dict]:
+        return {ip: self.summary(ip) for ip in self.ips()}
+
+    def ratecounters(self, ip: str) -> List[str]:
+        return list(self.sessions.get(ip).ratecounts.keys())
+
+    def kept_records(self, ips: Iterable[str]) -> RecordStore:
+        """ kept records of sessions in time order """
+        records = list()
+        for ip in ips:
+            records.extend(self.sessions.get(ip).records)
+        records.sort(key=lambda r: r[0])
+        store = RecordStore()
+        for ts, record in records:
+            store.append(ts, record)
+        return store
+
+    def nbytes(self) -> int:
+        """ memory of sketches (sessions are not included) """
+        return self.hits.nbytes() + self.status_hits.nbytes() + self.distinct_ips.nbytes()
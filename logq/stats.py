@@ -1,11 +1,130 @@
-from dataclasses import dataclass
+from contextlib import contextmanager
+from typing import Dict, Any
+import time
+
+try:
+    import resource
+except ImportError:     # not on windows
+    resource = None
+
+# order of pipeline stages in report
+STAGES = ('read', 'parse', 'onload', 'tagging', 'rate', 'summary', 'session', 'out', 'output')
+
+
+# plain classes, not dataclasses: importing dataclasses (and inspect) takes longer than short runs of logq
+
+class StageStats:
+    __slots__ = ('records', 'time')
+
+    def __init__(self):
+        self.records = 0
+        self.time = 0.0
+
+
+class QueryStats:
+    __slots__ = ('stage', 'expr', 'calls', 'hits', 'time')
+
+    def __init__(self, stage: str, expr: str):
+        self.stage = stage
+        self.expr = expr
+        self.calls = 0
+        self.hits = 0
+        self.time = 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
 
-@dataclass
 class Stats:
-    sum_runtime_errors: int = 0
-    sum_name_errors: int = 0
-    sum_matches: int = 0
-    rec_runtime_errors: int = 0
-    rec_matches: int = 0
+    def __init__(self):
+        self.sum_runtime_errors = 0
+        self.sum_name_errors = 0
+        self.sum_matches = 0
+        self.rec_runtime_errors = 0
+        self.rec_name_errors = 0
+        self.rec_matches = 0
+        self.parse_errors = 0
+        # per stage and per query timings, collected only with profile (--profile)
+        self.profile = False
+        self.stages: Dict[str, StageStats] = dict()
+        self.queries: Dict[str, QueryStats] = dict()
+
+    def stage(self, name: str) -> StageStats:
+        try:
+            return self.stages[name]
+        except KeyError:
+            s = self.stages[name] = StageStats()
+            return s
+
+    def query(self, name: str, stage: str, expr: str) -> QueryStats:
+        try:
+            return self.queries[name]
+        except KeyError:
+            q = self.queries[name] = QueryStats(stage, expr)
+            return q
+
+    def error(self, where: str, name_error: bool):
+        if where == "session":
+            if name_error:
+                self.sum_name_errors += 1
+            else:
+                self.sum_runtime_errors += 1
+        elif name_error:
+            self.rec_name_errors += 1
+        else:
+            self.rec_runtime_errors += 1
+
+    @contextmanager
+    def timer(self, stage: str, records: int = 0):
+        """ add wall time of block to stage (only if profiling) """
+        if not self.profile:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            s = self.stage(stage)
+            s.time += time.perf_counter() - start
+            s.records += records
+
+    @staticmethod
+    def peak_rss() -> int | None:
+        """ peak resident memory of process in bytes """
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def report(self) -> Dict[str, Any]:
+        stages = dict()
+        for name in sorted(self.stages, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+            s = self.stages[name]
+            stages[name] = dict(records=s.records, time=round(s.time, 6),
+                                records_per_sec=round(s.records / s.time) if s.time else None)
+        counters = {k: v for k, v in vars(self).items() if isinstance(v, int) and not isinstance(v, bool)}
+        queries = {name: q.as_dict() for name, q in sorted(self.queries.items(), key=lambda q: -q[1].time)}
+        for q in queries.values():
+            q['time'] = round(q['time'], 6)
+        return dict(stages=stages, queries=queries, counters=counters, peak_rss=self.peak_rss())
+
+    def table(self) -> str:
+        report = self.report()
+        lines = [f"{'stage':<10} {'records':>10} {'time':>10} {'rec/s':>10}"]
+        for name, s in report['stages'].items():
+            rate = s['records_per_sec'] if s['records_per_sec'] is not None else '-'
+            lines.append(f"{name:<10} {s['records']:>10} {s['time']:>9.3f}s {rate:>10}")
+        if report['queries']:
+            lines.append('')
+            lines.append(f"{'query':<20} {'stage':<8} {'calls':>10} {'hits':>10} {'time':>10}")
+            for name, q in report['queries'].items():
+                lines.append(f"{name[:20]:<20} {q['stage']:<8} {q['calls']:>10} {q['hits']:>10} {q['time']:>9.3f}s")
+        lines.append('')
+        for name, value in report['counters'].items():
+            if value:
+                lines.append(f"{name}: {value}")
+        if report['peak_rss'] is not None:
+            lines.append(f"peak RSS: {report['peak_rss'] // (1024 * 1024)} MB")
+        return '\n'.join(lines)
+
 
-stats = Stats()
\ No newline at end of file
+stats = Stats()
@@ -0,0 +1,107 @@
+from array import array
+from typing import Dict, Any, List, Iterable
+import sys
+
+from .recordstore import RecordStore
+
+# smaller stores are summarized per ip in python: importing numpy takes longer (unless it is already imported)
+BATCH_MIN_ROWS = 50000
+
+
+def extra_aggregates(store: RecordStore, rows: Iterable[int], fields: Iterable[str]) -> Dict[str, Any]:
+    """ bytes, uris, interval_min, interval_avg for rows of one ip (fallback without numpy) """
+    extra = dict()
+    if 'size' in fields:
+        extra['bytes'] = sum(store.size[n] for n in rows)
+    if 'uri' in fields:
+        extra['uris'] = len({store.uri.codes[n] for n in rows})
+    times = sorted(store.ts[n] for n in rows)
+    extra['interval_min'] = min((b - a for a, b in zip(times, times[1:])), default=0)
+    extra['interval_avg'] = interval_avg(len(times), times[0], times[-1])
+    return extra
+
+
+def interval_avg(hits: int, first: int, last: int) -> float:
+    """ mean seconds between requests """
+    return round((last - first) / (hits - 1), 2) if hits > 1 else 0
+
+
+def batch_aggregates(store: RecordStore, fields: Iterable[str], ips: List[str] | None = None) -> Dict[str, tuple] | None:
+    """ per-ip aggregates for all ips (or only given ones) at once with numpy grouped reductions.
+
+        Returns ip -> (hits, first, last, status, extra) like arguments of make_summary(),
+        status dict keeps order of first appearance (same as per-ip summary). None if numpy is not installed
+        or rows are too few to be worth importing it.
+    """
+    nrows = len(store) if ips is None else sum(len(store.ip_rows[ip]) for ip in ips)
+    if not nrows or (nrows < BATCH_MIN_ROWS and 'numpy' not in sys.modules):
+        return None
+    try:
+        import numpy as np
+    except ImportError:     # optional, pip install logq[fast]
+        return None
+
+    # rows of given ips in store order
+    rows = None
+    if ips is not None:
+        ip_rows = [store.ip_rows[ip] for ip in ips]
+        rows = np.sort(np.concatenate([np.frombuffer(r, dtype=r.typecode) for r in ip_rows]))
+
+    def column(values: array):
+        values = np.frombuffer(values, dtype=values.typecode)
+        return values if rows is None else values[rows]
+
+    ipc = column(store.ip.codes)
+    ts = column(store.ts)
+    status = column(store.status)
+    nips = len(store.ip.values)
+
+    hits = np.bincount(ipc, minlength=nips)
+    # rows grouped by ip, sorted by time inside group
+    order = np.lexsort((ts, ipc))
+    ts_sorted = ts[order]
+    ends = np.cumsum(hits)
+    starts = ends - hits
+    present = hits > 0
+    first = np.zeros(nips, dtype=np.int64)
+    last = np.zeros(nips, dtype=np.int64)
+    first[present] = ts_sorted[starts[present]]
+    last[present] = ts_sorted[ends[present] - 1]
+
+    # intervals between consecutive requests of same ip, first row of each group gets no interval
+    gaps = np.diff(ts_sorted, prepend=ts_sorted[:1])
+    big = np.iinfo(np.int64).max
+    gaps[starts[present]] = big
+    interval_min = np.zeros(nips, dtype=np.int64)
+    interval_min[present] = np.minimum.reduceat(gaps, starts[present])
+    interval_min[interval_min == big] = 0
+
+    extra: Dict[str, Any] = dict()
+    if 'size' in fields:
+        size = column(store.size)
+        extra['bytes'] = np.bincount(ipc, weights=size, minlength=nips).astype(np.int64)
+    if 'uri' in fields:
+        uric = column(store.uri.codes).astype(np.int64)
+        pairs = np.unique(ipc.astype(np.int64) * (len(store.uri.values) + 1) + uric)
+        extra['uris'] = np.bincount(pairs // (len(store.uri.values) + 1), minlength=nips)
+
+    # status counts: unique (ip, status) pairs, ordered by first row where pair appears
+    keys = ipc.astype(np.int64) << 32 | status
+    pair_keys, pair_first, pair_counts = np.unique(keys, return_index=True, return_counts=True)
+    pair_order = np.lexsort((pair_first, pair_keys >> 32))
+    statuses: List[Dict[int, int]] = [dict() for _ in range(nips)]
+    for key, cnt in zip(pair_keys[pair_order].tolist(), pair_counts[pair_order].tolist()):
+        statuses[key >> 32][key & 0xffffffff] = cnt
+
+    columns = {name: values.tolist() for name, values in extra.items()}
+    columns['interval_min'] = interval_min.tolist()
+    hits, first, last = hits.tolist(), first.tolist(), last.tolist()
+
+    result = dict()
+    for code, ip in enumerate(store.ip.values):
+        if not hits[code]:
+            continue
+        extra = {name: values[code] for name, values in columns.items()}
+        extra['interval_avg'] = interval_avg(hits[code], first[code], last[code])
+        result[ip] = (hits[code], first[code], last[code], statuses[code], extra)
+    return result
@@ -0,0 +1,188 @@
+from datetime import datetime, timedelta
+from typing import BinaryIO, List, Tuple
+import json
+import os
+import re
+
+from .cache import cache_dir, tail_crc
+from .parser import TimestampDecoder, get_parser
+from .utils import epoch
+
+# lines this many seconds out of time order near edges of range are still read
+TOLERANCE = 300
+# binary search stops when interval is smaller, rest is read and filtered by timestamp
+MIN_GAP = 64 * 1024
+# lines read at probe offset to find one with timestamp
+PROBE_LINES = 16
+# sparse index: one entry per INDEX_STEP bytes
+INDEX_STEP = 1024 * 1024
+INDEX_VERSION = 1
+
+RELATIVE_REGEX = re.compile(r'-?(\d+)([smhdw])$')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+TIME_FORMATS = ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse_time(s: str, now: datetime | None = None) -> int:
+    """ --since/--until value to epoch: log format (01/Sep/2025:16:00:00), ISO (2025-09-01 16:00)
+        or time before now (30m, 1h, 2d). Like log timestamps, timezone is not used.
+    """
+    s = s.strip()
+    m = RELATIVE_REGEX.match(s)
+    if m:
+        now = now or datetime.now()
+        return epoch(now - timedelta(seconds=int(m.group(1)) * UNITS[m.group(2)]))
+    for fmt in TIME_FORMATS:
+        try:
+            return epoch(datetime.strptime(s, fmt))
+        except ValueError:
+            pass
+    try:
+        return epoch(TimestampDecoder.strptime(s))
+    except ValueError:
+        raise ValueError(f"Invalid time {s!r}, use e.g. 01/Sep/2025:16:00:00, 2025-09-01 16:00 or 1h")
+
+
+class TimeSeeker:
+    """ byte offsets of time range in (nearly) time ordered log, found by binary search over file offsets.
+
+        Probe at offset skips partial line and takes timestamp of first line which parses.
+        Edges are searched with TOLERANCE, so lines slightly out of order are not lost; exact
+        filtering by timestamp is done when records are read.
+    """
+    def __init__(self, path: str, log_regex: re.Pattern, use_index: bool = False):
+        self.path = path
+        self.parser = get_parser(log_regex, ())
+        self.index = OffsetIndex(path, self) if use_index else None
+
+    def probe(self, f: BinaryIO, offset: int) -> Tuple[int, int] | None:
+        """ (line offset, timestamp) of first parsed line starting at or after offset """
+        f.seek(offset)
+        if offset:
+            f.readline()
+        for _ in range(PROBE_LINES):
+            pos = f.tell()
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                # EOF or incomplete line being written
+                return None
+            try:
+                return pos, self.parser.parse(line.decode('utf-8').strip())[0]
+            except Exception:
+                continue
+        return None
+
+    def find(self, f: BinaryIO, size: int, ts: int, late: bool) -> int:
+        """ offset of line where log reaches ts. Search stops MIN_GAP before it: late=True returns
+            offset after it (for end of range), late=False before it (for start of range)
+        """
+        lo, hi = 0, size
+        if self.index is not None:
+            lo, hi = self.index.bounds(ts, size)
+        # line start at or after hi (hi is either size, index entry or probed offset)
+        hi_line = hi
+
+        while hi - lo > MIN_GAP:
+            mid = (lo + hi) // 2
+            p = self.probe(f, mid)
+            if p is None:
+                # no timestamp here, move bound which keeps more lines
+                if late:
+                    lo = mid
+                else:
+                    hi = hi_line = mid
+            elif p[1] < ts:
+                lo = mid
+            else:
+                hi, hi_line = mid, p[0]
+
+        if late:
+            if hi_line == hi and 0 < hi < size:
+                # resync to line start
+                f.seek(hi - 1)
+                f.readline()
+                return f.tell()
+            return hi_line
+        if lo == 0:
+            return 0
+        # line containing lo is before ts, start from next line
+        f.seek(lo)
+        f.readline()
+        return f.tell()
+
+    def byte_range(self, since: int | None, until: int | None) -> Tuple[int, int]:
+        """ (start, end) offsets covering lines of [since, until) """
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if self.index is not None:
+                self.index.update(f, size)
+            start = 0 if since is None else self.find(f, size, since - TOLERANCE, late=False)
+            end = size if until is None else self.find(f, size, until + TOLERANCE, late=True)
+        return start, max(start, end)
+
+
+class OffsetIndex:
+    """ persisted sparse index of (offset, timestamp) for log, one entry per INDEX_STEP bytes.
+        Kept in cache directory, extended when log grows, rebuilt if it was rotated or truncated.
+    """
+    def __init__(self, path: str, seeker: TimeSeeker, directory: str | None = None):
+        self.path = os.path.abspath(path)
+        self.seeker = seeker
+        import hashlib
+        name = hashlib.sha1(self.path.encode()).hexdigest()
+        self.index_path = os.path.join(directory or cache_dir(), f"{name}.tindex")
+        self.entries: List[Tuple[int, int]] = list()
+        self.covered = 0
+
+    def load(self, inode: int, size: int):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+            if data['version'] == INDEX_VERSION and data['path'] == self.path and data['inode'] == inode \
+                    and data['covered'] <= size and data['tail_crc'] == tail_crc(self.path, data['covered']):
+                self.entries = [tuple(e) for e in data['entries']]
+                self.covered = data['covered']
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.entries = list()
+        self.covered = 0
+
+    def update(self, f: BinaryIO, size: int):
+        """ load index and add entries for part of log after covered offset """
+        inode = os.fstat(f.fileno()).st_ino
+        self.load(inode, size)
+        if size - self.covered < INDEX_STEP:
+            return
+        offset = self.covered
+        while offset + INDEX_STEP <= size:
+            p = self.seeker.probe(f, offset)
+            if p is not None:
+                self.entries.append(p)
+            offset += INDEX_STEP
+        self.covered = offset
+        self.save(inode)
+
+    def save(self, inode: int):
+        data = dict(version=INDEX_VERSION, path=self.path, inode=inode, covered=self.covered,
+                    tail_crc=tail_crc(self.path, self.covered), entries=self.entries)
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.index_path)
+        except OSError:
+            # index is only an optimization
+            pass
+
+    def bounds(self, ts: int, size: int) -> Tuple[int, int]:
+        """ (lo, hi) offsets around place where log reaches ts """
+        lo, hi = 0, size
+        for offset, entry_ts in self.entries:
+            if entry_ts < ts:
+                lo = offset
+            else:
+                hi = offset
+                break
+        return lo, max(lo, hi)
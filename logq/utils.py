@@ -1,3 +1,6 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+
 def dhms(seconds: int) -> str:
     parts = []
     days, seconds = divmod(seconds, 86400)
@@ -12,3 +15,17 @@ def dhms(seconds: int) -> str:
     if seconds or not parts:
         parts.append(f"{seconds}s")
     return "".join(parts)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+def epoch(dt: datetime) -> int:
+    """ naive datetime (timezone is dropped when parsing log) to integer seconds """
+    return int((dt - EPOCH).total_seconds())
+
+def from_epoch(ts: int) -> datetime:
+    return EPOCH + timedelta(seconds=ts)
+
+@lru_cache(maxsize=4096)
+def format_epoch(ts: int, fmt: str = "%d/%b/%Y %H:%M:%S") -> str:
+    return from_epoch(ts).strftime(fmt)
@@ -25,4 +25,8 @@ setup(
         "rich",
         "toml"
     ],
+    extras_require={
+        # vectorized session summaries
+        "fast": ["numpy"],
+    },
 )
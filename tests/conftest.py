@@ -0,0 +1,54 @@
+import re
+
+import pytest
+
+from logq.parser import COMBINED_REGEX
+from logq.stats import stats
+
+LINE = '{ip} - - [01/Sep/2025:16:{minute:02d}:{second:02d}] "{method} {uri} HTTP/1.1" {status} {size} "-" "{agent}"\n'
+
+# stats counters changed by reading and evaluating, reset for each test
+COUNTERS = ('parse_errors', 'rec_name_errors', 'rec_runtime_errors', 'sum_name_errors', 'sum_runtime_errors')
+
+
+def log_line(n: int = 0, ip: str | None = None, status: int = 200, size: int = 10, method: str = 'GET',
+             uri: str = '/a', agent: str = 'curl') -> str:
+    """ combined log line, n-th second after 16:00 """
+    return LINE.format(ip=f'192.0.2.{n % 256}' if ip is None else ip, minute=n // 60 % 60, second=n % 60,
+                       method=method, uri=uri, status=status, size=size, agent=agent)
+
+
+@pytest.fixture
+def line():
+    return log_line
+
+
+@pytest.fixture
+def write_log(tmp_path):
+    """ write lines (or (status, size) rows of log_line) to access.log in tmp_path, returns its path """
+    def write(lines, name: str = 'access.log') -> str:
+        path = tmp_path / name
+        path.write_text(''.join(log_line(n, status=row[0], size=row[1]) if isinstance(row, tuple) else row
+                                for n, row in enumerate(lines)))
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def log_regex():
+    return re.compile(COMBINED_REGEX)
+
+
+@pytest.fixture(autouse=True)
+def counters(monkeypatch):
+    """ zeroed stats counters, restored after test """
+    for name in COUNTERS:
+        monkeypatch.setattr(stats, name, 0)
+    return stats
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """ ParseCache, time index and query cache of test go to tmp_path """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
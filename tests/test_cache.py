@@ -0,0 +1,100 @@
+import gzip
+import os
+import re
+
+import pytest
+
+from logq.cache import ParseCache
+from logq.logfile import LogFile
+from logq.parser import FIELDS
+
+
+def read(path, log_regex, **kwargs):
+    logfile = LogFile(path, log_regex, cache=True, **kwargs)
+    logfile.read_all()
+    return logfile
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_resume_after_append(write_log, log_regex, line, use_mmap):
+    lines = [line(n, status=200 + n % 3) for n in range(120)]
+    path = write_log(lines[:100])
+    assert read(path, log_regex, use_mmap=use_mmap).nrecords == 100
+    with open(path, 'a') as f:
+        f.write(''.join(lines[100:]))
+    logfile = read(path, log_regex, use_mmap=use_mmap)
+    fresh = LogFile(path, log_regex)
+    fresh.read_all()
+    assert logfile.nrecords == 120
+    assert list(logfile.store.status) == list(fresh.store.status)
+    assert logfile._offset == os.path.getsize(path)
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_line_being_written_is_not_cached(write_log, log_regex, line, counters, monkeypatch, use_mmap, jobs):
+    lines = [line(n) for n in range(110)]
+    path = write_log(lines[:100] + [lines[100][:60]])
+    logfile = LogFile(path, log_regex, cache=True, use_mmap=use_mmap)
+    logfile.read_all(jobs=jobs)
+    # this run sees half line, as without cache
+    assert logfile.nrecords == 100
+    assert counters.parse_errors == 1
+    store, offset, _ = ParseCache(path, log_regex).load()
+    assert len(store) == 100
+    assert offset == len(''.join(lines[:100]))
+
+    with open(path, 'w') as f:
+        f.write(''.join(lines))
+    monkeypatch.setattr(counters, 'parse_errors', 0)
+    assert read(path, log_regex, use_mmap=use_mmap).nrecords == 110
+    assert counters.parse_errors == 0
+
+
+def test_last_line_without_newline(write_log, log_regex, line):
+    path = write_log([line(n) for n in range(10)] + [line(10).rstrip('\n')])
+    for _ in range(2):
+        assert read(path, log_regex).nrecords == 11
+
+
+def test_changed_log_is_parsed_again(write_log, log_regex, line):
+    path = write_log([line(n) for n in range(100)])
+    read(path, log_regex)
+    assert ParseCache(path, log_regex).load() is not None
+    # other regex, cache of this one is not used
+    assert ParseCache(path, re.compile(log_regex.pattern + ' ?')).load() is None
+
+    # same inode, bigger size, but bytes before cached offset changed
+    write_log([line(n, status=404) for n in range(120)])
+    assert list(set(read(path, log_regex).store.status)) == [404]
+    # log shrank
+    write_log([line(n) for n in range(50)])
+    logfile = read(path, log_regex)
+    assert logfile.nrecords == 50
+    assert list(set(logfile.store.status)) == [200]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_several_files(write_log, log_regex, line, tmp_path, jobs):
+    old = tmp_path / 'access.log.2.gz'
+    with gzip.open(old, 'wt') as f:
+        f.write(''.join(line(n) for n in range(0, 30)))
+    paths = [str(old), write_log([line(n, status=404) for n in range(30, 60)], name='access.log.1'),
+             write_log([line(n, uri='/b') for n in range(60, 90)])]
+
+    def records():
+        logfile = LogFile(paths[-1], log_regex, cache=True)
+        logfile.read_files(paths, jobs=jobs)
+        return [logfile.store.row(n, FIELDS) for n in range(len(logfile.store))]
+
+    fresh = LogFile(paths[-1], log_regex)
+    fresh.read_files(paths)
+    expected = [fresh.store.row(n, FIELDS) for n in range(len(fresh.store))]
+    assert records() == expected
+    assert [ParseCache(path, log_regex).load() is not None for path in paths] == [False, True, True]
+    assert records() == expected
+
+    with open(paths[-1], 'a') as f:
+        f.write(line(90))
+    assert len(records()) == 91
+    assert len(ParseCache(paths[-1], log_regex).load()[0]) == 31
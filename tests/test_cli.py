@@ -0,0 +1,38 @@
+import random
+
+import pytest
+
+from logq.cli import sort_sessions
+
+
+def reference_sort(data, sort_order):
+    """ stable sort by each key, last key first """
+    data = list(data)
+    for field in reversed(sort_order.split(',')):
+        name = field.strip().rstrip('-')
+        data.sort(key=lambda s: s.get(name, 0), reverse=field.strip().endswith('-'))
+    return data
+
+
+@pytest.fixture
+def sessions():
+    rnd = random.Random(16)
+    data = list()
+    for n in range(500):
+        summary = dict(ip=f'192.0.2.{n % 256}', hits=rnd.randint(1, 20), uris=rnd.randint(1, 5),
+                       first=f'01/Sep/2025 16:{rnd.randint(0, 5):02d}:00')
+        if rnd.random() < 0.3:
+            # only sessions with such hits have counter
+            summary['status404'] = rnd.randint(1, 3)
+        data.append(summary)
+    return data
+
+
+@pytest.mark.parametrize("sort_order", ["hits", "hits-", "status404-,hits", "first-,uris", "uris, first, hits-",
+                                        "first-,ip-", "missing-"])
+@pytest.mark.parametrize("num", [None, 0, 1, 10, 499, 1000])
+def test_top_same_as_sort(sessions, sort_order, num):
+    expected = reference_sort(sessions, sort_order)
+    if num is not None:
+        expected = expected[:num]
+    assert sort_sessions(iter(sessions), sort_order, 'json', num=num) == expected
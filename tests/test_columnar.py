@@ -0,0 +1,23 @@
+import pytest
+
+from logq.expressions import ExpressionCollection
+from logq.logfile import LogFile
+
+pytest.importorskip('numpy')
+
+
+def read(path, log_regex, expr, columnar):
+    ec = ExpressionCollection()
+    ec.add(expr, "out", None)
+    ec.compile()
+    logfile = LogFile(path, log_regex, ec=ec, columnar=columnar)
+    logfile.read_all()
+    return [n for n in range(len(logfile.store)) if logfile.out_match[n]]
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_fallback_error_is_no_match(write_log, log_regex, counters, columnar):
+    path = write_log([(200, 10), (404, 500), (200, 0), (500, 30)])
+    # ZeroDivisionError for status 200, not translatable to numpy
+    assert read(path, log_regex, "size / (status - 200) > 1", columnar) == [1]
+    assert counters.rec_runtime_errors == 2
@@ -0,0 +1,62 @@
+import pytest
+
+from logq import expressions
+from logq.expressions import Expression, ExpressionCollection
+from logq.logfile import LogFile
+from logq.stats import stats
+
+# more than INDEX_MIN_RULES: indexed rules and generic tuple
+INDEXED = [(f"uri == '/u{n}'", f"u{n}") for n in range(8)]
+
+
+def tagging_ec(rules):
+    ec = ExpressionCollection()
+    for expr, tag in rules:
+        ec.add(expr, "tagging", tag)
+    ec.add("status > 'x'", "rate", "bad")
+    ec.add("status == 404", "rate", "notfound")
+    ec.compile()
+    return ec
+
+
+@pytest.mark.parametrize("rules", [[], INDEXED])
+@pytest.mark.parametrize("mode", ["row", "columnar", "profile"])
+def test_failing_rule_does_not_match(write_log, log_regex, line, counters, monkeypatch, rules, mode):
+    if mode == "columnar":
+        pytest.importorskip('numpy')
+    monkeypatch.setattr(stats, 'profile', mode == "profile")
+    path = write_log([line(0, uri='/a'), line(1, uri='/u3', status=404), line(2, uri='/b')])
+    ec = tagging_ec(rules + [("uri == '/a' or status > 'x'", "bad"), ("uri.startswith('/a')", "a")])
+    logfile = LogFile(path, log_regex, ec=ec, columnar=(mode == "columnar"))
+    logfile.read_all()
+    assert logfile.nrecords == 3
+    expected = {'192.0.2.0': {'bad', 'a'}}
+    if rules:
+        expected['192.0.2.1'] = {'u3'}
+    assert dict(logfile.tags) == expected
+    assert list(logfile.ratecounts) == ['192.0.2.1']
+    assert list(logfile.ratecounts['192.0.2.1']) == ['notfound']
+    # bad tagging rule on 2 lines (first matches before error), bad rate rule on all 3
+    assert counters.rec_runtime_errors == 5
+
+
+def test_stage_errors_are_counted_per_stage(counters):
+    ec = ExpressionCollection()
+    ec.add("status > 'x'", "onload", None)
+    ec.add("hits > 'x'", "session", None)
+    ec.compile()
+    assert not ec.apply_all("onload", {'status': 200})
+    assert not ec.apply_all("session", {'hits': 3})
+    assert (counters.rec_runtime_errors, counters.sum_runtime_errors) == (1, 1)
+
+
+def test_validated_expressions_are_bounded(monkeypatch):
+    monkeypatch.setattr(expressions, 'validated', dict())
+    monkeypatch.setattr(expressions, 'MAX_EXPRESSIONS', 3)
+    for n in range(5):
+        Expression(f"status == {n}")
+    assert list(expressions.validated) == ["status == 2", "status == 3", "status == 4"]
+    # used expression is kept longer
+    Expression("status == 2")
+    Expression("status == 5")
+    assert list(expressions.validated) == ["status == 4", "status == 2", "status == 5"]
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from logq import follow
+from logq.expressions import ExpressionCollection
+from logq.follow import Follower
+
+
+class Stop(Exception):
+    pass
+
+
+def test_follow_rotation(write_log, log_regex, line, monkeypatch):
+    path = write_log([line(n) for n in range(5)])
+    ec = ExpressionCollection()
+    ec.compile()
+    follower = Follower(path, log_regex, ec)
+    steps = iter([
+        # rename, new file not created yet: read_new() finds no file
+        lambda: os.rename(path, path + '.1'),
+        lambda: None,
+        lambda: write_log([line(n) for n in range(5, 8)]),
+        lambda: None,
+    ])
+
+    def sleep(interval):
+        try:
+            next(steps)()
+        except StopIteration:
+            raise Stop
+
+    monkeypatch.setattr(follow.time, 'sleep', sleep)
+    with pytest.raises(Stop):
+        follower.follow(interval=0, from_start=True)
+    assert follower.nrecords == 8
+
+
+def test_session_extra_fields(write_log, log_regex, line, counters):
+    path = write_log([line(0, uri='/a', size=10), line(3, ip='192.0.2.0', uri='/b', size=10),
+                      line(7, ip='192.0.2.0', uri='/b', size=10)])
+    ec = ExpressionCollection()
+    ec.add("bytes > 15 and uris == 2 and interval_min == 3", "session", None)
+    ec.compile()
+    alerts = list()
+    follower = Follower(path, log_regex, ec, fields={'size', 'uri'}, alert=alerts.append)
+    follower.read_new()
+    assert [(a['ip'], a['bytes'], a['uris'], a['interval_min']) for a in alerts] == [('192.0.2.0', 20, 2, 3)]
+    assert counters.rec_name_errors == counters.sum_name_errors == 0
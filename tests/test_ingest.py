@@ -0,0 +1,39 @@
+import socket
+
+import pytest
+
+from logq.expressions import ExpressionCollection
+from logq.follow import Follower
+from logq.ingest import Ingest
+
+# characters which str.splitlines() takes as line breaks
+BREAKS = '\x0b\x0c\x1c\x1d\x1e\x85  '
+
+
+@pytest.fixture
+def ingest(write_log, log_regex):
+    ec = ExpressionCollection()
+    ec.compile()
+    return Ingest(Follower(write_log([]), log_regex, ec=ec, alert=print))
+
+
+def test_file_lines_end_only_at_newline(ingest, write_log, log_regex, line, counters):
+    path = write_log([line(0), line(1, agent=f'a{BREAKS}b'), '\n', line(2).replace('\n', '\r\n')], name='other.log')
+    source = ingest.add_source(path, log_regex, from_start=True)
+    source.read()
+    assert source.lines == 3
+    assert ingest.follower.nrecords == 3
+    assert counters.parse_errors == 0
+
+
+def test_syslog_lines_end_only_at_newline(ingest, log_regex, line, counters, tmp_path):
+    source = ingest.add_source(f'unix://{tmp_path}/syslog.sock', log_regex)
+    source.sock.setblocking(False)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as client:
+        client.sendto(f'<190>nginx: {line(0)}<190>nginx: {line(1, agent=BREAKS)}'.encode(), source.local_address)
+        client.sendto(f'<190>nginx: {line(2)}'.encode(), source.local_address)
+    source.receive()
+    source.close()
+    assert source.lines == 3
+    assert ingest.follower.nrecords == 3
+    assert counters.parse_errors == 0
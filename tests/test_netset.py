@@ -0,0 +1,87 @@
+import ipaddress
+import random
+
+import pytest
+
+from logq.netset import IpGrouper, NetSet, parse_networks
+
+
+ADDRESS = {4: ipaddress.IPv4Address, 6: ipaddress.IPv6Address}
+
+
+def random_networks(rnd, version, count):
+    bits = 32 if version == 4 else 128
+    for _ in range(count):
+        address = ADDRESS[version](rnd.getrandbits(bits))
+        yield ipaddress.ip_network((address, rnd.randint(12, bits)), strict=False)
+
+
+def probes(networks):
+    """ first and last address of each network and their neighbours """
+    for net in networks:
+        first, last = int(net.network_address), int(net.broadcast_address)
+        top = 2 ** net.max_prefixlen - 1
+        for n in (first - 1, first, last, last + 1):
+            if 0 <= n <= top:
+                yield ADDRESS[net.version](n)
+
+
+@pytest.mark.parametrize("version", [4, 6])
+def test_lookup_same_as_ipaddress(version):
+    rnd = random.Random(version)
+    # prefixes near byte boundaries are most likely to go wrong
+    networks = list(random_networks(rnd, version, 300))
+    netset = NetSet(str(net) for net in networks)
+    ips = list(probes(networks)) + list(probes(random_networks(rnd, version, 300)))
+    found = [str(ip) in netset for ip in ips]
+    assert found == [any(ip in net for net in networks) for ip in ips]
+    assert 0 < sum(found) < len(found)
+
+
+def test_ranges_and_mapped():
+    netset = NetSet(['192.0.2.10-192.0.2.99', '198.51.100.7', '2001:db8::/32'])
+    assert [f'192.0.2.{n}' in netset for n in (9, 10, 99, 100)] == [False, True, True, False]
+    assert '198.51.100.7' in netset and '198.51.100.8' not in netset
+    assert '::ffff:192.0.2.50' in netset and '::ffff:192.0.2.5' not in netset
+    assert '2001:db8:ffff::1' in netset and '2001:db9::1' not in netset
+    # network address of grouped session
+    assert '192.0.2.64/26' in netset
+    for bad in ('192.0.2', '192.0.2.256', 'x', '', None, 42):
+        assert bad not in netset
+    assert parse_networks('192.0.2.10 - 192.0.2.20  # comment')[0] == parse_networks('192.0.2.10-192.0.2.20')[0]
+    with pytest.raises(ValueError):
+        parse_networks('192.0.2.20-192.0.2.10')
+
+
+def test_everything():
+    netset = NetSet(['0.0.0.0/0'])
+    assert '203.0.113.1' in netset and '::ffff:1.2.3.4' in netset
+    assert '2001:db8::1' not in netset
+    netset.add('::/0')
+    assert '2001:db8::1' in netset
+
+
+def test_asn_rows(tmp_path):
+    path = tmp_path / 'ip2asn.tsv'
+    path.write_text('1.0.0.0\t1.0.0.255\t13335\tUS\tCLOUDFLARENET\n'
+                    '1.0.4.0\t1.0.7.255\t38803\tAU\tWPL-AS-AP\n'
+                    '2606:4700::\t2606:4700:ffff:ffff:ffff:ffff:ffff:ffff\t13335\tUS\tCLOUDFLARENET\n'
+                    '\n# comment\n')
+    cloud = NetSet.from_config(dict(file=str(path), asn=['AS13335']))
+    assert '1.0.0.1' in cloud and '2606:4700::1' in cloud
+    assert '1.0.5.1' not in cloud
+    every = NetSet.from_config(dict(file=[str(path)], networks=['10.0.0.0/8']))
+    assert '1.0.5.1' in every and '10.1.2.3' in every and '1.0.1.0' not in every
+    assert parse_networks('1.0.4.0 1.0.7.255 AS38803 AU')[1] == '38803'
+
+    path.write_text('1.0.0.0 bad 1\n')
+    with pytest.raises(ValueError, match='ip2asn.tsv:1'):
+        NetSet.from_config(dict(file=str(path)))
+
+
+def test_grouper():
+    assert IpGrouper(24)('192.0.2.77') == '192.0.2.0/24'
+    assert IpGrouper(24, 48)('2001:db8:1:2::1') == '2001:db8:1::/48'
+    assert IpGrouper(24)('unknown') == 'unknown'
+    with pytest.raises(ValueError):
+        IpGrouper(33)
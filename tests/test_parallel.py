@@ -0,0 +1,36 @@
+from logq import parallel
+from logq.expressions import ExpressionCollection
+from logq.logfile import LogFile
+
+
+def test_parse_errors_of_workers(write_log, log_regex, line, counters, monkeypatch):
+    path = write_log([line(n) + f"broken {n}\n" for n in range(40)])
+    # several chunks
+    monkeypatch.setattr(parallel, 'CHUNK_SIZE', 512)
+    for jobs in (1, 2):
+        monkeypatch.setattr(counters, 'parse_errors', 0)
+        logfile = LogFile(path, log_regex)
+        logfile.read_all(jobs=jobs)
+        assert logfile.nrecords == 40
+        assert counters.parse_errors == 40
+
+    monkeypatch.setattr(counters, 'parse_errors', 0)
+    parallel.read_files(LogFile(path, log_regex), [path, path])
+    assert counters.parse_errors == 80
+
+
+def test_tagging_errors_of_workers(write_log, log_regex, line, counters, monkeypatch):
+    path = write_log([line(n, uri=f'/{n % 2}') for n in range(40)])
+    monkeypatch.setattr(parallel, 'CHUNK_SIZE', 512)
+    for profile in (False, True):
+        monkeypatch.setattr(counters, 'profile', profile)
+        monkeypatch.setattr(counters, 'rec_runtime_errors', 0)
+        ec = ExpressionCollection()
+        ec.add("status > 'x'", "tagging", "bad")
+        ec.add("uri == '/1'", "tagging", "odd")
+        ec.compile()
+        logfile = LogFile(path, log_regex, ec=ec)
+        logfile.read_all(jobs=2)
+        assert logfile.nrecords == 40
+        assert counters.rec_runtime_errors == 40
+        assert {tag for tags in logfile.tags.values() for tag in tags} == {'odd'}
@@ -0,0 +1,66 @@
+import pytest
+
+from logq.parser import CombinedParser, RegexParser
+
+GOOD = '192.0.2.1 - - [01/Sep/2025:16:00:01 +0000] "GET /a?b=1 HTTP/1.1" 200 10 "http://x/" "curl/8.0"'
+
+LINES = [
+    GOOD,
+    GOOD.replace('"curl/8.0"', '"Mozilla/5.0 (X11; Linux) é中"'),
+    GOOD + ' trailing "text"',
+    GOOD.replace(' +0000', ''),
+    GOOD.replace('/a?b=1', '/a b'),
+    GOOD.replace('"http://x/"', '"-"').replace('"curl/8.0"', '""'),
+    GOOD.replace('"http://x/"', '"a"b"'),
+    GOOD.replace(' 200 10 ', ' 200 - '),
+    GOOD.replace(' 200 10 ', ' 200  10 '),
+    GOOD.replace(' 200 10 ', ' 2x0 10 '),
+    GOOD.replace(' 200 10 ', ' 4294967295 18446744073709551615 '),
+    GOOD.replace(' 200 10 ', ' 4294967296 10 '),
+    GOOD.replace(' 200 10 ', ' 200 9223372036854775808 '),
+    GOOD.replace(' 200 10 ', ' 0200 0010 '),
+    GOOD.replace(' 200 10 ', ' ٢٠٠ 10 '),
+    GOOD.replace('192.0.2.1', '192.0.2'),
+    GOOD.replace('192.0.2.1', '192..2.1'),
+    GOOD.replace('192.0.2.1', '.192.0.2'),
+    GOOD.replace('192.0.2.1', '192.0.2.x'),
+    GOOD.replace('192.0.2.1', '2001:db8::1'),
+    GOOD.replace('192.0.2.1', '١.0.2.1'),
+    GOOD.replace('GET', 'G3T'),
+    GOOD.replace('GET', ''),
+    GOOD.replace('GET /a?b=1 HTTP/1.1', 'GET /a'),
+    GOOD.replace('GET /a?b=1 HTTP/1.1', '-'),
+    GOOD.replace('01/Sep/2025:16:00:01 +0000', ''),
+    GOOD.replace('01/Sep/2025:16:00:01 +0000', '01/Foo/2025:16:00:01'),
+    GOOD.replace('01/Sep/2025:16:00:01 +0000', '31/Feb/2025:16:00:01'),
+    GOOD.replace('] "GET', ']  "GET'),
+    GOOD.replace('"GET', 'GET'),
+    GOOD[:-1],
+    GOOD[:40],
+    '',
+    'garbage',
+]
+
+
+def parse(parse_func, line):
+    """ result of parse_func, or exception type: both parsers must fail on same lines """
+    try:
+        return parse_func(line)
+    except ValueError as ex:
+        return type(ex)
+
+
+@pytest.mark.parametrize("fields", [None, ['uri', 'user_agent']])
+@pytest.mark.parametrize("line", LINES)
+def test_combined_parser_same_as_regex(log_regex, line, fields):
+    expected = parse(RegexParser(log_regex, fields).parse, line)
+    combined = CombinedParser(log_regex, fields)
+    assert parse(combined.parse, line) == expected
+    assert parse(combined.parse_bytes, line.encode('utf-8')) == expected
+
+
+def test_good_line(log_regex):
+    ts, record = CombinedParser(log_regex).parse(GOOD)
+    assert ts == 1756742401
+    assert record['ip'] == '192.0.2.1'
+    assert (record['status'], record['size'], record['uri']) == (200, 10, '/a?b=1')
@@ -0,0 +1,30 @@
+import pytest
+
+from logq.expressions import ExpressionCollection
+from logq.logfile import LogFile
+from logq.netset import IpGrouper
+
+
+def onload_ec(expr):
+    ec = ExpressionCollection()
+    ec.add(expr, "onload", None)
+    ec.compile()
+    return ec
+
+
+@pytest.mark.parametrize("options", [dict(), dict(use_mmap=True), dict(columnar=True)])
+def test_group_net_with_ip_onload(write_log, log_regex, line, options):
+    if options.get('columnar'):
+        pytest.importorskip('numpy')
+    path = write_log([line(n) for n in range(10)] + [line(1, ip='198.51.100.1')])
+    ec = onload_ec("ip == '192.0.2.0/24'")
+    logfile = LogFile(path, log_regex, ec=ec, group=IpGrouper(24), **options)
+    logfile.read_all()
+    assert logfile.ips() == ['192.0.2.0/24']
+    assert logfile.nrecords == 10
+
+
+def test_prefilter_exclude():
+    ec = onload_ec("ip == '192.0.2.1' and uri == '/a'")
+    assert ec.prefilter().clauses == [['192.0.2.1'], ['/a']]
+    assert ec.prefilter(exclude=('ip',)).clauses == [['/a']]
@@ -0,0 +1,26 @@
+from logq.ratecount import RateCount
+
+
+def test_early_peak_does_not_pin_buffer():
+    rc = RateCount([60, 600])
+    # burst of 100 events, then one event per minute for a long time
+    for n in range(100):
+        rc.add(1000, data=n)
+    for n in range(10000):
+        rc.add(2000 + 60 * n, data=-n)
+    assert rc.get_max() == 100
+    assert rc.top_dataq == list(range(100))
+    assert len(rc.times) < 200
+    assert len(rc.data) == len(rc.times)
+
+
+def test_later_peak_replaces_copied_one():
+    rc = RateCount(60)
+    for n in range(5):
+        rc.add(1000, data=n)
+    for n in range(200):
+        rc.add(2000 + 60 * n, data=None)
+    for n in range(8):
+        rc.add(100000, data=n)
+    assert rc.get_max() == 8
+    assert rc.top_dataq == list(range(8))
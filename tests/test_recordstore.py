@@ -0,0 +1,55 @@
+import pytest
+
+from logq.logfile import LogFile
+from logq.parser import FIELDS, get_parser
+from logq.recordstore import RecordStore
+
+
+def test_store_wide_status():
+    store = RecordStore()
+    store.append(0, {'ip': '192.0.2.1', 'status': 70000, 'size': 1 << 40})
+    assert store.status[0] == 70000
+    assert store.size[0] == 1 << 40
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_big_numbers_are_parse_errors(write_log, log_regex, counters, use_mmap):
+    path = write_log([(200, 10), (70000, 10), (1 << 33, 10), (200, 1 << 64), (404, 20)])
+    logfile = LogFile(path, log_regex, use_mmap=use_mmap)
+    logfile.read_all()
+    assert list(logfile.store.status) == [200, 70000, 404]
+    assert counters.parse_errors == 2
+
+
+def test_wide_status_summary(write_log, log_regex):
+    pytest.importorskip('numpy')
+    path = write_log([(200, 10), (70000, 10), (70000, 10)])
+    logfile = LogFile(path, log_regex)
+    logfile.read_all()
+    per_ip = {ip: logfile._make_summary(ip) for ip in logfile.ips()}
+    assert logfile.summaries() == per_ip
+    assert per_ip['192.0.2.1']['status70000'] == 1
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_rows_same_as_parsed(write_log, log_regex, line, use_mmap):
+    lines = [line(n, ip=f'192.0.2.{n % 3}', uri=f'/{n % 4}', agent=f'agent é{n % 2}', size=n) for n in range(20)]
+    path = write_log(lines)
+    logfile = LogFile(path, log_regex, use_mmap=use_mmap)
+    logfile.read_all()
+    store = logfile.store
+    parsed = [get_parser(log_regex).parse(s.strip()) for s in lines]
+    assert len(store) == len(parsed)
+    assert [(store.ts[n], store.row(n, FIELDS)) for n in range(len(store))] == parsed
+    assert [list(rows) for rows in store.ip_rows.values()] == [list(range(k, 20, 3)) for k in range(3)]
+
+    # copies of rows keep values, columns are re-encoded
+    copy = RecordStore()
+    copy.append(*parsed[5])
+    copy.extend(store)
+    remap = copy.remap(store)
+    for n in range(0, 20, 2):
+        copy.copy_row(store, n, remap)
+    expected = parsed[5:6] + parsed + parsed[::2]
+    assert [(copy.ts[n], copy.row(n, FIELDS)) for n in range(len(copy))] == expected
+    assert list(copy.ip_rows['192.0.2.2']) == [0] + [n + 1 for n in range(2, 20, 3)] + [21 + n // 2 for n in range(2, 20, 6)]
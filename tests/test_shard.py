@@ -0,0 +1,75 @@
+import json
+import sys
+
+import pytest
+
+from logq import cli
+from logq.parser import COMBINED_REGEX
+
+CONFIG = f'''
+def_regex = {json.dumps(COMBINED_REGEX)}
+
+[query.admin]
+query = "uri.startswith('/admin')"
+stage = "tagging"
+tag = "ADMIN"
+
+[query.post]
+query = "method == 'POST'"
+stage = "rate"
+counter = "postrate"
+'''
+
+
+@pytest.fixture
+def logq(tmp_path, monkeypatch):
+    """ run logq with arguments, returns output """
+    config = tmp_path / 'logq.toml'
+    config.write_text(CONFIG)
+
+    def run(*args) -> str:
+        output = tmp_path / 'output'
+        output.unlink(missing_ok=True)
+        # subcommand goes first
+        command = [args[0]] if args[0] == 'merge' else []
+        argv = ['logq', *command, '-c', str(config), *args[len(command):], '--output-file', str(output)]
+        monkeypatch.setattr(sys, 'argv', argv)
+        cli.main()
+        # --export writes no output
+        return output.read_text() if output.exists() else ''
+    return run
+
+
+@pytest.fixture
+def logs(write_log, line):
+    """ two logs of same ips, second one continues first one """
+    lines = [line(n, ip=f'192.0.2.{n % 7}', status=(200, 404, 302)[n % 3], size=n,
+                  method='POST' if n % 5 == 0 else 'GET', uri=f'/{"admin" if n % 11 == 0 else "page"}/{n % 13}')
+             for n in range(300)]
+    return write_log(lines[:150], name='a.log'), write_log(lines[150:], name='b.log')
+
+
+@pytest.mark.parametrize("args", [['--sum', '-o', 'json'], ['--sum', '--session', 'hits > 42', '-o', 'json'],
+                                  ['-o', 'csv'], ['--out', "status == 404", '-o', 'log']])
+def test_merge_of_logs_same_as_one_run(logq, logs, tmp_path, args):
+    shards = []
+    for n, path in enumerate(logs):
+        shards.append(str(tmp_path / f'shard{n}'))
+        logq('-q', 'admin', 'post', '-l', path, '--export', shards[-1], *[a for a in args if a == '--sum'])
+    merged = logq('merge', *shards, *args)
+    single = logq('-q', 'admin', 'post', '-l', *logs, *args)
+    assert merged
+    if args[0] == '--sum':
+        assert json.loads(merged) == json.loads(single)
+    else:
+        assert sorted(merged.splitlines()) == sorted(single.splitlines())
+
+
+def test_merge_of_partitions_same_as_one_run(logq, logs, tmp_path):
+    shards = [str(tmp_path / f'part{n}') for n in range(3)]
+    for n, shard in enumerate(shards):
+        logq('-q', 'admin', 'post', '-l', *logs, '--partition', f'{n}/3', '--export', shard)
+    single = json.loads(logq('-q', 'admin', 'post', '-l', *logs, '--sum', '-o', 'json'))
+    assert json.loads(logq('merge', *shards, '--sum', '-o', 'json')) == single
+    assert any(s['tags'] == ['ADMIN'] for s in single)
+    assert any('rates_postrate' in s for s in single)
@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+from logq.logfile import LogFile
+from logq.sketch import URIS_PRECISION, ApproxLogFile, CountMinSketch, HeavyHitters, HyperLogLog
+
+
+def stream(rnd, heavy=20, light=3000):
+    """ keys: few heavy ones with many hits, many light ones with 1-3 hits, shuffled """
+    keys = [f'heavy{n}' for n in range(heavy) for _ in range(100 + n)]
+    keys += [f'light{n}' for n in range(light) for _ in range(rnd.randint(1, 3))]
+    rnd.shuffle(keys)
+    return keys
+
+
+def test_count_min_bounds():
+    rnd = random.Random(23)
+    keys = stream(rnd)
+    sketch = CountMinSketch(width=2048, depth=4)
+    for key in keys:
+        sketch.add(key)
+    counts = {key: keys.count(key) for key in set(keys)}
+    assert sketch.total == len(keys)
+    errors = [sketch.estimate(key) - count for key, count in counts.items()]
+    assert min(errors) >= 0
+    # bound holds for each key with probability 1 - exp(-depth)
+    assert sum(e > sketch.error() for e in errors) < 0.05 * len(errors)
+
+
+@pytest.mark.parametrize("count", [0, 10, 1000, 50000])
+def test_hyperloglog_count(count):
+    hll = HyperLogLog(precision=10)
+    for n in range(count):
+        hll.add(f'192.0.{n >> 8}.{n & 255}')
+        hll.add(f'192.0.{n >> 8}.{n & 255}')
+    assert abs(hll.count() - count) <= 5 * hll.error() * count
+
+
+def test_heavy_hitters_keep_top():
+    rnd = random.Random(7)
+    sketch = CountMinSketch(width=4096)
+    top = HeavyHitters(capacity=40)
+    for key in stream(rnd):
+        estimate = sketch.add(key)
+        if key in top:
+            top.update(key, estimate)
+        else:
+            top.offer(key, estimate, value=key)
+    assert len(top) == 40
+    assert {f'heavy{n}' for n in range(20)} <= set(top.values)
+    assert top.evicted > 0
+    assert top.min_count() == min(top.counts.values())
+
+
+def key_ip(key):
+    n = int(key[5:])
+    return f'198.51.100.{n}' if key.startswith('heavy') else f'10.0.{n >> 8}.{n & 255}'
+
+
+def test_approx_same_as_exact_for_heavy_ips(write_log, log_regex, line):
+    rnd = random.Random(3)
+    keys = stream(rnd, heavy=5, light=500)
+    lines = [line(n, ip=key_ip(key), status=(200, 404)[n % 2], uri=f'/{n % 7}') for n, key in enumerate(keys)]
+    path = write_log(lines)
+    exact = LogFile(path, log_regex)
+    exact.read_all()
+    approx = ApproxLogFile(path, log_regex, top=20)
+    approx.read_all()
+    assert approx.nrecords == exact.nrecords
+    heavy = [f'198.51.100.{n}' for n in range(5)]
+    uris = HyperLogLog(URIS_PRECISION)
+    for n in range(7):
+        uris.add(f'/{n}')
+    assert set(heavy) <= set(approx.ips())
+    for ip in heavy:
+        summary, expected = approx.summary(ip), exact.summaries()[ip]
+        assert summary['hits'] == expected['hits']
+        assert summary['status404'] == expected['status404']
+        # same estimate as HyperLogLog of all uris of ip: two of them may share register
+        assert expected['uris'] == 7
+        assert summary['uris'] == uris.count()
+    assert abs(approx.distinct_ips.count() - len(exact.ips())) <= 0.05 * len(exact.ips())
@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import pytest
+
+from logq import timerange
+from logq.logfile import LogFile
+from logq.timerange import TimeSeeker, parse_time
+
+# timestamp of log_line(0)
+START = parse_time('2025-09-01 16:00:00')
+NLINES = 1200
+
+
+@pytest.fixture
+def timed_log(write_log, line, monkeypatch):
+    """ log of one line per second, a few lines out of order and garbage lines; small gaps to search """
+    monkeypatch.setattr(timerange, 'MIN_GAP', 1024)
+    monkeypatch.setattr(timerange, 'INDEX_STEP', 4096)
+    lines = [line(n) for n in range(NLINES)]
+    # late lines, within TOLERANCE
+    lines[600], lines[601] = line(601), line(600 - 200)
+    lines[900:900] = ['garbage\n'] * 20
+    return write_log(lines)
+
+
+def timestamps(path, log_regex, **kwargs):
+    logfile = LogFile(path, log_regex, **kwargs)
+    logfile.read_all()
+    return sorted(logfile.store.ts)
+
+
+@pytest.mark.parametrize("options", [dict(), dict(use_mmap=True), dict(time_index=True)])
+@pytest.mark.parametrize("since, until", [
+    (None, None), (-10, None), (0, None), (1, None), (599, None), (600, None), (601, 601), (601, 602),
+    (None, 0), (None, 1), (None, 600), (700, 1100), (NLINES - 1, None), (NLINES - 1, NLINES), (NLINES, None),
+    (NLINES + 1000, None), (None, NLINES + 1000), (1000, 500),
+])
+def test_range_same_as_filter(timed_log, log_regex, options, since, until):
+    everything = timestamps(timed_log, log_regex)
+    since = None if since is None else START + since
+    until = None if until is None else START + until
+    expected = [ts for ts in everything if (since is None or ts >= since) and (until is None or ts < until)]
+    for _ in range(2):
+        # second run with saved time index
+        assert timestamps(timed_log, log_regex, since=since, until=until, **options) == expected
+
+
+def test_range_is_seeked(timed_log, log_regex, monkeypatch):
+    monkeypatch.setattr(timerange, 'TOLERANCE', 10)
+    start, end = TimeSeeker(timed_log, log_regex).byte_range(START + 1000, START + 1050)
+    with open(timed_log, 'rb') as f:
+        size = len(f.read())
+    assert 0 < start < end < size
+    assert end - start < size // 4
+
+
+def test_parse_time():
+    now = datetime(2025, 9, 1, 16, 30)
+    assert parse_time('2025-09-01 16:00') == START
+    assert parse_time('2025-09-01T16:00:00') == START
+    assert parse_time('01/Sep/2025:16:00:00') == START
+    assert parse_time('30m', now) == START
+    assert parse_time('-1h', now) == START - 1800
+    with pytest.raises(ValueError):
+        parse_time('yesterday')